@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Inference Backend Benchmark - cv2.dnn vs ONNX Runtime vs OpenVINO
+Runs best.onnx through every available backend on test_images/test,
+timing single-image latency and batched throughput, and checks that each
+backend returns the same detections as cv2.dnn: same classes, boxes within
+--box-tolerance pixels and confidences within --conf-tolerance points.
+Backends whose package is not installed are skipped.
+
+Run with: python benchmarks/bench_backends.py [--images 50] [--batch-size 8]
+"""
+
+import sys
+import time
+import argparse
+import statistics
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'my_fastapi_app'))
+
+from main import Detection, MODEL_PATH, DAMAGE_CLASSES, DETECTION_POSTPROCESS, DECODE_MIN_SIZE, decode_image
+from backends import BACKENDS
+
+
+def load_images(num_images):
+    test_images_dir = ROOT / 'test_images' / 'test'
+    images = []
+    for img_path in sorted(test_images_dir.glob('*.jpg'))[:num_images]:
+        image, _ = decode_image(img_path.read_bytes(), min_size=DECODE_MIN_SIZE)
+        images.append(image)
+    return images
+
+
+def same_detections(expected, actual, box_tolerance, conf_tolerance):
+    if expected['classes'] != actual['classes']:
+        return False
+    for box_a, box_b in zip(expected['boxes'], actual['boxes']):
+        if max(abs(a - b) for a, b in zip(box_a, box_b)) > box_tolerance:
+            return False
+    for conf_a, conf_b in zip(expected['confidences'], actual['confidences']):
+        if abs(conf_a - conf_b) > conf_tolerance:
+            return False
+    return True
+
+
+def run_backend(engine, images, batch_size, repeat):
+    # Warm-up: first runs include graph compilation and allocations
+    engine.detect_batch(images[:batch_size])
+    engine(images[0])
+
+    latencies = []
+    for _ in range(repeat):
+        for image in images:
+            start = time.perf_counter()
+            engine(image)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for i in range(0, len(images), batch_size):
+            engine.detect_batch(images[i:i + batch_size])
+    throughput = repeat * len(images) / (time.perf_counter() - start)
+
+    return {
+        'p50_ms': statistics.median(latencies),
+        'p95_ms': sorted(latencies)[int(len(latencies) * 0.95) - 1],
+        'throughput': throughput,
+        'results': engine.detect_batch(images)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=50, help='number of test images')
+    parser.add_argument('--batch-size', type=int, default=8, help='images per batched forward pass')
+    parser.add_argument('--repeat', type=int, default=3, help='timed passes over the images')
+    parser.add_argument('--threads', type=int, default=0, help='threads per backend (0: library default)')
+    parser.add_argument('--backends', type=str, default=','.join(BACKENDS), help='comma-separated backends to compare')
+    parser.add_argument('--box-tolerance', type=int, default=2, help='max box coordinate difference in pixels')
+    parser.add_argument('--conf-tolerance', type=float, default=0.5, help='max confidence difference in percentage points')
+    args = parser.parse_args()
+
+    images = load_images(args.images)
+    thread_option = {'onnxruntime': 'intra_op_threads'}
+
+    results = {}
+    for name in args.backends.split(','):
+        options = {thread_option.get(name, 'num_threads'): args.threads}
+        try:
+            engine = Detection(MODEL_PATH, DAMAGE_CLASSES, postprocess=DETECTION_POSTPROCESS, backend=name, backend_options=options)
+        except ImportError as e:
+            print(f"   Skipping {name}: {e}")
+            continue
+        results[name] = run_backend(engine, images, args.batch_size, args.repeat)
+
+    reference_name = next(iter(results))
+    reference = results[reference_name]['results']
+
+    print("=" * 70)
+    print(f"Backend benchmark: {len(images)} images, batch size {args.batch_size}, reference {reference_name}")
+    print("=" * 70)
+    print(f"   {'backend':12} {'p50 ms':>10} {'p95 ms':>10} {'img/s':>10} {'speedup':>9} {'agreement':>11}")
+    all_agree = True
+    for name, r in results.items():
+        agreeing = sum(
+            same_detections(expected, actual, args.box_tolerance, args.conf_tolerance)
+            for expected, actual in zip(reference, r['results'])
+        )
+        all_agree = all_agree and agreeing == len(images)
+        speedup = r['throughput'] / results[reference_name]['throughput']
+        print(f"   {name:12} {r['p50_ms']:10.2f} {r['p95_ms']:10.2f} {r['throughput']:10.1f} {speedup:8.2f}x {agreeing:5d}/{len(images):<5d}")
+    fastest = max(results, key=lambda name: results[name]['throughput'])
+    print(f"   Fastest (batched throughput): {fastest}")
+    print("=" * 70)
+
+    return all_agree
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Decoder Microbenchmark - Vectorized vs legacy YOLOv8 output decoding
+Records raw `preds` tensors from the model on test images (or loads a
+previous recording) and times both decoders on exactly the same input.
+Then times the vectorized decoder with each post-processing preset, with
+the number of candidates reaching NMS and of detections returned.
+
+Run with: python benchmarks/bench_decode.py [--images 20] [--repeat 20]
+"""
+
+import os
+import sys
+import time
+import argparse
+import statistics
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'my_fastapi_app'))
+
+from main import detection, POSTPROCESS_PRESETS
+
+
+def legacy_extract_output(preds, classes, image_shape, input_shape, score=0.005, nms=0.0, confidence=0.0001):
+    """Pure Python per-anchor/per-class decoder, kept as the reference implementation"""
+    class_ids, confs, boxes = list(), list(), list()
+
+    image_height, image_width = image_shape
+    input_height, input_width = input_shape
+    x_factor = image_width / input_width
+    y_factor = image_height / input_height
+
+    rows = preds[0].shape[0]
+    for i in range(rows):
+        row = preds[0][i]
+        conf = row[4]
+        classes_score = row[4:]
+        for class_id, class_score in enumerate(classes_score):
+            if class_score > score:
+                label = classes[int(class_id)]
+                confs.append(conf)
+                class_ids.append(label)
+                x, y, w, h = row[0].item(), row[1].item(), row[2].item(), row[3].item()
+                left = int((x - 0.5 * w) * x_factor)
+                top = int((y - 0.5 * h) * y_factor)
+                width = int(w * x_factor)
+                height = int(h * y_factor)
+                boxes.append(np.array([left, top, width, height]))
+
+    r_class_ids, r_confs, r_boxes = list(), list(), list()
+    indexes = cv2.dnn.NMSBoxes(boxes, confs, confidence, nms)
+    if len(indexes) > 0:
+        for i in indexes:
+            r_class_ids.append(class_ids[i])
+            r_confs.append(confs[i] * 100)
+            r_boxes.append(boxes[i].tolist())
+
+    return {
+        'boxes': [[int(x) for x in box] for box in r_boxes],
+        'confidences': [float(conf) for conf in r_confs],
+        'classes': [str(c) for c in r_class_ids]
+    }
+
+
+def record_preds(num_images, width=640, height=640):
+    """Run the model on test images and capture the transposed raw output"""
+    test_images_dir = ROOT / 'test_images' / 'test'
+    image_paths = sorted(test_images_dir.glob('*.jpg'))[:num_images]
+
+    recorded, shapes = [], []
+    for img_path in image_paths:
+        image = cv2.imread(str(img_path))
+        if image is None:
+            continue
+        blob = cv2.dnn.blobFromImage(image, 1/255.0, (width, height), swapRB=True, crop=False)
+        recorded.append(detection.model.forward(blob).transpose((0, 2, 1)))
+        shapes.append(image.shape[:2])
+
+    return np.stack(recorded), np.array(shapes)
+
+
+def time_decoder(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=20, help='number of test images to record preds from')
+    parser.add_argument('--repeat', type=int, default=20, help='timed runs per decoder and image')
+    parser.add_argument('--preds', type=str, default=None, help='.npz recording to load (recorded and saved if missing)')
+    args = parser.parse_args()
+
+    if args.preds and os.path.exists(args.preds):
+        recording = np.load(args.preds)
+        all_preds, shapes = recording['preds'], recording['shapes']
+    else:
+        all_preds, shapes = record_preds(args.images)
+        if args.preds:
+            np.savez_compressed(args.preds, preds=all_preds, shapes=shapes)
+
+    vectorized = detection._Detection__extract_output
+    legacy_ms, vectorized_ms, mismatches = [], [], 0
+    # The reference decoder has no top-k, caps or class-aware NMS: compare on the legacy preset
+    legacy_preset = POSTPROCESS_PRESETS['legacy']
+    preset_ms = {name: [] for name in POSTPROCESS_PRESETS}
+    preset_candidates = {name: [] for name in POSTPROCESS_PRESETS}
+    preset_detections = {name: [] for name in POSTPROCESS_PRESETS}
+
+    for preds, shape in zip(all_preds, shapes):
+        kwargs = dict(preds=preds, image_shape=tuple(shape), input_shape=(640, 640))
+        legacy_kwargs = dict(kwargs, score=legacy_preset['score'], nms=legacy_preset['nms'], confidence=legacy_preset['confidence'])
+
+        # The reference scores every candidate with the first class column, the
+        # decoder with its own class score: both agree when only that column is kept
+        single_class = dict(kwargs, preds=preds[..., :5])
+        legacy_single_class = dict(legacy_kwargs, preds=preds[..., :5])
+        if legacy_extract_output(classes=detection.classes, **legacy_single_class) != vectorized(**single_class, **legacy_preset):
+            mismatches += 1
+
+        legacy_ms.append(time_decoder(lambda: legacy_extract_output(classes=detection.classes, **legacy_kwargs), max(1, args.repeat // 5)))
+        vectorized_ms.append(time_decoder(lambda: vectorized(**kwargs, **legacy_preset), args.repeat))
+
+        for name, preset in POSTPROCESS_PRESETS.items():
+            candidates = int((preds[0, :, 4:] > preset['score']).sum())
+            preset_candidates[name].append(min(candidates, preset['top_k']) if preset['top_k'] else candidates)
+            preset_detections[name].append(len(vectorized(**kwargs, **preset)['boxes']))
+            preset_ms[name].append(time_decoder(lambda: vectorized(**kwargs, **preset), args.repeat))
+
+    legacy_median = statistics.median(legacy_ms)
+    vectorized_median = statistics.median(vectorized_ms)
+
+    print("=" * 60)
+    print(f"Decoder benchmark on {len(all_preds)} recorded preds tensors")
+    print("=" * 60)
+    print(f"   Legacy decoder (median):     {legacy_median:8.3f} ms")
+    print(f"   Vectorized decoder (median): {vectorized_median:8.3f} ms")
+    print(f"   Speedup:                     {legacy_median / vectorized_median:8.1f}x")
+    print(f"   Output mismatches (class 0): {mismatches}")
+    print("-" * 60)
+    print(f"   {'preset':10} {'median ms':>10} {'max ms':>10} {'max to NMS':>11} {'max dets':>9}")
+    for name in POSTPROCESS_PRESETS:
+        print(f"   {name:10} {statistics.median(preset_ms[name]):10.3f} {max(preset_ms[name]):10.3f} "
+              f"{max(preset_candidates[name]):11d} {max(preset_detections[name]):9d}")
+    print("=" * 60)
+
+    return mismatches == 0
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Image Decode Benchmark - Legacy PIL path vs reduced-size BGR decode
+Measures per-image latency and peak RSS of each decode path on
+test_images/test. Every method runs in its own child process so peak RSS
+is not shared between them.
+
+The test set is small web images, so by default the images are also
+re-encoded at phone-camera resolution (--resolution 4032x3024) to show
+the effect on real uploads. Use --resolution native to skip that.
+
+Run with: python benchmarks/bench_image_decode.py [--images 50]
+"""
+
+import io
+import sys
+import json
+import time
+import argparse
+import resource
+import statistics
+import tempfile
+import subprocess
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'my_fastapi_app'))
+
+METHODS = ('legacy', 'fast')
+
+
+def load_uploads(num_images, resolution):
+    from PIL import Image
+
+    test_images_dir = ROOT / 'test_images' / 'test'
+    uploads = []
+    for img_path in sorted(test_images_dir.glob('*.jpg'))[:num_images]:
+        data = img_path.read_bytes()
+        if resolution != 'native':
+            width, height = (int(v) for v in resolution.split('x'))
+            img = Image.open(io.BytesIO(data)).convert('RGB').resize((width, height))
+            buffer = io.BytesIO()
+            img.save(buffer, format='JPEG', quality=90)
+            data = buffer.getvalue()
+        uploads.append(data)
+    return uploads
+
+
+def run_method(method, data_dir):
+    """Child process: decode every upload with one method and report stats as JSON"""
+    import numpy as np
+    from PIL import Image
+    from main import decode_image, DECODE_MIN_SIZE
+
+    uploads = [path.read_bytes() for path in sorted(Path(data_dir).iterdir())]
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    latencies = []
+    for data in uploads:
+        start = time.perf_counter()
+        if method == 'legacy':
+            image = Image.open(io.BytesIO(data)).convert("RGB")
+            image = np.array(image)
+            image = image[:,:,::-1].copy()
+        else:
+            image, _ = decode_image(data, min_size=DECODE_MIN_SIZE)
+        latencies.append((time.perf_counter() - start) * 1000)
+        del image
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({
+        'images': len(uploads),
+        'p50_ms': statistics.median(latencies),
+        'p95_ms': sorted(latencies)[int(len(latencies) * 0.95) - 1] if latencies else 0.0,
+        'peak_rss_mb': peak_rss / 1024,
+        'decode_rss_mb': (peak_rss - baseline_rss) / 1024
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=50, help='number of test images to decode')
+    parser.add_argument('--resolution', type=str, default='4032x3024', help="WxH to re-encode test images at, or 'native'")
+    parser.add_argument('--method', choices=METHODS, help=argparse.SUPPRESS)
+    parser.add_argument('--data-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.method:
+        run_method(args.method, args.data_dir)
+        return True
+
+    results = {}
+    with tempfile.TemporaryDirectory() as data_dir:
+        # Uploads are prepared once, up front, so re-encoding never counts towards peak RSS
+        for i, data in enumerate(load_uploads(args.images, args.resolution)):
+            Path(data_dir, f"{i:05d}.jpg").write_bytes(data)
+
+        for method in METHODS:
+            output = subprocess.run(
+                [sys.executable, __file__, '--method', method, '--data-dir', data_dir],
+                check=True, capture_output=True, text=True
+            ).stdout
+            results[method] = json.loads(output.strip().splitlines()[-1])
+
+    print("=" * 60)
+    print(f"Image decode benchmark: {results['legacy']['images']} images at {args.resolution}")
+    print("=" * 60)
+    print(f"   {'':10} {'p50 ms':>10} {'p95 ms':>10} {'decode RSS MB':>15}")
+    for method in METHODS:
+        r = results[method]
+        print(f"   {method:10} {r['p50_ms']:10.2f} {r['p95_ms']:10.2f} {r['decode_rss_mb']:15.1f}")
+    print(f"   Speedup (p50): {results['legacy']['p50_ms'] / results['fast']['p50_ms']:.1f}x")
+    print("=" * 60)
+    return True
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+"""
+API Benchmark Suite - Detection stage microbenchmarks and a workflow load test
+Stages: decodes images from test_images/test and runs each through the
+Detection engine, timing decode, hash, preprocess, forward, postprocess (split
+into decode_output and nms) and render (the stages /metrics reports) per image.
+Load: drives the full inspection workflow (start -> detect x N -> switch-to-return
+-> detect x N -> complete) against the app in-process, --concurrency workflows
+at a time, and reports throughput, per-endpoint latency percentiles and the
+mean server-side time per stage. It runs --rounds times, each with an empty
+result cache, and reports the median of each metric across rounds.
+Both report the peak RSS of the process.
+
+With --baseline, every metric is compared to a stored run and the script exits
+with 1 when any is worse by more than --tolerance (latencies and RSS higher,
+throughput lower, any new errors; p99 is only reported). --save-baseline stores this run there
+instead. Timings depend on the machine: record the baseline on the machine (or
+CI runner) that compares against it.
+
+Run with: python benchmarks/bench_suite.py [--images 50] [--workflows 16] [--concurrency 4] [--baseline benchmarks/baseline.json]
+"""
+
+import sys
+import json
+import math
+import time
+import asyncio
+import argparse
+import itertools
+import statistics
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'my_fastapi_app'))
+
+import main as app_module
+import metrics
+from result_cache import ResultCache
+from main import (
+    app, detection, decode_image, describe_image,
+    DECODE_MIN_SIZE, DETECTION_PRESET, INFERENCE_BACKEND, MODEL_VARIANT
+)
+
+PERCENTILES = (50, 95, 99)
+
+# Differences below these are noise whatever the tolerance (e.g. a 0.05 ms NMS pass)
+MIN_DELTA_MS = 0.2
+MIN_DELTA_MB = 5.0
+
+
+def load_test_images(num_images):
+    test_images_dir = ROOT / 'test_images' / 'test'
+    return [path.read_bytes() for path in sorted(test_images_dir.glob('*.jpg'))[:num_images]]
+
+
+def distinct_upload(data, n):
+    """A JPEG with the same pixels but its own bytes (and digest): a comment segment after the SOI marker"""
+    comment = f'bench upload {n}'.encode()
+    return data[:2] + b'\xff\xfe' + (len(comment) + 2).to_bytes(2, 'big') + comment + data[2:]
+
+
+def percentile(samples, p):
+    """Nearest-rank percentile"""
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def summarize(samples_ms):
+    return {f'p{p}_ms': round(percentile(samples_ms, p), 3) for p in PERCENTILES}
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_stages(images, repeat):
+    """Per-stage latencies of the Detection engine on each test image"""
+    # Warm-up: the first forward pass includes graph setup and allocations
+    warmup, _ = decode_image(images[0], min_size=DECODE_MIN_SIZE)
+    detection.render(warmup, detection(warmup))
+
+    samples = {}
+    for _ in range(repeat):
+        for data in images:
+            with metrics.collect() as timings:
+                with metrics.stage('decode'):
+                    image, scale = decode_image(data, min_size=DECODE_MIN_SIZE)
+                with metrics.stage('hash'):
+                    describe_image(image, scale)
+                results = detection(image)
+                detection.render(image, results)
+            for name, seconds in timings.items():
+                samples.setdefault(name, []).append(seconds * 1000)
+
+    return {
+        'per_stage': {name: summarize(stage_samples) for name, stage_samples in samples.items()},
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+async def run_workflow(client, pickup, returns, latencies, errors):
+    async def timed(endpoint, path, **kwargs):
+        start = time.perf_counter()
+        response = await client.post(path, **kwargs)
+        latencies.setdefault(endpoint, []).append((time.perf_counter() - start) * 1000)
+        if response.status_code != 200:
+            errors.append(f"{endpoint}: {response.status_code} {response.text[:200]}")
+            return None
+        return response.json()
+
+    start = time.perf_counter()
+    started = await timed('start', '/api/inspection/start')
+    if started is None:
+        return
+    session_id = started['session_id']
+    for phase, uploads in (('pickup', pickup), ('return', returns)):
+        if phase == 'return':
+            await timed('switch-to-return', f'/api/inspection/{session_id}/switch-to-return')
+        for i, data in enumerate(uploads):
+            await timed('detect', f'/api/inspection/{session_id}/detect', files={'file': (f'{phase}-{i}.jpg', data, 'image/jpeg')})
+    await timed('complete', f'/api/inspection/{session_id}/complete')
+    latencies.setdefault('workflow', []).append((time.perf_counter() - start) * 1000)
+
+
+async def run_load_round(images, workflows, concurrency, images_per_phase):
+    """Throughput and latency of complete inspection workflows against the in-process app"""
+    # Results cached by an earlier round would skip the model
+    app_module.result_cache = ResultCache(
+        app_module.result_cache.fingerprint,
+        max_bytes=app_module.result_cache.stats()['max_bytes']
+    )
+
+    # Test photos come round again once the set runs out, but every upload is a distinct
+    # file, so it goes through the model instead of hitting the result cache
+    photos = (distinct_upload(data, n) for n, data in enumerate(itertools.cycle(images)))
+    plans = [
+        ([next(photos) for _ in range(images_per_phase)], [next(photos) for _ in range(images_per_phase)])
+        for _ in range(workflows)
+    ]
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=None) as client:
+        # Warm-up workflow, not timed
+        await run_workflow(client, images[:1], images[1:2], {}, [])
+
+        stages_before = metrics.STAGE_SECONDS.snapshot()
+        latencies, errors = {}, []
+        slots = asyncio.Semaphore(concurrency)
+
+        async def limited(pickup, returns):
+            async with slots:
+                await run_workflow(client, pickup, returns, latencies, errors)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(limited(pickup, returns) for pickup, returns in plans))
+        elapsed = time.perf_counter() - start
+        stages_after = metrics.STAGE_SECONDS.snapshot()
+
+    stage_mean_ms = {}
+    for (name,), series in sorted(stages_after.items()):
+        before = stages_before.get((name,), {'sum': 0.0, 'count': 0})
+        count = series['count'] - before['count']
+        if count:
+            stage_mean_ms[name] = round((series['sum'] - before['sum']) / count * 1000, 3)
+
+    return {
+        'workflows_per_s': round(workflows / elapsed, 3),
+        'images_per_s': round(workflows * images_per_phase * 2 / elapsed, 3),
+        'errors': len(errors),
+        'error_samples': errors[:5],
+        'latency': {endpoint: summarize(samples) for endpoint, samples in latencies.items()},
+        'stage_mean_ms': stage_mean_ms,
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def combine_rounds(rounds):
+    """Median of each metric across rounds; errors add up and RSS keeps its peak"""
+    combined = {}
+    for key, value in rounds[0].items():
+        values = [round_report[key] for round_report in rounds if key in round_report]
+        if isinstance(value, dict):
+            combined[key] = combine_rounds(values)
+        elif key == 'errors':
+            combined[key] = sum(values)
+        elif key == 'error_samples':
+            combined[key] = [sample for samples in values for sample in samples][:5]
+        elif key == 'peak_rss_mb':
+            combined[key] = max(values) if None not in values else None
+        elif isinstance(value, (int, float)):
+            combined[key] = round(statistics.median(values), 3)
+        else:
+            combined[key] = value
+    return combined
+
+
+def run_load(images, workflows, concurrency, images_per_phase, rounds):
+    return combine_rounds([
+        asyncio.run(run_load_round(images, workflows, concurrency, images_per_phase))
+        for _ in range(rounds)
+    ])
+
+
+def flatten(report, prefix=''):
+    flat = {}
+    for key, value in report.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+def compare(report, baseline, tolerance):
+    """(metric, baseline, current, change) for each metric worse than the baseline beyond tolerance"""
+    current, reference = flatten(report['results']), flatten(baseline['results'])
+    regressions = []
+    for key, base in sorted(reference.items()):
+        value = current.get(key)
+        # p99 of a few dozen samples is close to the maximum: reported, but too noisy to gate on
+        if value is None or key.endswith('p99_ms'):
+            continue
+        if key.endswith('errors'):
+            worse = value > base
+        elif key.endswith('_per_s'):
+            worse = value < base * (1 - tolerance)
+        elif key.endswith('_ms'):
+            worse = value > base * (1 + tolerance) and value - base > MIN_DELTA_MS
+        elif key.endswith('_mb'):
+            worse = value > base * (1 + tolerance) and value - base > MIN_DELTA_MB
+        else:
+            continue
+        if worse:
+            change = (value - base) / base * 100 if base else float('inf')
+            regressions.append((key, base, value, change))
+    return regressions
+
+
+def print_report(report):
+    results = report['results']
+    print("=" * 70)
+    print(f"Benchmark suite: {json.dumps(report['config'])}")
+    print("=" * 70)
+    if 'stages' in results:
+        print("   Detection stages (ms per image)")
+        print(f"   {'stage':14} " + ' '.join(f"{f'p{p}':>10}" for p in PERCENTILES))
+        for name, summary in results['stages']['per_stage'].items():
+            print(f"   {name:14} " + ' '.join(f"{summary[f'p{p}_ms']:10.2f}" for p in PERCENTILES))
+        print(f"   Peak RSS: {results['stages']['peak_rss_mb']} MB")
+    if 'load' in results:
+        load = results['load']
+        print("-" * 70)
+        print(f"   Workflow load test: {load['workflows_per_s']:.2f} workflows/s, {load['images_per_s']:.2f} images/s, {load['errors']} errors")
+        print(f"   {'endpoint (ms)':18} " + ' '.join(f"{f'p{p}':>10}" for p in PERCENTILES))
+        for endpoint, summary in load['latency'].items():
+            print(f"   {endpoint:18} " + ' '.join(f"{summary[f'p{p}_ms']:10.2f}" for p in PERCENTILES))
+        print("   Mean server-side time per stage (ms): " + ', '.join(f"{name} {ms:.2f}" for name, ms in load['stage_mean_ms'].items()))
+        for sample in load['error_samples']:
+            print(f"   Error: {sample}")
+        print(f"   Peak RSS: {load['peak_rss_mb']} MB")
+    print("=" * 70)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--suites', type=str, default='stages,load', help='comma-separated suites to run: stages, load')
+    parser.add_argument('--images', type=int, default=50, help='number of test images')
+    parser.add_argument('--repeat', type=int, default=3, help='timed passes over the images (stages)')
+    parser.add_argument('--workflows', type=int, default=16, help='inspection workflows to run (load)')
+    parser.add_argument('--concurrency', type=int, default=4, help='workflows running at once (load)')
+    parser.add_argument('--images-per-phase', type=int, default=4, help='photos uploaded per phase (load)')
+    parser.add_argument('--rounds', type=int, default=3, help='load test rounds, metrics are the median across rounds')
+    parser.add_argument('--output', type=str, default=None, help='write the results to this JSON file')
+    parser.add_argument('--baseline', type=str, default=None, help='baseline JSON to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='store this run as the --baseline instead of comparing')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown before a metric counts as a regression')
+    args = parser.parse_args()
+
+    suites = args.suites.split(',')
+    images = load_test_images(args.images)
+    config = {
+        'suites': suites,
+        'images': len(images),
+        'repeat': args.repeat,
+        'workflows': args.workflows,
+        'concurrency': args.concurrency,
+        'images_per_phase': args.images_per_phase,
+        'rounds': args.rounds,
+        'backend': INFERENCE_BACKEND,
+        'model_variant': MODEL_VARIANT,
+        'preset': DETECTION_PRESET
+    }
+
+    results = {}
+    if 'stages' in suites:
+        results['stages'] = run_stages(images, args.repeat)
+    if 'load' in suites:
+        results['load'] = run_load(images, args.workflows, args.concurrency, args.images_per_phase, args.rounds)
+    report = {'config': config, 'results': results}
+    print_report(report)
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+
+    if args.baseline is None:
+        return 0
+    baseline_path = Path(args.baseline)
+    if args.save_baseline:
+        baseline_path.write_text(json.dumps(report, indent=2))
+        print(f"   Baseline saved to {baseline_path}")
+        return 0
+    if not baseline_path.exists():
+        print(f"   No baseline at {baseline_path}, record one with --save-baseline")
+        return 1
+
+    baseline = json.loads(baseline_path.read_text())
+    if baseline['config'] != config:
+        print(f"   Baseline was recorded with different settings: {json.dumps(baseline['config'])}")
+        return 1
+
+    regressions = compare(report, baseline, args.tolerance)
+    if not regressions:
+        print(f"   No regressions against {baseline_path} (tolerance {args.tolerance:.0%})")
+        return 0
+    print(f"   REGRESSIONS against {baseline_path} (tolerance {args.tolerance:.0%}):")
+    for key, base, value, change in regressions:
+        print(f"   {key:45} {base:10.2f} -> {value:10.2f} ({change:+.0f}%)")
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Model Variant Comparison - Quantized models vs FP32 on the test images
+Runs FP32 and each quantized variant through the evaluate_model.py pipeline
+and reports, per damage class, how many detections agree with FP32 (same
+class, IoU >= --iou), plus throughput and latency speedups.
+
+A variant passes when every class FP32 detects agrees at least
+--min-agreement. The exit code is non-zero if any variant fails, so this
+gate can run before switching MODEL_VARIANT in a deployment.
+
+Run with: python compare_model_variants.py [--variants int8,fp16] [--min-agreement 0.9]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from collections import defaultdict
+
+import numpy as np
+
+# evaluate_model puts my_fastapi_app on the path, so it is imported first
+from evaluate_model import run_pipeline, percentile, ROOT
+from main import Detection, DAMAGE_CLASSES, DETECTION_POSTPROCESS, INFERENCE_BACKEND, backend_options, model_variant_path
+from quantize_model import CALIBRATION_IMAGES
+
+
+def iou(box_a, box_b):
+    """IoU of two ltwh boxes"""
+    ax, ay, aw, ah = box_a
+    bx, by, bw, bh = box_b
+    inter_w = max(0, min(ax + aw, bx + bw) - max(ax, bx))
+    inter_h = max(0, min(ay + ah, by + bh) - max(ay, by))
+    inter = inter_w * inter_h
+    union = aw * ah + bw * bh - inter
+    if union <= 0:
+        # Degenerate (zero-area) boxes only agree with themselves
+        return 1.0 if list(box_a) == list(box_b) else 0.0
+    return inter / union
+
+
+def match_detections(reference, candidate, iou_threshold):
+    """Greedy one-to-one matching of same-class boxes by IoU; returns matched pairs (i, j)"""
+    pairs = []
+    for i, (box_a, class_a) in enumerate(zip(reference['boxes'], reference['classes'])):
+        for j, (box_b, class_b) in enumerate(zip(candidate['boxes'], candidate['classes'])):
+            if class_a == class_b:
+                overlap = iou(box_a, box_b)
+                if overlap >= iou_threshold:
+                    pairs.append((overlap, i, j))
+
+    matched, used_i, used_j = [], set(), set()
+    for _, i, j in sorted(pairs, reverse=True):
+        if i not in used_i and j not in used_j:
+            used_i.add(i)
+            used_j.add(j)
+            matched.append((i, j))
+    return matched
+
+
+def agreement(reference_records, candidate_records, iou_threshold):
+    """
+    Per-class agreement: 2 * matched / (reference + candidate detections), over
+    the images both runs analyzed (records are paired by image name, so an image
+    that failed in one run is left out rather than shifting the pairs)
+    """
+    counts = defaultdict(lambda: {'reference': 0, 'candidate': 0, 'matched': 0})
+    confidence_deltas = []
+
+    candidates = {record['image']: record for record in candidate_records}
+    pairs = [(reference, candidates[reference['image']]) for reference in reference_records if reference['image'] in candidates]
+    for reference, candidate in pairs:
+        for damage_type in reference['classes']:
+            counts[damage_type]['reference'] += 1
+        for damage_type in candidate['classes']:
+            counts[damage_type]['candidate'] += 1
+        for i, j in match_detections(reference, candidate, iou_threshold):
+            counts[reference['classes'][i]]['matched'] += 1
+            confidence_deltas.append(abs(reference['confidences'][i] - candidate['confidences'][j]))
+
+    per_class = {}
+    for damage_type, c in counts.items():
+        total = c['reference'] + c['candidate']
+        per_class[damage_type] = dict(c, agreement=2 * c['matched'] / total if total else 1.0)
+
+    total = sum(c['reference'] + c['candidate'] for c in counts.values())
+    overall = 2 * sum(c['matched'] for c in counts.values()) / total if total else 1.0
+    return per_class, overall, float(np.mean(confidence_deltas)) if confidence_deltas else 0.0, len(pairs)
+
+
+def ratio(numerator, denominator):
+    return numerator / denominator if denominator else 0.0
+
+
+def run_variant(variant, images, workers, batch_size, backend):
+    engine = Detection(
+        model_variant_path(variant),
+        DAMAGE_CLASSES,
+        postprocess=DETECTION_POSTPROCESS,
+        backend=backend,
+        backend_options=backend_options() if backend == INFERENCE_BACKEND else None
+    )
+    # Warm-up, so one-off graph compilation does not count against a variant
+    run_pipeline(images[:batch_size], workers, batch_size, engine=engine)
+
+    start = time.perf_counter()
+    records, stage_totals = run_pipeline(images, workers, batch_size, engine=engine)
+    wall_s = time.perf_counter() - start
+
+    records = [record for record in records if 'error' not in record]
+    records.sort(key=lambda record: record['image'])
+    return records, {
+        'images': len(records),
+        'throughput_img_per_s': ratio(len(records), wall_s),
+        'inference_ms_per_image': ratio(stage_totals['inference'], len(records)),
+        'p50_latency_ms': percentile([r['latency_ms'] for r in records], 50),
+        'p95_latency_ms': percentile([r['latency_ms'] for r in records], 95)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--variants', type=str, default='int8,fp16', help='comma-separated variants to compare with fp32')
+    parser.add_argument('--min-agreement', type=float, default=0.9, help='lowest per-class agreement a variant may have')
+    parser.add_argument('--iou', type=float, default=0.5, help='IoU for two detections of a class to agree')
+    parser.add_argument('--backend', type=str, default=INFERENCE_BACKEND, help='inference backend to time the variants on')
+    parser.add_argument('--skip', type=int, default=CALIBRATION_IMAGES, help='skip the first N test images (default: the INT8 calibration slice of quantize_model.py)')
+    parser.add_argument('--limit', type=int, default=None, help='only compare on N images')
+    parser.add_argument('--workers', type=int, default=4, help='parallel image decode workers')
+    parser.add_argument('--batch-size', type=int, default=8, help='images per batched forward pass')
+    parser.add_argument('--report', type=str, default=str(ROOT / 'model_variants_report.json'), help='report path')
+    args = parser.parse_args()
+
+    test_images = sorted((ROOT / "test_images" / "test").glob("*.jpg"))[args.skip:]
+    if args.limit:
+        test_images = test_images[:args.limit]
+
+    print(f"🧪 Comparing model variants on {len(test_images)} test images ({args.backend} backend)...\n")
+
+    reference_records, reference_perf = run_variant('fp32', test_images, args.workers, args.batch_size, args.backend)
+    report = {'backend': args.backend, 'images': len(test_images), 'min_agreement': args.min_agreement, 'fp32': reference_perf, 'variants': {}}
+    all_passed = True
+
+    for variant in args.variants.split(','):
+        if not os.path.exists(model_variant_path(variant)):
+            print(f"❌ {variant}: {model_variant_path(variant)} not found, run quantize_model.py first")
+            all_passed = False
+            continue
+
+        records, perf = run_variant(variant, test_images, args.workers, args.batch_size, args.backend)
+        per_class, overall, confidence_delta, compared = agreement(reference_records, records, args.iou)
+        # Only classes FP32 actually detects can gate a variant, and only on images both analyzed
+        gated = {damage_type: c for damage_type, c in per_class.items() if c['reference'] > 0}
+        worst = min((c['agreement'] for c in gated.values()), default=1.0)
+        passed = compared > 0 and worst >= args.min_agreement
+        all_passed = all_passed and passed
+
+        report['variants'][variant] = dict(
+            perf,
+            compared_images=compared,
+            speedup=ratio(perf['throughput_img_per_s'], reference_perf['throughput_img_per_s']),
+            inference_speedup=ratio(reference_perf['inference_ms_per_image'], perf['inference_ms_per_image']),
+            agreement=overall,
+            worst_class_agreement=worst,
+            mean_confidence_delta=confidence_delta,
+            per_class=per_class,
+            passed=passed
+        )
+
+        r = report['variants'][variant]
+        print(f"\n📊 {variant} vs fp32: {'✅ PASS' if passed else '❌ FAIL'} (worst class {worst:.1%}, required {args.min_agreement:.0%})")
+        print(f"   Throughput: {r['throughput_img_per_s']:.1f} img/s ({r['speedup']:.2f}x), inference {r['inference_speedup']:.2f}x")
+        print(f"   Agreement: {overall:.1%} overall on {compared} images both analyzed, mean confidence delta {confidence_delta:.2f} points")
+        for damage_type, c in sorted(per_class.items(), key=lambda x: x[1]['agreement']):
+            print(f"   {damage_type}: {c['agreement']:.1%} ({c['matched']} matched, fp32 {c['reference']}, {variant} {c['candidate']})")
+
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\n✅ Report saved to: {args.report}")
+
+    return all_passed
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -2,39 +2,174 @@
 """
 Model Evaluation Script - Tests accuracy on all test images
 Runs detection on all test images and generates a report with statistics
+
+Images are read and decoded by a pool of prefetching workers while the main
+thread runs batched inference, so decoding overlaps with the forward passes.
+Per-image results are checkpointed as they complete; an interrupted run
+resumes where it stopped. Throughput, latency percentiles and a per-stage
+time breakdown are written into the report alongside the detection stats.
+
+Run with: python evaluate_model.py [--workers 4] [--batch-size 8]
 """
 
 import os
 import sys
-import cv2
 import json
+import time
+import argparse
+import statistics
 from pathlib import Path
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
-# Add my_fastapi_app to path so we can import Detection class
+# Add my_fastapi_app to path so we can import the Detection engine
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'my_fastapi_app'))
 
-from train import detection, REPAIR_COSTS
+from main import detection, REPAIR_COSTS, DECODE_MIN_SIZE, decode_image, rescale_boxes
+
+ROOT = Path(__file__).parent
+
+
+def load_image(img_path):
+    """Decode stage (runs on the prefetch workers): read + decode one image, timed"""
+    start = time.perf_counter()
+    data = img_path.read_bytes()
+    read_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    try:
+        image, scale = decode_image(data, min_size=DECODE_MIN_SIZE)
+    except Exception as e:
+        return img_path, None, None, read_ms, 0.0, str(e)[:30]
+    decode_ms = (time.perf_counter() - start) * 1000
+
+    return img_path, image, scale, read_ms, decode_ms, None
+
+
+def load_checkpoint(checkpoint_path):
+    """Per-image records from a previous, interrupted run; images that failed are run again"""
+    records = {}
+    if checkpoint_path.exists():
+        with open(checkpoint_path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    record = json.loads(line)
+                    if 'error' not in record:
+                        records[record['image']] = record
+    return records
+
+
+def run_pipeline(pending, workers, batch_size, checkpoint_file=None, engine=detection):
+    """Prefetching decode on `workers` threads, batched inference with `engine` on this thread"""
+    stage_totals = defaultdict(float)
+    records = []
+    prefetch_depth = max(workers, 1) * batch_size * 2
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='decode') as pool:
+        queued = deque()
+        paths = iter(pending)
 
-def evaluate_model():
+        def fill():
+            while len(queued) < prefetch_depth:
+                img_path = next(paths, None)
+                if img_path is None:
+                    return
+                queued.append(pool.submit(load_image, img_path))
+
+        fill()
+        with tqdm(total=len(pending), desc="Processing") as progress:
+            while queued:
+                batch = []
+                batch_records = []
+                start = time.perf_counter()
+                while queued and len(batch) < batch_size:
+                    img_path, image, scale, read_ms, decode_ms, error = queued.popleft().result()
+                    fill()
+                    stage_totals['read'] += read_ms
+                    stage_totals['decode'] += decode_ms
+                    if error is not None:
+                        batch_records.append({'image': img_path.name, 'error': error})
+                        continue
+                    batch.append((img_path, image, scale, read_ms, decode_ms))
+                # Time the inference thread spent waiting for decoded images
+                stage_totals['decode_wait'] += (time.perf_counter() - start) * 1000
+
+                if batch:
+                    start = time.perf_counter()
+                    batch_results = engine.detect_batch([image for _, image, _, _, _ in batch])
+                    inference_ms = (time.perf_counter() - start) * 1000
+                    stage_totals['inference'] += inference_ms
+
+                    for (img_path, _, scale, read_ms, decode_ms), results in zip(batch, batch_results):
+                        results = rescale_boxes(results, scale)
+                        batch_records.append({
+                            'image': img_path.name,
+                            'boxes': results['boxes'],
+                            'classes': results['classes'],
+                            'confidences': results['confidences'],
+                            # Per-image latency: its own read + decode plus its share of the batch
+                            'latency_ms': read_ms + decode_ms + inference_ms / len(batch)
+                        })
+
+                if checkpoint_file is not None:
+                    # Failed images are left out, so a resumed run retries them
+                    for record in batch_records:
+                        if 'error' not in record:
+                            checkpoint_file.write(json.dumps(record) + '\n')
+                    checkpoint_file.flush()
+                records.extend(batch_records)
+                progress.update(len(batch_records))
+
+    return records, stage_totals
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def evaluate_model(workers=4, batch_size=8, report_path=None, checkpoint_path=None, fresh=False, limit=None):
     """Evaluate model on all test images"""
-    
-    test_images_dir = Path(__file__).parent / "test_images" / "test"
-    
+
+    test_images_dir = ROOT / "test_images" / "test"
+    report_path = Path(report_path) if report_path else ROOT / "model_evaluation_report.json"
+    checkpoint_path = Path(checkpoint_path) if checkpoint_path else report_path.with_suffix('.checkpoint.jsonl')
+
     if not test_images_dir.exists():
         print("❌ test_images/test folder not found!")
         return False
-    
+
     # Get all test images
     test_images = sorted(list(test_images_dir.glob("*.jpg")) + list(test_images_dir.glob("*.jpeg")))
-    
+    if limit:
+        test_images = test_images[:limit]
+
     if not test_images:
         print("❌ No test images found!")
         return False
-    
-    print(f"🧪 Evaluating model on {len(test_images)} test images...\n")
-    
+
+    if fresh and checkpoint_path.exists():
+        checkpoint_path.unlink()
+    done = load_checkpoint(checkpoint_path)
+    pending = [img_path for img_path in test_images if img_path.name not in done]
+
+    print(f"🧪 Evaluating model on {len(test_images)} test images...")
+    if done:
+        print(f"   Resuming: {len(test_images) - len(pending)} already done, {len(pending)} remaining")
+    print(f"   Decode workers: {workers}, batch size: {batch_size}\n")
+
+    wall_start = time.perf_counter()
+    with open(checkpoint_path, 'a') as checkpoint_file:
+        new_records, stage_totals = run_pipeline(pending, workers, batch_size, checkpoint_file)
+    wall_s = time.perf_counter() - wall_start
+
+    for record in new_records:
+        done[record['image']] = record
+
     # Statistics
     stats = {
         'total_images': len(test_images),
@@ -45,72 +180,93 @@ def evaluate_model():
         'total_repair_cost_estimated': 0,
         'detections_per_image': []
     }
-    
+
     failed_images = []
-    
-    # Process each image
-    for img_path in tqdm(test_images, desc="Processing"):
-        try:
-            # Read image
-            image = cv2.imread(str(img_path))
-            if image is None:
-                failed_images.append(img_path.name)
-                continue
-            
-            # Run detection
-            results = detection(image, return_annotated=False)  # Don't encode image, just get data
-            
-            num_detections = len(results.get('classes', []))
-            
-            if num_detections > 0:
-                stats['images_with_detections'] += 1
-                stats['total_detections'] += num_detections
-                
-                # Track damages
-                for damage_type in results.get('classes', []):
-                    stats['damages_by_type'][damage_type] += 1
-                
-                # Track repair costs
-                for repair_cost in results.get('repair_costs', []):
-                    stats['total_repair_cost_estimated'] += (repair_cost['min'] + repair_cost['max']) / 2
-                
-                stats['detections_per_image'].append({
-                    'image': img_path.name,
-                    'detections': num_detections,
-                    'classes': results.get('classes', []),
-                    'confidences': [f"{c:.1f}%" for c in results.get('confidences', [])]
-                })
-            else:
-                stats['images_without_detections'] += 1
-        
-        except Exception as e:
-            failed_images.append(f"{img_path.name} (error: {str(e)[:30]})")
-    
+    latencies = []
+
+    for img_path in test_images:
+        record = done.get(img_path.name)
+        if record is None:
+            continue
+        if 'error' in record:
+            failed_images.append(f"{img_path.name} (error: {record['error']})")
+            continue
+
+        latencies.append(record['latency_ms'])
+        num_detections = len(record['classes'])
+
+        if num_detections > 0:
+            stats['images_with_detections'] += 1
+            stats['total_detections'] += num_detections
+
+            # Track damages and repair costs
+            for damage_type in record['classes']:
+                stats['damages_by_type'][damage_type] += 1
+                repair_cost = REPAIR_COSTS.get(damage_type.lower(), {'min': 100, 'max': 500})
+                stats['total_repair_cost_estimated'] += (repair_cost['min'] + repair_cost['max']) / 2
+
+            stats['detections_per_image'].append({
+                'image': img_path.name,
+                'detections': num_detections,
+                'classes': record['classes'],
+                'confidences': [f"{c:.1f}%" for c in record['confidences']]
+            })
+        else:
+            stats['images_without_detections'] += 1
+
+    processed = len(new_records)
+    stats['performance'] = {
+        'workers': workers,
+        'batch_size': batch_size,
+        'images_processed_this_run': processed,
+        'wall_time_s': round(wall_s, 3),
+        'throughput_img_per_s': round(processed / wall_s, 2) if wall_s > 0 and processed else 0.0,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50), 2),
+            'p95': round(percentile(latencies, 95), 2),
+            'mean': round(statistics.mean(latencies), 2) if latencies else 0.0
+        },
+        'stage_breakdown_ms': {
+            stage: {
+                'total': round(total, 1),
+                'per_image': round(total / processed, 2) if processed else 0.0
+            }
+            for stage, total in stage_totals.items()
+        }
+    }
+
     # Print results
     print("\n" + "="*60)
     print("🎯 MODEL EVALUATION RESULTS")
     print("="*60)
-    
+
     print(f"\n📊 Overall Statistics:")
     print(f"   Total images tested: {stats['total_images']}")
     print(f"   Images with detections: {stats['images_with_detections']} ({stats['images_with_detections']*100//stats['total_images']}%)")
     print(f"   Images without detections: {stats['images_without_detections']} ({stats['images_without_detections']*100//stats['total_images']}%)")
     print(f"   Failed to process: {len(failed_images)}")
-    
+
     print(f"\n🔍 Detection Statistics:")
     print(f"   Total detections: {stats['total_detections']}")
     avg_per_image = stats['total_detections'] / stats['total_images'] if stats['total_images'] > 0 else 0
     print(f"   Average detections per image: {avg_per_image:.2f}")
-    
+
     print(f"\n💰 Damage Breakdown:")
     for damage_type, count in sorted(stats['damages_by_type'].items(), key=lambda x: x[1], reverse=True):
         percentage = count * 100 // stats['total_detections'] if stats['total_detections'] > 0 else 0
         print(f"   {damage_type}: {count} ({percentage}%)")
-    
+
     print(f"\n💵 Cost Estimation:")
     print(f"   Average repair cost per detection: ${stats['total_repair_cost_estimated']/stats['total_detections']:.2f}" if stats['total_detections'] > 0 else "   No detections")
     print(f"   Total estimated cost (all detections): ${stats['total_repair_cost_estimated']:.2f}")
-    
+
+    performance = stats['performance']
+    print(f"\n⚡ Performance (this run):")
+    print(f"   Throughput: {performance['throughput_img_per_s']} img/s ({processed} images in {performance['wall_time_s']}s)")
+    print(f"   Latency per image: p50 {performance['latency_ms']['p50']} ms, p95 {performance['latency_ms']['p95']} ms")
+    for stage, breakdown in performance['stage_breakdown_ms'].items():
+        print(f"   {stage}: {breakdown['per_image']} ms/image")
+
     # Show sample detections
     if stats['detections_per_image']:
         print(f"\n📸 Sample Detections (first 10):")
@@ -118,37 +274,55 @@ def evaluate_model():
             print(f"   {det['image']}: {det['detections']} damages")
             for cls, conf in zip(det['classes'], det['confidences']):
                 print(f"      - {cls} ({conf})")
-    
+
     # Warnings
     if stats['images_without_detections'] > stats['total_images'] * 0.5:
         print(f"\n⚠️  WARNING: More than 50% of images have no detections!")
         print(f"   Consider lowering the detection threshold or retraining the model.")
-    
+
     if failed_images:
         print(f"\n❌ Failed images ({len(failed_images)}):")
         for img in failed_images[:5]:
             print(f"   - {img}")
         if len(failed_images) > 5:
             print(f"   ... and {len(failed_images) - 5} more")
-    
+
     # Save detailed report
-    report_path = Path(__file__).parent / "model_evaluation_report.json"
     with open(report_path, 'w') as f:
         # Convert defaultdict to dict for JSON serialization
         stats['damages_by_type'] = dict(stats['damages_by_type'])
         json.dump(stats, f, indent=2)
-    
+
+    # The run is complete, so the next one starts from scratch
+    checkpoint_path.unlink()
+
     print(f"\n✅ Detailed report saved to: {report_path}")
     print("="*60 + "\n")
-    
+
     return True
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate the damage detection model on test_images/test")
+    parser.add_argument('--workers', type=int, default=4, help='parallel image decode workers')
+    parser.add_argument('--batch-size', type=int, default=8, help='images per batched forward pass')
+    parser.add_argument('--report', type=str, default=None, help='report path (default: model_evaluation_report.json)')
+    parser.add_argument('--checkpoint', type=str, default=None, help='checkpoint path (default: next to the report)')
+    parser.add_argument('--fresh', action='store_true', help='ignore any checkpoint from an interrupted run')
+    parser.add_argument('--limit', type=int, default=None, help='only evaluate the first N images')
+    args = parser.parse_args()
+
     try:
-        success = evaluate_model()
+        success = evaluate_model(
+            workers=args.workers,
+            batch_size=args.batch_size,
+            report_path=args.report,
+            checkpoint_path=args.checkpoint,
+            fresh=args.fresh,
+            limit=args.limit
+        )
         sys.exit(0 if success else 1)
     except KeyboardInterrupt:
-        print("\n\n❌ Evaluation interrupted")
+        print("\n\n❌ Evaluation interrupted (progress saved, run again to resume)")
         sys.exit(1)
     except Exception as e:
         print(f"\n❌ Error: {e}")
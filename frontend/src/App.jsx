@@ -1,8 +1,12 @@
-import React, { useState } from "react";
+import React, { useEffect, useRef, useState } from "react";
 import axios from "axios";
 
 const API_BASE = "https://hiring-sprint-2025.onrender.com";
 
+// Annotated images are served by the API as relative URLs, rendered on demand
+const imageUrl = (path, size = "full") =>
+  path.startsWith("/") ? `${API_BASE}${path}?size=${size}` : path;
+
 export default function App() {
   const [sessionId, setSessionId] = useState(null);
   const [phase, setPhase] = useState(null);
@@ -11,6 +15,16 @@ export default function App() {
   const [loading, setLoading] = useState(false);
   const [inspectionReport, setInspectionReport] = useState(null);
   const [currentDetection, setCurrentDetection] = useState(null);
+  // Object URLs of streamed thumbnails by image index, revoked once replaced,
+  // when a new inspection starts and on unmount so their blobs are freed
+  const thumbnailUrls = useRef(new Map());
+
+  const revokeThumbnails = () => {
+    thumbnailUrls.current.forEach((url) => URL.revokeObjectURL(url));
+    thumbnailUrls.current.clear();
+  };
+
+  useEffect(() => revokeThumbnails, []);
 
   const startInspection = async () => {
     setLoading(true);
@@ -18,6 +32,7 @@ export default function App() {
       const res = await axios.post(`${API_BASE}/api/inspection/start`);
       setSessionId(res.data.session_id);
       setPhase("pickup");
+      revokeThumbnails();
       setPickupImages([]);
       setReturnImages([]);
       setInspectionReport(null);
@@ -27,39 +42,62 @@ export default function App() {
     setLoading(false);
   };
 
-  const handleImageUpload = async (e, isReturn) => {
-    const files = e.target.files;
-    if (!files || !sessionId) return;
+  // Photos are streamed over one WebSocket: all are sent at once, and each
+  // result is shown as soon as the server finishes it (annotated thumbnails follow)
+  const handleImageUpload = (e, isReturn) => {
+    const files = Array.from(e.target.files || []);
+    if (!files.length || !sessionId) return;
 
-    setLoading(true);
-    try {
-      for (let file of files) {
-        const formData = new FormData();
-        formData.append("file", file);
+    const setImages = isReturn ? setReturnImages : setPickupImages;
+    const ws = new WebSocket(
+      `${API_BASE.replace(/^http/, "ws")}/api/inspection/${sessionId}/stream?images=thumb`
+    );
+    ws.binaryType = "blob";
+    let pendingImage = null;
 
-        const res = await axios.post(
-          `${API_BASE}/api/inspection/${sessionId}/detect`,
-          formData,
-          { headers: { "Content-Type": "multipart/form-data" } }
+    setLoading(true);
+    ws.onopen = () => {
+      files.forEach((file) => ws.send(file));
+      ws.send(JSON.stringify({ type: "end" }));
+    };
+    ws.onmessage = (event) => {
+      if (typeof event.data !== "string") {
+        // JPEG for the preceding "image" message
+        const thumbnail = URL.createObjectURL(event.data);
+        const { image_index } = pendingImage;
+        const previous = thumbnailUrls.current.get(image_index);
+        if (previous) URL.revokeObjectURL(previous);
+        thumbnailUrls.current.set(image_index, thumbnail);
+        setImages((images) =>
+          images.map((img) =>
+            img.detection.image_index === image_index ? { ...img, thumbnail } : img
+          )
         );
+        pendingImage = null;
+        return;
+      }
 
-        const imageData = {
-          file_name: file.name,
-          detection: res.data.current_detection,
-        };
-
-        if (isReturn) {
-          setReturnImages([...returnImages, imageData]);
-        } else {
-          setPickupImages([...pickupImages, imageData]);
-        }
-
-        setCurrentDetection(res.data.current_detection);
+      const message = JSON.parse(event.data);
+      if (message.type === "detection") {
+        setImages((images) => [
+          ...images,
+          {
+            file_name: files[message.seq].name,
+            detection: message.current_detection,
+          },
+        ]);
+        setCurrentDetection(message.current_detection);
+      } else if (message.type === "image") {
+        pendingImage = message;
+      } else if (message.type === "error") {
+        alert(`Error uploading ${files[message.seq].name}: ${message.detail}`);
+      } else if (message.type === "end") {
+        ws.close();
       }
-    } catch (error) {
-      alert("Error uploading image: " + error.message);
-    }
-    setLoading(false);
+    };
+    ws.onerror = () => alert("Error uploading images: connection failed");
+    ws.onclose = () => setLoading(false);
+    e.target.value = "";
   };
 
   const switchToReturn = async () => {
@@ -191,9 +229,9 @@ export default function App() {
                     className="border rounded-lg overflow-hidden bg-gray-100"
                   >
                     <div className="aspect-video bg-gray-200 flex items-center justify-center overflow-hidden">
-                      {img.detection.annotated_image && (
+                      {img.thumbnail && (
                         <img
-                          src={img.detection.annotated_image}
+                          src={img.thumbnail}
                           alt={`Upload ${idx}`}
                           className="w-full h-full object-contain"
                         />
@@ -407,7 +445,7 @@ export default function App() {
                       <div className="aspect-video bg-gray-200 flex items-center justify-center">
                         {det.annotated_image && (
                           <img
-                            src={det.annotated_image}
+                            src={imageUrl(det.annotated_image)}
                             alt={`Return ${idx}`}
                             className="w-full h-full object-contain"
                           />
@@ -0,0 +1,143 @@
+"""
+Content-addressed artifact store and render cache for inspection images.
+
+Sessions only keep compact detection records. The uploaded photos live in
+ArtifactStore, keyed by their SHA-256 digest and bounded by a byte budget
+(least recently used blobs are evicted first). Each session record keeps the
+digest of its photo next to the detections, so the annotated image can be
+rendered on demand as /api/inspection/{session_id}/images/{n}.jpg, even after
+/complete. ArtifactStore lives in one process; with sessions in Redis the
+photos go to RedisArtifactStore next to them, so any API worker can render
+them and match their features, whichever worker took the upload.
+
+Rendered JPEGs are kept in RenderCache, keyed by everything that affects the
+output pixels (image digest, detections, style, size and quality), so an
+image is only drawn and encoded once per variant, and only if it is viewed.
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+
+class ByteLRU:
+    """Thread-safe LRU mapping of keys to bytes, bounded by total size"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._items.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._items.move_to_end(key)
+            return data
+
+    def put(self, key: str, data: bytes):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return
+            self._items[key] = data
+            self.bytes_used += len(data)
+            while self.bytes_used > self.max_bytes and len(self._items) > 1:
+                _, evicted = self._items.popitem(last=False)
+                self.bytes_used -= len(evicted)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'items': len(self._items),
+                'bytes_used': self.bytes_used,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+
+class ArtifactStore:
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self._blobs = ByteLRU(max_bytes)
+
+    def put(self, data: bytes, digest: Optional[str] = None) -> str:
+        digest = digest or hashlib.sha256(data).hexdigest()
+        self._blobs.put(digest, data)
+        return digest
+
+    def get(self, digest: str) -> Optional[bytes]:
+        return self._blobs.get(digest)
+
+    def stats(self) -> Dict:
+        return self._blobs.stats()
+
+
+class RedisArtifactStore:
+    """
+    Photos in a Redis-protocol store, shared by every API worker. Each blob
+    lives as long as the sessions that point to it (the session TTL, refreshed
+    whenever it is stored or read again); Redis' maxmemory policy bounds the
+    total size.
+    """
+
+    def __init__(self, client, ttl_seconds: float = 6 * 3600, prefix: str = 'artifact:'):
+        self.client = client
+        self.ttl_seconds = int(ttl_seconds)
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, data: bytes, digest: Optional[str] = None) -> str:
+        digest = digest or hashlib.sha256(data).hexdigest()
+        key = f"{self.prefix}{digest}"
+        # Identical content is stored once, a repeated upload only keeps it longer
+        if not self.client.set(key, data, ex=self.ttl_seconds, nx=True):
+            self.client.expire(key, self.ttl_seconds)
+        return digest
+
+    def get(self, digest: str) -> Optional[bytes]:
+        data = self.client.getex(f"{self.prefix}{digest}", ex=self.ttl_seconds)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            'backend': 'redis',
+            'ttl_seconds': self.ttl_seconds,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+
+def render_key(image_digest: str, detections: dict, style: str, size: str, quality: int) -> str:
+    """Stable key (also used as ETag) for one rendered variant of an image"""
+    drawn = json.dumps({'boxes': detections.get('boxes', []), 'classes': detections.get('classes', [])}, sort_keys=True)
+    material = f"{image_digest}:{hashlib.sha256(drawn.encode()).hexdigest()}:{style}:{size}:{quality}"
+    return hashlib.sha256(material.encode()).hexdigest()
+
+
+class RenderCache(ByteLRU):
+    """Bounded LRU of rendered annotated JPEGs, keyed by render_key()"""
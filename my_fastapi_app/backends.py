@@ -0,0 +1,148 @@
+"""
+Inference backends for the Detection engine.
+
+Every backend loads the same ONNX model and exposes `forward(blob)`, taking an
+NCHW float32 blob and returning the raw model output, so Detection does not
+care which engine runs the network:
+
+- `opencv`: cv2.dnn (always available)
+- `onnxruntime`: ONNX Runtime CPU with full graph optimizations, configurable
+  intra/inter-op threads and IO binding
+- `openvino`: OpenVINO CPU plugin
+
+ONNX Runtime and OpenVINO are optional dependencies, only imported when their
+backend is selected.
+"""
+
+import threading
+from typing import Dict, Optional
+
+import cv2
+import numpy as np
+from numpy import ndarray
+
+
+class InferenceBackend:
+    """Interface shared by all inference backends"""
+
+    name = ''
+
+    def forward(self, blob: ndarray) -> ndarray:
+        raise NotImplementedError
+
+    def describe(self) -> Dict:
+        return {'backend': self.name}
+
+
+class OpenCVBackend(InferenceBackend):
+    name = 'opencv'
+
+    def __init__(self, model_path: str, num_threads: int = 0):
+        self.net = cv2.dnn.readNet(model_path)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        # cv2's thread pool is process-wide, only touch it when asked to
+        if num_threads:
+            cv2.setNumThreads(num_threads)
+        self.num_threads = num_threads
+
+    def forward(self, blob: ndarray) -> ndarray:
+        self.net.setInput(blob)
+        return self.net.forward()
+
+    def describe(self) -> Dict:
+        return {'backend': self.name, 'num_threads': self.num_threads}
+
+
+class OnnxRuntimeBackend(InferenceBackend):
+    name = 'onnxruntime'
+
+    def __init__(self, model_path: str, intra_op_threads: int = 0, inter_op_threads: int = 0, io_binding: bool = True):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # 0 lets ONNX Runtime pick (one thread per physical core)
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL if inter_op_threads <= 1 else ort.ExecutionMode.ORT_PARALLEL
+
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_name = self.session.get_outputs()[0].name
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.io_binding = io_binding
+
+    def forward(self, blob: ndarray) -> ndarray:
+        blob = np.ascontiguousarray(blob, dtype=np.float32)
+        if not self.io_binding:
+            return self.session.run([self.output_name], {self.input_name: blob})[0]
+
+        # Bind the blob in place instead of copying it into a feed dict
+        binding = self.session.io_binding()
+        binding.bind_cpu_input(self.input_name, blob)
+        binding.bind_output(self.output_name)
+        self.session.run_with_iobinding(binding)
+        return binding.copy_outputs_to_cpu()[0]
+
+    def describe(self) -> Dict:
+        return {
+            'backend': self.name,
+            'intra_op_threads': self.intra_op_threads,
+            'inter_op_threads': self.inter_op_threads,
+            'io_binding': self.io_binding
+        }
+
+
+class OpenVINOBackend(InferenceBackend):
+    name = 'openvino'
+
+    def __init__(self, model_path: str, num_threads: int = 0, performance_hint: str = 'LATENCY', precision: str = 'f32'):
+        import openvino as ov
+
+        # The CPU plugin silently drops to bf16 on CPUs that support it, which
+        # shifts scores enough to change detections; keep FP32 unless asked
+        config = {'PERFORMANCE_HINT': performance_hint, 'INFERENCE_PRECISION_HINT': precision}
+        if num_threads:
+            config['INFERENCE_NUM_THREADS'] = num_threads
+
+        core = ov.Core()
+        self.compiled_model = core.compile_model(core.read_model(model_path), 'CPU', config)
+        self.num_threads = num_threads
+        self.performance_hint = performance_hint
+        self.precision = precision
+        # Infer requests are not thread-safe, each calling thread gets its own
+        self._local = threading.local()
+
+    def forward(self, blob: ndarray) -> ndarray:
+        request = getattr(self._local, 'request', None)
+        if request is None:
+            request = self._local.request = self.compiled_model.create_infer_request()
+        request.infer({0: np.ascontiguousarray(blob, dtype=np.float32)})
+        return request.get_output_tensor(0).data.copy()
+
+    def describe(self) -> Dict:
+        return {
+            'backend': self.name,
+            'num_threads': self.num_threads,
+            'performance_hint': self.performance_hint,
+            'precision': self.precision
+        }
+
+
+BACKENDS = {
+    'opencv': OpenCVBackend,
+    'onnxruntime': OnnxRuntimeBackend,
+    'openvino': OpenVINOBackend
+}
+
+
+def check_backend(name: str):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{name}', expected one of {', '.join(BACKENDS)}")
+
+
+def create_backend(name: str, model_path: str, options: Optional[Dict] = None) -> InferenceBackend:
+    """Instantiate the backend registered as `name` for the model at `model_path`"""
+    check_backend(name)
+    return BACKENDS[name](model_path, **(options or {}))
@@ -0,0 +1,77 @@
+"""
+Perceptual hashes for spotting near-duplicate photos within an inspection phase.
+
+Bursts of almost identical shots of the same panel hash to 64-bit values a few
+bits apart, while different views differ in many bits. A photo whose hash is
+within the configured Hamming distance of an earlier photo in the same phase is
+treated as a duplicate of it: its detections are reused instead of running the
+model, and it is left out of the damage counts.
+
+- `phash`: DCT of a 32x32 grayscale thumbnail, low frequencies against their
+  median. Robust to rescaling, recompression and small exposure changes.
+- `dhash`: sign of horizontal gradients on a 9x8 thumbnail. Cheaper, a little
+  less tolerant of lighting changes.
+
+Hashes are stored as 16-digit hex strings so they survive JSON round trips
+(Redis session store, JavaScript clients) without losing precision. Nearly
+flat images (lens cap, black frame) have no structure to hash and get None,
+so they are never taken for duplicates of each other.
+"""
+
+from typing import Iterable, Optional, Tuple
+
+import cv2
+import numpy as np
+from numpy import ndarray
+
+
+def _to_hex(bits: ndarray) -> str:
+    return f"{int(''.join('1' if bit else '0' for bit in bits.flatten()), 2):016x}"
+
+
+# Thumbnails with less contrast than this (std of gray levels) count as flat
+FLAT_STD = 2.0
+
+
+def _thumbnail(image: ndarray, size: Tuple[int, int]) -> Optional[ndarray]:
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    small = cv2.resize(gray, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+    return small if small.std() >= FLAT_STD else None
+
+
+def dhash(image: ndarray) -> Optional[str]:
+    small = _thumbnail(image, (9, 8))
+    if small is None:
+        return None
+    return _to_hex(small[:, 1:] > small[:, :-1])
+
+
+def phash(image: ndarray) -> Optional[str]:
+    small = _thumbnail(image, (32, 32))
+    if small is None:
+        return None
+    low = cv2.dct(small)[:8, :8]
+    # The DC term only encodes overall brightness
+    return _to_hex(low > np.median(low.flatten()[1:]))
+
+
+HASHES = {
+    'phash': phash,
+    'dhash': dhash
+}
+
+
+def hamming(hash_a: str, hash_b: str) -> int:
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count('1')
+
+
+def find_duplicate(image_hash: Optional[str], known: Iterable[Tuple[int, str]], max_distance: int) -> Optional[int]:
+    """Key of the closest known hash within max_distance bits, if any (negative distance disables)"""
+    if max_distance < 0 or image_hash is None:
+        return None
+    best_key, best_distance = None, max_distance + 1
+    for key, known_hash in known:
+        distance = hamming(image_hash, known_hash)
+        if distance < best_distance:
+            best_key, best_distance = key, distance
+    return best_key
@@ -0,0 +1,117 @@
+"""
+Response formats for detection results, negotiated from the Accept header.
+
+- application/json (default): the documented response, unchanged.
+- application/vnd.car-damage.compact+json: detections packed like the Redis
+  session store does (`i` image index, `c` class indices, `b` flat boxes, `p`
+  confidences rounded to 2 decimals). Class names and repair costs are sent once,
+  in `classes` and `repair_costs` (indexed like `c`), instead of per detection,
+  and `annotated_image` URLs are left out (`image_url` is their template).
+- application/msgpack: the compact form as MessagePack (needs the optional
+  msgpack package; not offered without it).
+- multipart/mixed: the compact form as the first part, followed by each annotated
+  image as a raw JPEG part instead of a URL to fetch. Each image part carries a
+  `Content-ID` of `<image-{i}>` and its URL in `Content-Location`.
+"""
+
+import json
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from sessions import pack_record
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'application/json'
+COMPACT_JSON = 'application/vnd.car-damage.compact+json'
+MSGPACK = 'application/msgpack'
+MULTIPART = 'multipart/mixed'
+
+MEDIA_TYPE_ALIASES = {
+    'application/x-msgpack': MSGPACK,
+    '*/*': JSON,
+    'application/*': JSON
+}
+
+# Keys holding one detection, or a list of them (directly or under 'detection')
+DETECTION_KEYS = ('current_detection',)
+DETECTION_LIST_KEYS = ('results', 'return_detections_with_boxes')
+
+
+def available_media_types() -> List[str]:
+    return [JSON, COMPACT_JSON, MULTIPART] + ([MSGPACK] if msgpack is not None else [])
+
+
+def negotiate(accept: Optional[str]) -> str:
+    """Best supported media type for an Accept header (highest q, then first listed); JSON if none"""
+    available = available_media_types()
+    best, best_q = JSON, 0.0
+    for entry in (accept or '').split(','):
+        media_type, *params = [part.strip() for part in entry.split(';')]
+        media_type = MEDIA_TYPE_ALIASES.get(media_type.lower(), media_type.lower())
+        q = 1.0
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if media_type in available and q > best_q:
+            best, best_q = media_type, q
+    return best
+
+
+def compact_detection(detection: Dict, class_ids: Dict[str, int]) -> Dict:
+    packed = pack_record(detection, class_ids)
+    packed.pop('repair_costs', None)
+    packed.pop('annotated_image', None)
+    return packed
+
+
+def compact_payload(payload: Dict, classes: List[str], repair_costs: List[Dict]) -> Dict:
+    """A detect/complete response with its detections in compact form"""
+    class_ids = {name: i for i, name in enumerate(classes)}
+    compact = dict(payload)
+    for key in DETECTION_KEYS:
+        if key in payload:
+            compact[key] = compact_detection(payload[key], class_ids)
+    for key in DETECTION_LIST_KEYS:
+        if key in payload:
+            compact[key] = [
+                dict(item, detection=compact_detection(item['detection'], class_ids)) if 'detection' in item
+                else compact_detection(item, class_ids)
+                for item in payload[key]
+            ]
+    compact['classes'] = classes
+    compact['repair_costs'] = repair_costs
+    if 'session_id' in payload:
+        compact['image_url'] = f"/api/inspection/{payload['session_id']}/images/{{i}}.jpg"
+    return compact
+
+
+def encode_json(compact: Dict) -> bytes:
+    return json.dumps(compact, separators=(',', ':')).encode()
+
+
+def encode_msgpack(compact: Dict) -> bytes:
+    return msgpack.packb(compact, use_bin_type=True)
+
+
+def encode_multipart(compact: Dict, images: List[Tuple[int, str, bytes]]) -> Tuple[bytes, str]:
+    """Multipart body and content type: compact JSON, then (image_index, url, jpeg) images as raw parts"""
+    boundary = uuid.uuid4().hex
+    parts = [
+        f"--{boundary}\r\nContent-Type: {COMPACT_JSON}\r\n\r\n".encode(),
+        encode_json(compact)
+    ]
+    for image_index, url, data in images:
+        parts.append(
+            f"\r\n--{boundary}\r\nContent-Type: image/jpeg\r\nContent-ID: <image-{image_index}>\r\n"
+            f"Content-Location: {url}\r\nContent-Length: {len(data)}\r\n\r\n".encode()
+        )
+        parts.append(data)
+    parts.append(f"\r\n--{boundary}--\r\n".encode())
+    return b''.join(parts), f'{MULTIPART}; boundary={boundary}'
@@ -1,15 +1,18 @@
+import asyncio
 import io
 import os
-import uvicorn
+import threading
+from contextlib import asynccontextmanager
 import numpy as np
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import StreamingResponse, HTMLResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException, Header, Query, WebSocket
+from fastapi.responses import StreamingResponse, HTMLResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.openapi.utils import get_openapi
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field
 from typing import List as ListType
 import cv2
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Literal
 from numpy import ndarray
 from typing import Tuple
 from PIL import Image
@@ -18,77 +21,154 @@ from fastapi import Response
 import json
 from datetime import datetime
 import uuid
+import hashlib
+import tempfile
+from functools import partial
+from scheduler import BatchScheduler
+from workers import InferencePool, ModelProcessPool, PoolSaturated
+from artifacts import ArtifactStore, RedisArtifactStore, RenderCache, render_key
+from sessions import MemorySessionStore, RedisSessionStore, SessionStore
+from backends import InferenceBackend, check_backend, create_backend
+from result_cache import ResultCache, fingerprint
+from duplicates import HASHES, find_duplicate
+from matching import image_features, match_inspection
+from uploads import BodySizeLimitMiddleware, check_image, read_upload, save_upload, spooling_route_class
+from streaming import DetectionStream
+from tiling import merge_detections, tile_grid
+from video import empty_video_stats, select_keyframes
+import formats
+import metrics
+from metrics import TimingMiddleware, stage
+from startup import ModelLoader
   
   
-
-
+# Post-processing settings for the YOLOv8 output:
+#   score          - minimum class score for a candidate
+#   confidence     - score threshold handed to NMS
+#   nms            - IoU above which the lower scoring box is suppressed
+#   top_k          - only the top_k highest scoring candidates reach NMS (0: no cap)
+#   max_detections - most boxes returned per image (0: no cap)
+#   class_aware    - suppress overlapping boxes of the same class only
+# 'legacy' keeps the original near-zero thresholds (thousands of candidates, IoU 0.0)
+POSTPROCESS_PRESETS = {
+ 'recall': {'score': 0.1, 'confidence': 0.1, 'nms': 0.5, 'top_k': 1000, 'max_detections': 100, 'class_aware': True},
+ 'balanced': {'score': 0.25, 'confidence': 0.25, 'nms': 0.45, 'top_k': 1000, 'max_detections': 100, 'class_aware': True},
+ 'precision': {'score': 0.5, 'confidence': 0.5, 'nms': 0.45, 'top_k': 300, 'max_detections': 30, 'class_aware': True},
+ 'legacy': {'score': 0.005, 'confidence': 0.0001, 'nms': 0.0, 'top_k': 0, 'max_detections': 0, 'class_aware': False}
+}
 
 
 class Detection:
  def __init__(self, 
       model_path: str, 
-   classes: List[str]
+   classes: List[str],
+   postprocess: Optional[dict]=None,
+   backend: str='opencv',
+   backend_options: Optional[dict]=None
   ):
   self.model_path = model_path
   self.classes = classes
-  self.model = self.__load_model()
+  self.backend = backend
+  self.backend_options = backend_options or {}
+  # A misconfigured backend still fails right away, only the model itself waits
+  check_backend(backend)
+  # Loaded on first use (or by warm_up at startup), so importing the app does not read the model
+  self._model = None
+  self._model_lock = threading.Lock()
+  # Backends are not safe to run from two threads at once (warm-up and the scheduler)
+  self._forward_lock = threading.Lock()
+  self.batch_forward = True
+  self.postprocess = dict(POSTPROCESS_PRESETS['balanced'], **(postprocess or {}))
   self.colors = [
    (255, 87, 51), (51, 255, 87), (87, 51, 255), (255, 195, 0),
    (0, 195, 255), (195, 0, 255), (255, 0, 195), (0, 255, 195)
   ]
 
- def __load_model(self) -> cv2.dnn_Net:
-  net = cv2.dnn.readNet(self.model_path)
-  net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
-  return net
+ def __load_model(self) -> InferenceBackend:
+  return create_backend(self.backend, self.model_path, self.backend_options)
+
+ @property
+ def model(self) -> InferenceBackend:
+  if self._model is None:
+   with self._model_lock:
+    if self._model is None:
+     self._model = self.__load_model()
+  return self._model
+
+ @property
+ def loaded(self) -> bool:
+  return self._model is not None
+
+ def warm_up(self, width: int=640, height: int=640):
+  # One forward pass on a blank input pays for graph initialization and memory
+  # allocation before the first real request does
+  self.__forward(np.zeros((1, 3, height, width), dtype=np.float32))
 
  def __extract_output(self, 
    preds: ndarray, 
    image_shape: Tuple[int, int], 
    input_shape: Tuple[int, int],
-   score: float=0.005,
-   nms: float=0.0, 
-   confidence: float=0.0001
+   score: float=0.25,
+   nms: float=0.45, 
+   confidence: float=0.25,
+   multi_label: bool=True,
+   top_k: int=1000,
+   max_detections: int=100,
+   class_aware: bool=True
   ) -> dict:
-  class_ids, confs, boxes = list(), list(), list()
-
   image_height, image_width = image_shape
   input_height, input_width = input_shape
   x_factor = image_width / input_width
   y_factor = image_height / input_height
-  
-  rows = preds[0].shape[0]
-  for i in range(rows):
-     row = preds[0][i]
-     conf = row[4]
-     classes_score = row[4:]
-     # For each class above threshold, add a detection
-     for class_id, class_score in enumerate(classes_score):
-        if class_score > score:
-         label = self.classes[int(class_id)]
-         confs.append(conf)
-         class_ids.append(label)
-         x, y, w, h = row[0].item(), row[1].item(), row[2].item(), row[3].item()
-         left = int((x - 0.5 * w) * x_factor)
-         top = int((y - 0.5 * h) * y_factor)
-         width = int(w * x_factor)
-         height = int(h * y_factor)
-         box = np.array([left, top, width, height])
-         boxes.append(box)
-
-  r_class_ids, r_confs, r_boxes = list(), list(), list()
-  indexes = cv2.dnn.NMSBoxes(boxes, confs, confidence, nms)
-  
-  if len(indexes) > 0:
-   for i in indexes:
-    r_class_ids.append(class_ids[i])
-    r_confs.append(confs[i]*100)
-    r_boxes.append(boxes[i].tolist())
+
+  # Candidates from the raw output, then non-maximum suppression, timed apart
+  with stage('decode_output'):
+   rows = preds[0]
+   classes_score = rows[:, 4:]
+
+   # One candidate per (anchor, class) pair above the score threshold,
+   # or only the best class of each anchor when multi_label is off
+   if multi_label:
+    row_ids, class_ids = np.nonzero(classes_score > score)
+   else:
+    best = classes_score.argmax(axis=1)
+    row_ids = np.nonzero(classes_score[np.arange(len(rows)), best] > score)[0]
+    class_ids = best[row_ids]
+
+   if len(row_ids) == 0:
+    return {'boxes': [], 'confidences': [], 'classes': []}
+
+   confs = classes_score[row_ids, class_ids]
+
+   # Only the top_k best candidates reach NMS, so its cost is bounded
+   # no matter how many anchors clear the score threshold
+   if top_k and len(confs) > top_k:
+    keep = np.argpartition(-confs, top_k - 1)[:top_k]
+    row_ids, class_ids, confs = row_ids[keep], class_ids[keep], confs[keep]
+
+   # xywh (center) -> ltwh, rescaled to the original image size
+   x, y, w, h = rows[row_ids, :4].astype(np.float64).T
+   boxes = np.stack([
+    (x - 0.5 * w) * x_factor,
+    (y - 0.5 * h) * y_factor,
+    w * x_factor,
+    h * y_factor
+   ], axis=1).astype(np.int32)
+
+  with stage('nms'):
+   if class_aware:
+    indexes = cv2.dnn.NMSBoxesBatched(boxes, confs, class_ids.astype(np.int32), confidence, nms)
+   else:
+    indexes = cv2.dnn.NMSBoxes(boxes, confs, confidence, nms)
+   # NMS returns the kept boxes best first
+   indexes = np.asarray(indexes, dtype=np.int64).reshape(-1)
+   if max_detections:
+    indexes = indexes[:max_detections]
 
   return {
-    'boxes': [ [int(x) for x in box] for box in r_boxes ],
-    'confidences': [ float(conf) for conf in r_confs ],
-    'classes': [ str(c) for c in r_class_ids ]
+    'boxes': boxes[indexes].tolist(),
+    'confidences': (confs[indexes] * 100).tolist(),
+    'classes': [self.classes[c] for c in class_ids[indexes]]
   }
 
  def __draw_boxes(self, image: ndarray, detections: dict) -> ndarray:
@@ -116,48 +196,259 @@ class Detection:
   
   return annotated_image
 
+ def __forward(self, blob: ndarray) -> ndarray:
+  with self._forward_lock:
+   # Models exported with a static batch size of 1 reject (or silently
+   # truncate) larger blobs, fall back to one forward pass per image for those
+   if len(blob) > 1 and self.batch_forward:
+    try:
+     preds = self.model.forward(blob)
+     if preds.shape[0] == len(blob):
+      return preds.transpose((0, 2, 1))
+    except Exception:
+     # cv2.error, ONNX Runtime / OpenVINO shape errors
+     pass
+    self.batch_forward = False
+
+   preds = []
+   for i in range(len(blob)):
+    preds.append(self.model.forward(blob[i:i + 1]))
+   return np.concatenate(preds).transpose((0, 2, 1))
+
+ def render(self, 
+   image: ndarray, 
+   results: dict, 
+   quality: int=95, 
+   max_side: Optional[int]=None
+  ) -> bytes:
+  # Thumbnails are downscaled before drawing so boxes and labels stay legible
+  if max_side is not None and max(image.shape[:2]) > max_side:
+   scale = max_side / max(image.shape[:2])
+   image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+   results = dict(results, boxes=[[int(v * scale) for v in box] for box in results['boxes']])
+
+  with stage('render'):
+   annotated_image = self.__draw_boxes(image, results)
+   annotated_rgb = cv2.cvtColor(annotated_image, cv2.COLOR_BGR2RGB)
+   # Use higher quality JPEG (95% quality by default) for better image fidelity
+   _, buffer = cv2.imencode('.jpg', annotated_rgb, [cv2.IMWRITE_JPEG_QUALITY, quality])
+  return buffer.tobytes()
+
+ def annotate(self, image: ndarray, results: dict) -> str:
+  img_base64 = base64.b64encode(self.render(image, results)).decode('utf-8')
+  return f"data:image/jpeg;base64,{img_base64}"
+
+ def detect_batch(self,
+   images: List[ndarray], 
+   width: int=640, 
+   height: int=640, 
+   score: Optional[float]=None,
+   nms: Optional[float]=None, 
+   confidence: Optional[float]=None,
+   return_annotated: bool=False
+  ) -> List[dict]:
+  if len(images) == 0:
+   return []
+
+  # Thresholds not given here come from the engine's post-processing settings
+  postprocess = dict(self.postprocess)
+  postprocess.update({key: value for key, value in (('score', score), ('nms', nms), ('confidence', confidence)) if value is not None})
+
+  # One NCHW blob for all images, each resized to the model input
+  with stage('preprocess'):
+   blob = cv2.dnn.blobFromImages(
+      images, 1/255.0, (width, height), 
+      swapRB=True, crop=False
+     )
+  with stage('forward'):
+   preds = self.__forward(blob)
+
+  batch_results = []
+  for i, image in enumerate(images):
+   with stage('postprocess'):
+    results = self.__extract_output(
+     preds=preds[i:i + 1],
+     image_shape=image.shape[:2],
+     input_shape=(height, width),
+     **postprocess
+    )
+   if return_annotated:
+    results['annotated_image'] = self.annotate(image, results)
+   batch_results.append(results)
+
+  return batch_results
+
  def __call__(self,
    image: ndarray, 
    width: int=640, 
    height: int=640, 
-   score: float=0.005,
-   nms: float=0.0, 
-   confidence: float=0.0001,
+   score: Optional[float]=None,
+   nms: Optional[float]=None, 
+   confidence: Optional[float]=None,
    return_annotated: bool=False
   ) -> dict:
-  
-  blob = cv2.dnn.blobFromImage(
-     image, 1/255.0, (width, height), 
-     swapRB=True, crop=False
-    )
-  self.model.setInput(blob)
-  preds = self.model.forward()
-  preds = preds.transpose((0, 2, 1))
-
-  results = self.__extract_output(
-   preds=preds,
-   image_shape=image.shape[:2],
-   input_shape=(height, width),
+  return self.detect_batch(
+   [image],
+   width=width,
+   height=height,
    score=score,
    nms=nms,
-   confidence=confidence
-  )
-  
-  if return_annotated:
-   annotated_image = self.__draw_boxes(image, results)
-   annotated_rgb = cv2.cvtColor(annotated_image, cv2.COLOR_BGR2RGB)
-   # Use higher quality JPEG (95% quality) for better image fidelity
-   _, buffer = cv2.imencode('.jpg', annotated_rgb, [cv2.IMWRITE_JPEG_QUALITY, 95])
-   img_base64 = base64.b64encode(buffer).decode('utf-8')
-   results['annotated_image'] = f"data:image/jpeg;base64,{img_base64}"
-  
-  return results
+   confidence=confidence,
+   return_annotated=return_annotated
+  )[0]
+
+# FP32 model plus the quantized variants written by quantize_model.py
+MODEL_VARIANTS = {
+    'fp32': 'best.onnx',
+    'fp16': 'best.fp16.onnx',
+    'int8': 'best.int8.onnx'
+}
+MODEL_VARIANT = os.environ.get('MODEL_VARIANT', 'fp32')
+
+
+def model_variant_path(variant: str) -> str:
+    return os.path.join(os.path.dirname(__file__), MODEL_VARIANTS[variant])
+
+MODEL_PATH = model_variant_path(MODEL_VARIANT)
+DAMAGE_CLASSES = ['damaged door', 'damaged window', 'damaged headlight', 'damaged mirror', 'dent', 'damaged hood', 'damaged bumper', 'damaged wind shield']
+
+# Threshold preset for every Detection engine, with optional overrides of the caps
+DETECTION_PRESET = os.environ.get('DETECTION_PRESET', 'balanced')
+DETECTION_POSTPROCESS = dict(POSTPROCESS_PRESETS[DETECTION_PRESET])
+if 'DETECTION_TOP_K' in os.environ:
+    DETECTION_POSTPROCESS['top_k'] = int(os.environ['DETECTION_TOP_K'])
+if 'DETECTION_MAX_DETECTIONS' in os.environ:
+    DETECTION_POSTPROCESS['max_detections'] = int(os.environ['DETECTION_MAX_DETECTIONS'])
+
+# Engine running the network: opencv (cv2.dnn), onnxruntime or openvino
+INFERENCE_BACKEND = os.environ.get('INFERENCE_BACKEND', 'opencv')
+
+
+def backend_options(threads: int = 0) -> dict:
+    """Settings for the configured backend; `threads` is used unless INFERENCE_THREADS is set (0: library default)"""
+    threads = int(os.environ.get('INFERENCE_THREADS', threads))
+    if INFERENCE_BACKEND == 'onnxruntime':
+        return {
+            'intra_op_threads': threads,
+            'inter_op_threads': int(os.environ.get('INFERENCE_INTER_OP_THREADS', 0)),
+            'io_binding': os.environ.get('INFERENCE_IO_BINDING', '1') == '1'
+        }
+    if INFERENCE_BACKEND == 'openvino':
+        return {'num_threads': threads, 'performance_hint': os.environ.get('OPENVINO_PERFORMANCE_HINT', 'LATENCY')}
+    return {'num_threads': threads}
 
 detection = Detection(
-   model_path=os.path.join(os.path.dirname(__file__), 'best.onnx'), 
-   classes=['damaged door', 'damaged window', 'damaged headlight', 'damaged mirror', 'dent', 'damaged hood', 'damaged bumper', 'damaged wind shield'] 
+   model_path=MODEL_PATH, 
+   classes=DAMAGE_CLASSES,
+   postprocess=DETECTION_POSTPROCESS,
+   backend=INFERENCE_BACKEND,
+   backend_options=backend_options()
+)
+
+INFERENCE_MAX_BATCH_SIZE = int(os.environ.get('INFERENCE_MAX_BATCH_SIZE', 8))
+
+# Uploads are decoded at reduced resolution while both sides stay above this
+# (the model input size by default); 0 always decodes at full resolution
+DECODE_MIN_SIZE = int(os.environ.get('DECODE_MIN_SIZE', 640)) or None
+
+# Tiled inference (`?tiled=true`): photos are decoded at full resolution and also cut into
+# overlapping TILE_SIZE tiles (at most TILE_MAX_COUNT, larger tiles beyond that), run with
+# the whole photo; copies of a damage in several tiles are merged when their intersection
+# covers TILE_MERGE_OVERLAP of the smaller box
+TILE_SIZE = int(os.environ.get('TILE_SIZE', 640))
+TILE_OVERLAP = float(os.environ.get('TILE_OVERLAP', 0.2))
+TILE_MAX_COUNT = int(os.environ.get('TILE_MAX_COUNT', 16))
+TILE_MERGE_OVERLAP = float(os.environ.get('TILE_MERGE_OVERLAP', 0.5))
+# Tiled results are cached apart from whole-photo ones, and per tiling setting
+TILED_CACHE_MODE = f"tiled:{TILE_SIZE}:{TILE_OVERLAP}:{TILE_MAX_COUNT}:{TILE_MERGE_OVERLAP}"
+
+# Upload limits: each image at most UPLOAD_MAX_MB, each request body at most REQUEST_MAX_MB;
+# uploads above UPLOAD_SPOOL_MB are spooled to a temporary file while the request is parsed
+UPLOAD_MAX_BYTES = int(float(os.environ.get('UPLOAD_MAX_MB', 20)) * 1024 * 1024)
+REQUEST_MAX_BYTES = int(float(os.environ.get('REQUEST_MAX_MB', 100)) * 1024 * 1024)
+UPLOAD_SPOOL_BYTES = int(float(os.environ.get('UPLOAD_SPOOL_MB', 1)) * 1024 * 1024)
+
+# Walk-around videos (/detect-video): at most VIDEO_MAX_MB (REQUEST_MAX_MB caps the whole request too),
+# analyzed at VIDEO_SAMPLE_FPS frames per second; frames with a Laplacian variance under
+# VIDEO_MIN_SHARPNESS or a mean frame difference over VIDEO_MAX_MOTION are skipped, and so are
+# frames within VIDEO_MIN_DISTANCE hash bits of the last keyframe. The sharpest new view over
+# VIDEO_KEYFRAME_WINDOW sampled frames becomes a keyframe, at most VIDEO_MAX_KEYFRAMES per video
+VIDEO_MAX_BYTES = int(float(os.environ.get('VIDEO_MAX_MB', 100)) * 1024 * 1024)
+VIDEO_SAMPLE_FPS = float(os.environ.get('VIDEO_SAMPLE_FPS', 5))
+VIDEO_MIN_SHARPNESS = float(os.environ.get('VIDEO_MIN_SHARPNESS', 40))
+VIDEO_MAX_MOTION = float(os.environ.get('VIDEO_MAX_MOTION', 0.12))
+VIDEO_MIN_DISTANCE = int(os.environ.get('VIDEO_MIN_DISTANCE', 10))
+VIDEO_KEYFRAME_WINDOW = int(os.environ.get('VIDEO_KEYFRAME_WINDOW', 5))
+VIDEO_MAX_KEYFRAMES = int(os.environ.get('VIDEO_MAX_KEYFRAMES', 30))
+
+# Photos analyzed at once per /stream connection before the server stops reading from it
+STREAM_MAX_IN_FLIGHT = int(os.environ.get('STREAM_MAX_IN_FLIGHT', INFERENCE_MAX_BATCH_SIZE))
+
+# Send a Server-Timing breakdown with every response, not only to requests with an `X-Timing: 1` header
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '0').lower() in ('1', 'true', 'yes')
+
+# All in-process inference goes through one micro-batching queue in front of the shared model
+scheduler = BatchScheduler(
+   detection,
+   max_batch_size=INFERENCE_MAX_BATCH_SIZE,
+   max_wait_ms=float(os.environ.get('INFERENCE_MAX_WAIT_MS', 10))
 )
 
+# Optional multi-process serving: N worker processes, each with its own model
+# pinned to its own cores, fed decoded frames through shared memory
+INFERENCE_MODEL_WORKERS = int(os.environ.get('INFERENCE_MODEL_WORKERS', 0))
+INFERENCE_CORES_PER_WORKER = int(os.environ.get('INFERENCE_CORES_PER_WORKER', 1))
+model_pool = ModelProcessPool(
+   partial(
+      Detection,
+      model_path=MODEL_PATH,
+      classes=DAMAGE_CLASSES,
+      postprocess=DETECTION_POSTPROCESS,
+      backend=INFERENCE_BACKEND,
+      # Each worker's backend only uses the cores it is pinned to
+      backend_options=backend_options(threads=INFERENCE_CORES_PER_WORKER)
+   ),
+   num_workers=INFERENCE_MODEL_WORKERS,
+   cores_per_worker=INFERENCE_CORES_PER_WORKER,
+   max_batch_size=INFERENCE_MAX_BATCH_SIZE
+) if INFERENCE_MODEL_WORKERS > 0 else None
+
+
+def inference_engine():
+    """Model worker processes when configured, otherwise the in-process batching scheduler"""
+    return model_pool if model_pool is not None else scheduler
+
+
+def load_model():
+    """Load and warm up the model, in every model worker process when those are configured"""
+    if model_pool is None:
+        detection.warm_up()
+    elif not model_pool.wait_ready():
+        raise RuntimeError("Model workers did not become ready in time")
+    # Hash the weights for the result cache now rather than on the first request
+    result_cache.fingerprint
+
+
+def model_loaded() -> bool:
+    """Whether the model has been loaded, however it came to be (warm-up or a first request)"""
+    if model_pool is None:
+        return detection.loaded
+    return model_pool.stats()['workers_ready'] == model_pool.num_workers
+
+# When the model is loaded and warmed up: 'background' right after startup, while the
+# server already answers liveness probes; 'startup' before the server accepts requests;
+# 'lazy' only when the first request needs it
+model_loader = ModelLoader(load_model, mode=os.environ.get('MODEL_LOAD', 'background'), loaded=model_loaded)
+
+# Dedicated, size-limited pool for decode + inference + encode; requests beyond
+# workers + queue get a 503 instead of piling up
+inference_pool = InferencePool(
+   max_workers=int(os.environ.get('INFERENCE_WORKERS', 8)),
+   max_queue=int(os.environ.get('INFERENCE_QUEUE_LIMIT', 16)),
+   kind=os.environ.get('INFERENCE_EXECUTOR', 'thread')
+)
+INFERENCE_RETRY_AFTER = int(os.environ.get('INFERENCE_RETRY_AFTER', 1))
+
 
 REPAIR_COSTS = {
     'damaged door': {'min': 700, 'max': 1500},
@@ -170,8 +461,598 @@ REPAIR_COSTS = {
     'damaged wind shield': {'min': 200, 'max': 500}
 }
 
-# In-memory store for inspection sessions
-inspection_sessions: Dict[str, Dict] = {}
+SESSION_TTL_SECONDS = float(os.environ.get('SESSION_TTL_SECONDS', 6 * 3600))
+
+
+def create_redis_client():
+    """Client shared by the session and artifact stores with SESSION_STORE=redis, None otherwise"""
+    if os.environ.get('SESSION_STORE', 'memory') != 'redis':
+        return None
+    import redis
+    return redis.Redis.from_url(os.environ.get('REDIS_URL', 'redis://localhost:6379/0'))
+
+
+def create_session_store(client) -> SessionStore:
+    """In-memory store by default; SESSION_STORE=redis shares sessions between API workers"""
+    if client is not None:
+        return RedisSessionStore(client, classes=DAMAGE_CLASSES, ttl_seconds=SESSION_TTL_SECONDS)
+    return MemorySessionStore(
+        ttl_seconds=SESSION_TTL_SECONDS,
+        max_sessions=int(os.environ.get('SESSION_MAX_COUNT', 10000))
+    )
+
+
+def create_artifact_store(client):
+    """Photos go where the sessions pointing to them are, so every worker that serves a session has them"""
+    if client is not None:
+        return RedisArtifactStore(client, ttl_seconds=SESSION_TTL_SECONDS)
+    return ArtifactStore(max_bytes=int(os.environ.get('ARTIFACT_STORE_MAX_MB', 256)) * 1024 * 1024)
+
+
+# Store for inspection sessions
+redis_client = create_redis_client()
+inspection_sessions: SessionStore = create_session_store(redis_client)
+
+# Uploaded photos are kept out of the sessions, in a content-addressed store;
+# annotated versions are only rendered when requested, then cached in this process
+artifacts = create_artifact_store(redis_client)
+render_cache = RenderCache(max_bytes=int(os.environ.get('RENDER_CACHE_MAX_MB', 64)) * 1024 * 1024)
+
+# Near-duplicate photos within a phase (perceptual hashes at most this many bits
+# apart) reuse the detections of the earlier shot; -1 disables the check
+DUPLICATE_HASH = os.environ.get('DUPLICATE_HASH', 'phash')
+DUPLICATE_MAX_DISTANCE = int(os.environ.get('DUPLICATE_MAX_DISTANCE', 4))
+perceptual_hash = HASHES[DUPLICATE_HASH]
+
+# Retried and re-sent uploads are served from a content-addressed result cache
+# instead of going through decode and inference again
+result_cache = ResultCache(
+    # Hashing the weights is deferred to the first lookup (or the warm-up), off the import path
+    partial(fingerprint, MODEL_PATH, {'postprocess': DETECTION_POSTPROCESS, 'decode_min_size': DECODE_MIN_SIZE, 'classes': DAMAGE_CLASSES, 'duplicate_hash': DUPLICATE_HASH}),
+    max_bytes=int(os.environ.get('RESULT_CACHE_MAX_MB', 32)) * 1024 * 1024,
+    disk_path=os.environ.get('RESULT_CACHE_DIR') or None,
+    disk_max_bytes=int(os.environ.get('RESULT_CACHE_DISK_MAX_MB', 512)) * 1024 * 1024
+)
+
+# How /complete decides which return damages are new: 'count' compares per-class totals,
+# 'spatial' aligns return photos with pickup photos and matches boxes (see matching.py)
+DAMAGE_MATCHING = os.environ.get('DAMAGE_MATCHING', 'count')
+MATCHING_MIN_IOU = float(os.environ.get('MATCHING_MIN_IOU', 0.3))
+MATCHING_MIN_INLIERS = int(os.environ.get('MATCHING_MIN_INLIERS', 15))
+MATCHING_CANDIDATES = int(os.environ.get('MATCHING_CANDIDATES', 3))
+
+RENDER_STYLE = 'boxes-v1'
+RENDER_SIZES = {
+    'full': {'max_side': None, 'quality': 95},
+    'thumb': {'max_side': 320, 'quality': 75}
+}
+
+
+# JPEG can be decoded directly at 1/2, 1/4 or 1/8 scale, far cheaper than a full decode
+REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2)
+)
+
+
+def decode_image(data: bytes, min_size: Optional[int] = None) -> Tuple[ndarray, Tuple[float, float]]:
+    """
+    Decode an uploaded image straight into the BGR array the Detection engine expects.
+    
+    With `min_size`, the image is decoded at the smallest reduced scale that keeps both
+    sides at least `min_size` pixels. Returns the image and the (x, y) factors that map
+    its coordinates back to the original resolution.
+    """
+    width, height = Image.open(io.BytesIO(data)).size
+    
+    flags = cv2.IMREAD_COLOR
+    if min_size is not None:
+        for factor, reduced_flag in REDUCED_DECODE_FLAGS:
+            if min(width, height) // factor >= min_size:
+                flags = reduced_flag
+                break
+    
+    # Keep pixel coordinates as stored in the file, like the PIL path does
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags | cv2.IMREAD_IGNORE_ORIENTATION)
+    if image is None:
+        # Formats OpenCV can't decode go through PIL at full resolution
+        image = np.array(Image.open(io.BytesIO(data)).convert("RGB"))
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    
+    return image, (width / image.shape[1], height / image.shape[0])
+
+
+def rescale_boxes(results: dict, scale: Tuple[float, float]) -> dict:
+    """Map boxes detected on a reduced-resolution decode back to original image coordinates"""
+    x_scale, y_scale = scale
+    if (x_scale, y_scale) != (1.0, 1.0):
+        results['boxes'] = [
+            [int(left * x_scale), int(top * y_scale), int(width * x_scale), int(height * y_scale)]
+            for left, top, width, height in results['boxes']
+        ]
+    return results
+
+
+def get_session_or_404(session_id: str) -> Dict:
+    session = inspection_sessions.get(session_id)
+    # Completed sessions are only kept for their report images
+    if session is None or session['phase'] == 'completed':
+        raise HTTPException(status_code=404, detail="Session not found")
+    return session
+
+
+def update_session_or_404(session_id: str, change) -> Tuple[Dict, object]:
+    """
+    Apply `change` to the latest copy of an open session and save it atomically (see
+    SessionStore.update), so uploads recorded by other requests or workers meanwhile are kept
+    """
+    def apply(session: Dict):
+        if session['phase'] == 'completed':
+            raise HTTPException(status_code=404, detail="Session not found")
+        return change(session)
+    
+    updated = inspection_sessions.update(session_id, apply)
+    if updated is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return updated
+
+
+def lookup_results(uploads: List[bytes], tiled: bool) -> Tuple[List[str], List[str], List[Optional[dict]]]:
+    """Digests, result cache keys and cached results (None if not seen) of uploaded images"""
+    image_digests = [hashlib.sha256(data).hexdigest() for data in uploads]
+    cache_keys = [result_cache.key(image_digest, TILED_CACHE_MODE if tiled else None) for image_digest in image_digests]
+    return image_digests, cache_keys, [result_cache.get(cache_key) for cache_key in cache_keys]
+
+
+def cache_results(entries: List[Tuple[str, dict]]):
+    for cache_key, results in entries:
+        result_cache.put(cache_key, results)
+
+
+def expand_record(session_id: str, record: dict) -> dict:
+    """Full detection result as returned by the API, from a compact session record"""
+    return {
+        **{key: value for key, value in record.items() if key != 'image_digest'},
+        'repair_costs': [repair_cost(damage_type) for damage_type in record.get('classes', [])],
+        'annotated_image': f"/api/inspection/{session_id}/images/{record['image_index']}.jpg"
+    }
+
+
+def render_annotated_image(digest: str, detections: dict, size: str = 'full', quality: Optional[int] = None) -> Optional[bytes]:
+    """Annotated JPEG of a stored image, rendered once per variant; None if the image was evicted"""
+    options = RENDER_SIZES[size]
+    quality = quality or options['quality']
+    key = render_key(digest, detections, RENDER_STYLE, size, quality)
+    data = render_cache.get(key)
+    if data is None:
+        source = artifacts.get(digest)
+        if source is None:
+            return None
+        # Thumbnails can start from a reduced decode, with boxes scaled down to match
+        image, scale = decode_image(source, min_size=options['max_side'])
+        detections = rescale_boxes(dict(detections), (1 / scale[0], 1 / scale[1]))
+        data = detection.render(image, detections, quality=quality, max_side=options['max_side'])
+        render_cache.put(key, data)
+    return data
+
+
+def session_record(session: Optional[Dict], image_index: int) -> Optional[dict]:
+    """Detection record of the image_index-th photo of a session, in either phase"""
+    if session is None:
+        return None
+    return next((
+        record
+        for key in ('pickup_detections', 'return_detections')
+        for record in session[key]
+        if record['image_index'] == image_index and record.get('image_digest')
+    ), None)
+
+
+def render_session_image(session_id: str, image_index: int, size: str = 'full') -> Optional[bytes]:
+    record = session_record(inspection_sessions.get(session_id), image_index)
+    return render_annotated_image(record['image_digest'], record, size=size) if record is not None else None
+
+
+def negotiated_response(payload: dict, accept: Optional[str], image_indices: List[int] = ()):
+    """
+    The payload in the format the Accept header asks for (see formats.py): as-is for JSON,
+    otherwise compact JSON, MessagePack or multipart/mixed with the annotated JPEGs of
+    `image_indices` attached.
+    """
+    media_type = formats.negotiate(accept)
+    if media_type == formats.JSON:
+        return payload
+    
+    with stage('encode'):
+        compact = formats.compact_payload(payload, DAMAGE_CLASSES, [repair_cost(damage_type) for damage_type in DAMAGE_CLASSES])
+        headers = {'Vary': 'Accept'}
+        if media_type == formats.MSGPACK:
+            return Response(content=formats.encode_msgpack(compact), media_type=media_type, headers=headers)
+        if media_type == formats.COMPACT_JSON:
+            return Response(content=formats.encode_json(compact), media_type=media_type, headers=headers)
+    
+        session_id = payload['session_id']
+        session = inspection_sessions.get(session_id)
+        images = []
+        for image_index in image_indices:
+            record = session_record(session, image_index)
+            data = render_annotated_image(record['image_digest'], record) if record is not None else None
+            if data is not None:
+                images.append((image_index, f"/api/inspection/{session_id}/images/{image_index}.jpg", data))
+        body, content_type = formats.encode_multipart(compact, images)
+        return Response(content=body, headers=dict(headers, **{'Content-Type': content_type}))
+
+
+async def negotiated_response_async(payload: dict, accept: Optional[str], image_indices: List[int] = ()):
+    """negotiated_response for async endpoints: multipart renders (decode, draw, encode) run off the event loop"""
+    if formats.negotiate(accept) == formats.MULTIPART:
+        return await run_in_threadpool(negotiated_response, payload, accept, image_indices)
+    return negotiated_response(payload, accept, image_indices)
+
+
+def phase_records(session: Dict) -> List[dict]:
+    return session['pickup_detections'] if session['phase'] == 'pickup' else session['return_detections']
+
+
+def phase_hashes(session: Dict) -> List[Tuple[int, str]]:
+    """(image_index, image_hash) of the photos in the current phase that are not duplicates themselves"""
+    return [
+        (record['image_index'], record['image_hash'])
+        for record in phase_records(session)
+        if record.get('image_hash') and record.get('duplicate_of') is None
+    ]
+
+
+def tag_duplicates(batch_results: List[dict], phase: str):
+    """Remember the phase near-duplicates were found in; the session may switch phase before they are recorded"""
+    for results in batch_results:
+        if results.get('duplicate_of') is not None:
+            results['duplicate_phase'] = phase
+
+
+def reuse_detections(session: Dict, image_index: int, image_size: List[int]) -> dict:
+    """Detections of an earlier photo, scaled to a near-duplicate's resolution"""
+    original = session_record(session, image_index)
+    if original is None:
+        raise HTTPException(status_code=409, detail="The photo this upload duplicates is no longer in the session, please upload it again")
+    scale = (image_size[0] / original['image_size'][0], image_size[1] / original['image_size'][1])
+    return rescale_boxes({
+        'boxes': original['boxes'],
+        'confidences': list(original['confidences']),
+        'classes': list(original['classes'])
+    }, scale)
+
+
+def record_detection(session: Dict, results: dict, image_data: bytes, image_digest: Optional[str] = None) -> dict:
+    """Store a compact detection record in the session's current phase and return the full result"""
+    session_id = session['session_id']
+    
+    duplicate_of = results.get('duplicate_of')
+    if duplicate_of is not None and results.get('duplicate_phase', session['phase']) != session['phase']:
+        # The phase switched while this photo was analyzed: the original belongs to the other
+        # phase, so its detections still describe this photo but it is no duplicate in this one
+        results = dict(results, **reuse_detections(session, duplicate_of, results['image_size']))
+        duplicate_of = None
+    
+    # Cached results (and uploads racing each other) are checked against the phase here
+    if duplicate_of is None and results.get('image_hash'):
+        duplicate_of = find_duplicate(results['image_hash'], phase_hashes(session), DUPLICATE_MAX_DISTANCE)
+    if duplicate_of is not None:
+        results = dict(results, **reuse_detections(session, duplicate_of, results['image_size']))
+    
+    # Indices come from the session, so they stay unique and stable whichever worker records the photo
+    image_index = session.get('image_count', len(session['pickup_detections']) + len(session['return_detections']))
+    session['image_count'] = image_index + 1
+    record = {
+        'boxes': results['boxes'],
+        'confidences': results['confidences'],
+        'classes': results['classes'],
+        'image_index': image_index,
+        'image_digest': artifacts.put(image_data, image_digest),
+        'image_hash': results.get('image_hash'),
+        'image_size': results.get('image_size')
+    }
+    if 'tiles' in results:
+        record['tiles'] = results['tiles']
+    if duplicate_of is not None:
+        record['duplicate_of'] = duplicate_of
+    
+    # Store in appropriate phase, keeping its running totals up to date
+    phase_records(session).append(record)
+    add_to_summary(phase_summary(session, session['phase']), record)
+    
+    return expand_record(session_id, record)
+
+
+def session_image_features(session: Dict, image_index: int):
+    """Keypoints of a stored session photo for spatial matching, None once evicted"""
+    record = session_record(session, image_index)
+    data = artifacts.get(record['image_digest']) if record is not None else None
+    if data is None:
+        return None
+    image, scale = decode_image(data, min_size=DECODE_MIN_SIZE)
+    return image_features(image, scale)
+
+
+def spatial_new_damages(session: Dict) -> dict:
+    """Per-box new damage flags for every return photo (near-duplicates share their original's)"""
+    originals = lambda records: [record for record in records if record.get('duplicate_of') is None]
+    matches = match_inspection(
+        originals(session['pickup_detections']),
+        originals(session['return_detections']),
+        partial(session_image_features, session),
+        candidates=MATCHING_CANDIDATES,
+        min_iou=MATCHING_MIN_IOU,
+        min_inliers=MATCHING_MIN_INLIERS
+    )
+    for record in session['return_detections']:
+        if record.get('duplicate_of') is not None:
+            matches['new'][record['image_index']] = matches['new'][record['duplicate_of']]
+            matches['aligned_to'][record['image_index']] = matches['aligned_to'][record['duplicate_of']]
+    return matches
+
+
+def phase_detections_count(session: Dict) -> int:
+    return len(phase_records(session))
+
+
+def repair_cost(damage_type: str) -> dict:
+    return REPAIR_COSTS.get(damage_type.lower(), {'min': 100, 'max': 500})
+
+
+def empty_summary() -> dict:
+    return {'images_uploaded': 0, 'duplicate_images': 0, 'total_damages': 0, 'damages_by_type': {}, 'repair_cost': {'min': 0, 'max': 0}}
+
+
+def add_to_summary(summary: dict, record: dict):
+    """Count one detection record into a phase's running totals (near-duplicates only as images)"""
+    summary['images_uploaded'] += 1
+    if record.get('duplicate_of') is not None:
+        summary['duplicate_images'] += 1
+        return
+    summary['total_damages'] += len(record['classes'])
+    for damage_type in record['classes']:
+        summary['damages_by_type'][damage_type] = summary['damages_by_type'].get(damage_type, 0) + 1
+        cost = repair_cost(damage_type)
+        summary['repair_cost']['min'] += cost['min']
+        summary['repair_cost']['max'] += cost['max']
+
+
+def phase_summary(session: Dict, phase: str) -> dict:
+    """Running totals of a phase, rebuilt once for sessions stored before they were kept"""
+    key = f'{phase}_summary'
+    if key not in session:
+        session[key] = empty_summary()
+        for record in session[f'{phase}_detections']:
+            add_to_summary(session[key], record)
+    return session[key]
+
+
+def count_new_damages(pickup_counts: Dict[str, int], return_counts: Dict[str, int]) -> Dict[str, int]:
+    """Per damage type, how many more were found at return than at pickup"""
+    return {
+        damage_type: count - pickup_counts.get(damage_type, 0)
+        for damage_type, count in return_counts.items()
+        if count > pickup_counts.get(damage_type, 0)
+    }
+
+
+def estimate_new_damages(new_damage_counts: Dict[str, int]) -> dict:
+    """The `new_damages_detected` report section for per-type counts of new damages"""
+    total_min_cost = 0
+    total_max_cost = 0
+    new_damages_breakdown = []
+    for damage_type, count in new_damage_counts.items():
+        cost = repair_cost(damage_type)
+        total_min_cost += cost['min'] * count
+        total_max_cost += cost['max'] * count
+        new_damages_breakdown.append({
+            'damage_type': damage_type,
+            'count': count,
+            'cost_per_unit': cost
+        })
+    
+    return {
+        'total_new_damages': sum(new_damage_counts.values()),
+        'damages_breakdown': new_damages_breakdown,
+        'estimated_repair_cost': {
+            'min': total_min_cost,
+            'max': total_max_cost,
+            'average': (total_min_cost + total_max_cost) // 2
+        }
+    }
+
+
+def describe_image(image: ndarray, scale: Tuple[float, float]) -> dict:
+    """Perceptual hash and original size of a decoded upload"""
+    height, width = image.shape[:2]
+    return {
+        'image_hash': perceptual_hash(image),
+        'image_size': [round(width * scale[0]), round(height * scale[1])]
+    }
+
+
+def detect_tiled(images: List[ndarray]) -> List[dict]:
+    """Detections of each photo and its tiles, merged; all crops are queued for the model at once"""
+    crops, offsets, counts, grids = [], [], [], []
+    for image in images:
+        height, width = image.shape[:2]
+        grid = tile_grid(width, height, TILE_SIZE, TILE_OVERLAP, TILE_MAX_COUNT)
+        # A photo that fits in one tile only needs the whole-photo pass
+        tiles = grid if len(grid) > 1 else []
+        crops.append(image)
+        crops.extend(np.ascontiguousarray(image[top:top + h, left:left + w]) for left, top, w, h in tiles)
+        offsets.extend([(0, 0)] + [(left, top) for left, top, _, _ in tiles])
+        counts.append(1 + len(tiles))
+        grids.append(len(grid))
+    
+    with stage('inference'):
+        crop_results = inference_engine().detect_batch(crops)
+    
+    batch_results, start = [], 0
+    with stage('merge'):
+        for count, tiles in zip(counts, grids):
+            results = merge_detections(
+                crop_results[start:start + count], offsets[start:start + count],
+                min_overlap=TILE_MERGE_OVERLAP, max_detections=DETECTION_POSTPROCESS['max_detections']
+            )
+            results['tiles'] = tiles
+            batch_results.append(results)
+            start += count
+    return batch_results
+
+
+def run_detection_pipeline(data: bytes, known_hashes: List[Tuple[int, str]] = (), tiled: bool = False) -> dict:
+    """Decode and detect one upload (runs on the inference pool)"""
+    try:
+        with stage('decode'):
+            image, scale = decode_image(data, min_size=None if tiled else DECODE_MIN_SIZE)
+    except Exception:
+        raise ValueError("Could not decode image")
+    with stage('hash'):
+        results = describe_image(image, scale)
+    
+    # A near-duplicate of an earlier photo gets that photo's detections when recorded
+    results['duplicate_of'] = find_duplicate(results['image_hash'], known_hashes, DUPLICATE_MAX_DISTANCE)
+    if results['duplicate_of'] is None:
+        if tiled:
+            detections = detect_tiled([image])[0]
+        else:
+            with stage('inference'):
+                detections = inference_engine().detect(image)
+        results.update(rescale_boxes(detections, scale))
+    return results
+
+
+def run_batch_detection_pipeline(uploads: List[Tuple[str, bytes]], known_hashes: List[Tuple[int, str]] = (), tiled: bool = False) -> List[dict]:
+    """Decode and detect several uploads (runs on the inference pool), see detect_images"""
+    images = []
+    for filename, data in uploads:
+        try:
+            with stage('decode'):
+                images.append(decode_image(data, min_size=None if tiled else DECODE_MIN_SIZE))
+        except Exception:
+            raise ValueError(f"Could not decode image: {filename}")
+    return detect_images(images, known_hashes, tiled)
+
+
+def detect_images(images: List[Tuple[ndarray, Tuple[float, float]]], known_hashes: List[Tuple[int, str]] = (), tiled: bool = False) -> List[dict]:
+    """
+    Detect several decoded (image, scale) pairs in batched forward passes.
+    
+    Near-duplicates of earlier photos in the phase get `duplicate_of` (an image index), and
+    near-duplicates of an earlier image in the same batch `duplicate_of_upload` (its position).
+    Neither runs through the model.
+    """
+    known_hashes = [(('image', image_index), image_hash) for image_index, image_hash in known_hashes]
+    batch_results, unique_images, scales, positions = [], [], [], []
+    for position, (image, scale) in enumerate(images):
+        with stage('hash'):
+            results = describe_image(image, scale)
+        batch_results.append(results)
+        
+        duplicate = find_duplicate(results['image_hash'], known_hashes, DUPLICATE_MAX_DISTANCE)
+        if duplicate is None:
+            if results['image_hash'] is not None:
+                known_hashes.append((('upload', position), results['image_hash']))
+            unique_images.append(image)
+            scales.append(scale)
+            positions.append(position)
+        elif duplicate[0] == 'image':
+            results['duplicate_of'] = duplicate[1]
+        else:
+            results['duplicate_of_upload'] = duplicate[1]
+    
+    if unique_images:
+        if tiled:
+            engine_results = detect_tiled(unique_images)
+        else:
+            with stage('inference'):
+                engine_results = inference_engine().detect_batch(unique_images)
+        for position, scale, detections in zip(positions, scales, engine_results):
+            batch_results[position].update(rescale_boxes(detections, scale))
+    return batch_results
+
+
+def record_batch(session: Dict, batch_results: List[dict], uploads: List[bytes], image_digests: List[Optional[str]]) -> List[dict]:
+    """Record several results in upload order, pointing near-duplicates of an earlier upload at its image"""
+    detections = []
+    for result, data, image_digest in zip(batch_results, uploads, image_digests):
+        if 'duplicate_of_upload' in result:
+            # A new dict: the session store may run this again on a fresher copy of the session
+            original = detections[result['duplicate_of_upload']]
+            result = {key: value for key, value in result.items() if key != 'duplicate_of_upload'}
+            result['duplicate_of'] = original.get('duplicate_of', original['image_index'])
+        detections.append(record_detection(session, result, data, image_digest))
+    return detections
+
+
+def run_video_pipeline(path: str, known_hashes: List[Tuple[int, str]] = (), tiled: bool = False) -> Tuple[List[dict], dict]:
+    """
+    Select the keyframes of a video file and detect them (runs on the inference pool).
+    
+    Keyframes go through detect_images INFERENCE_MAX_BATCH_SIZE at a time as they are found,
+    so only one batch of decoded frames is held at once. Each result carries its `frame`
+    number, `timestamp` and the keyframe as a JPEG (`image_data`) to be stored like an upload.
+    """
+    stats = empty_video_stats()
+    keyframes = select_keyframes(
+        path, stats,
+        sample_fps=VIDEO_SAMPLE_FPS,
+        max_keyframes=VIDEO_MAX_KEYFRAMES,
+        min_sharpness=VIDEO_MIN_SHARPNESS,
+        max_motion=VIDEO_MAX_MOTION,
+        min_distance=VIDEO_MIN_DISTANCE,
+        window=VIDEO_KEYFRAME_WINDOW,
+        hash_image=perceptual_hash
+    )
+    
+    video_results, chunk = [], []
+    
+    def detect_chunk():
+        offset = len(video_results)
+        chunk_results = detect_images([(frame, (1.0, 1.0)) for _, _, frame in chunk], known_hashes, tiled)
+        for (frame_index, timestamp, frame), result in zip(chunk, chunk_results):
+            if 'duplicate_of_upload' in result:
+                result['duplicate_of_upload'] += offset
+            with stage('encode'):
+                result['image_data'] = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+            result.update(frame=frame_index, timestamp=round(timestamp, 3))
+            video_results.append(result)
+        chunk.clear()
+    
+    with stage('keyframes'):
+        # Timed as a whole, so it includes the inference of the batches found along the way
+        for keyframe in keyframes:
+            chunk.append(keyframe)
+            if len(chunk) == INFERENCE_MAX_BATCH_SIZE:
+                detect_chunk()
+        if chunk:
+            detect_chunk()
+    return video_results, stats
+
+
+async def run_on_inference_pool(fn, *args):
+    try:
+        return await inference_pool.run(fn, *args)
+    except PoolSaturated:
+        raise HTTPException(
+            status_code=503,
+            detail="Inference workers are busy, please retry shortly",
+            headers={'Retry-After': str(INFERENCE_RETRY_AFTER)}
+        )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if model_loader.mode == 'background':
+        model_loader.start()
+    elif model_loader.mode == 'startup':
+        if not await asyncio.get_running_loop().run_in_executor(None, model_loader.load):
+            raise RuntimeError(f"Model failed to load: {model_loader.error}")
+    yield
+    if model_pool is not None:
+        model_pool.shutdown()
 
 app = FastAPI(
     title="🚗 Car Damage Detection & Estimation API",
@@ -203,8 +1084,14 @@ app = FastAPI(
     },
     license_info={
         "name": "MIT"
-    }
+    },
+    lifespan=lifespan
 )
+# Multipart uploads of this app's routes are spooled at UPLOAD_SPOOL_MB
+app.router.route_class = spooling_route_class(UPLOAD_SPOOL_BYTES)
+
+# Added before CORS so the 413 responses still carry CORS headers
+app.add_middleware(BodySizeLimitMiddleware, max_bytes=REQUEST_MAX_BYTES)
 
 app.add_middleware(
     CORSMiddleware,
@@ -214,6 +1101,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Outermost, so the request latency covers the other middleware too
+app.add_middleware(TimingMiddleware, always=SERVER_TIMING)
+
 @app.get("/api", tags=["Info"], summary="API Information", response_description="API metadata and available endpoints")
 def read_root():
     """
@@ -232,9 +1122,18 @@ def read_root():
         "endpoints": {
             "/api/inspection/start": "POST - Start a new inspection session (pickup phase)",
             "/api/inspection/{session_id}/detect": "POST - Detect damages in uploaded image",
+            "/api/inspection/{session_id}/detect-batch": "POST - Detect damages in multiple uploaded images at once",
+            "/api/inspection/{session_id}/detect-video": "POST - Detect damages in the sharp, distinct keyframes of a walk-around video",
+            "/api/inspection/{session_id}/stream": "WebSocket - Stream photos in and detections back as each finishes",
+            "/api/inspection/{session_id}/images/{n}.jpg": "GET - Annotated image for the n-th uploaded photo (?size=thumb|full&quality=)",
             "/api/inspection/{session_id}/switch-to-return": "POST - Switch from pickup to return phase",
-            "/api/inspection/{session_id}/complete": "POST - Complete inspection and compare damages",
+            "/api/inspection/{session_id}/summary": "GET - Running damage totals and new damages so far",
+            "/api/inspection/{session_id}/complete": "POST - Complete inspection and compare damages (?matching=count|spatial)",
             "/api/detection": "POST - Legacy single image detection (deprecated)",
+            "/api/inference/stats": "GET - Inference queue depth and batch-size statistics",
+            "/health/live": "GET - Liveness probe",
+            "/health/ready": "GET - Readiness probe: 200 once the model is loaded and warmed up, 503 before",
+            "/metrics": "GET - Per-stage latency histograms and load gauges (Prometheus text format)",
         },
         "docs": "/docs (Swagger UI) or /redoc (ReDoc)"
     }
@@ -265,17 +1164,20 @@ def start_inspection():
     ```
     """
     session_id = str(uuid.uuid4())
-    inspection_sessions[session_id] = {
+    inspection_sessions.create({
         'session_id': session_id,
         'created_at': datetime.now().isoformat(),
         'pickup_detections': [],
         'return_detections': [],
-        'phase': 'pickup'
-    }
+        'pickup_summary': empty_summary(),
+        'return_summary': empty_summary(),
+        'phase': 'pickup',
+        'image_count': 0
+    })
     return {'session_id': session_id, 'message': 'Inspection started - in pickup phase'}
 
 @app.post('/api/inspection/{session_id}/detect', tags=["Inspection Workflow"], summary="Detect Damages in Image", response_description="Detection results with annotated image")
-def detect_damage_in_session(session_id: str, file: bytes = File(...)):
+async def detect_damage_in_session(session_id: str, file: UploadFile = File(...), tiled: bool = False, accept: Optional[str] = Header(None)):
     """
     Analyze an uploaded vehicle image for damage detection.
     
@@ -285,6 +1187,8 @@ def detect_damage_in_session(session_id: str, file: bytes = File(...)):
     **Parameters:**
     - `session_id` (path): The unique session ID from `/api/inspection/start`
     - `file` (body): Image file (JPEG, PNG) - vehicle photo to analyze
+    - `tiled` (query): `true` to also run overlapping full-resolution tiles of the photo through the model,
+      for small damage on high-resolution close-ups (more compute per photo; see `TILE_*` settings)
     
     **Detection Classes:**
     - damaged door, damaged window, damaged headlight, damaged mirror
@@ -294,12 +1198,32 @@ def detect_damage_in_session(session_id: str, file: bytes = File(...)):
     - `session_id`: Your session ID
     - `phase`: Current phase (pickup or return)
     - `detections_count`: Total detections uploaded in current phase
+    - `cached`: `true` when this exact image was analyzed before and the model was not run again
     - `current_detection`: Object containing:
       - `boxes`: Bounding box coordinates [x, y, width, height]
       - `confidences`: Detection confidence scores (0-100%)
       - `classes`: Detected damage types
       - `repair_costs`: Cost estimate per damage type
-      - `annotated_image`: Base64-encoded image with bounding boxes
+      - `image_index`: Index of this image within the session
+      - `image_hash`, `image_size`: Perceptual hash and original [width, height] of the photo
+      - `tiles`: Only with `tiled=true`: number of tiles the photo was cut into (1: it fit in one tile)
+      - `duplicate_of`: Only for near-duplicates of an earlier photo in this phase: that photo's `image_index`.
+        Its detections are reused without running the model, and it is not counted again at `/complete`
+      - `annotated_image`: URL of the image with bounding boxes (`/api/inspection/{session_id}/images/{n}.jpg`)
+    
+    **Response formats** (`Accept` header):
+    - `application/json` (default): As described above
+    - `application/vnd.car-damage.compact+json`: Detections as `i` (image index), `c` (class indices into `classes`),
+      `b` (flat box list), `p` (confidences); `repair_costs` once per class and `image_url` as a template instead of per detection
+    - `application/msgpack`: The compact form as MessagePack
+    - `multipart/mixed`: The compact form, followed by the annotated images as raw JPEG parts (`Content-ID: <image-{i}>`)
+    
+    **Errors:**
+    - `400`: The image could not be decoded (e.g. a truncated file)
+    - `404`: Session not found
+    - `413`: Image larger than `UPLOAD_MAX_MB` (or request body larger than `REQUEST_MAX_MB`)
+    - `415`: Not an image (checked from the first bytes of the file)
+    - `503`: All inference workers are busy; retry after the `Retry-After` header
     
     **Example:**
     ```
@@ -308,38 +1232,294 @@ def detect_damage_in_session(session_id: str, file: bytes = File(...)):
     file: <image file>
     ```
     """
-    if session_id not in inspection_sessions:
-        raise HTTPException(status_code=404, detail="Session not found")
-    
-    session = inspection_sessions[session_id]
-    
-    # Detect damages in the image
-    image = Image.open(io.BytesIO(file)).convert("RGB")
-    image = np.array(image)
-    image = image[:,:,::-1].copy()
-    results = detection(image, return_annotated=True)
+    with stage('upload'):
+        data = await read_upload(file, UPLOAD_MAX_BYTES)
+    payload = await detect_and_record(session_id, data, tiled)
+    return await negotiated_response_async(payload, accept, [payload['current_detection']['image_index']])
+
+
+async def detect_and_record(session_id: str, data: bytes, tiled: bool = False) -> dict:
+    """Detect damages in one upload and record them in the session; returns the `/detect` response"""
+    # Session store round trips, hashing and the result cache's disk tier all block,
+    # so they run on the threadpool rather than stalling the event loop
+    session = await run_in_threadpool(get_session_or_404, session_id)
     
-    # Add repair costs
-    repair_costs = []
-    for damage_type in results.get('classes', []):
-        cost = REPAIR_COSTS.get(damage_type.lower(), {'min': 100, 'max': 500})
-        repair_costs.append(cost)
+    # Detect damages in the image, unless these exact bytes were analyzed before
+    with stage('cache'):
+        [image_digest], [cache_key], [results] = await run_in_threadpool(lookup_results, [data], tiled)
+    cached = results is not None
+    if not cached:
+        phase = session['phase']
+        try:
+            results = await run_on_inference_pool(run_detection_pipeline, data, phase_hashes(session), tiled)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        tag_duplicates([results], phase)
+        # Reused detections of a near-duplicate are not model output for these bytes
+        if results['duplicate_of'] is None:
+            await run_in_threadpool(cache_results, [(cache_key, results)])
     
-    results['repair_costs'] = repair_costs
-    
-    # Store in appropriate phase
-    if session['phase'] == 'pickup':
-        session['pickup_detections'].append(results)
-    else:
-        session['return_detections'].append(results)
+    # Recorded into the latest copy of the session, so concurrent uploads are not lost
+    with stage('record'):
+        session, results = await run_in_threadpool(
+            update_session_or_404, session_id, lambda session: record_detection(session, results, data, image_digest)
+        )
     
     return {
         'session_id': session_id,
         'phase': session['phase'],
-        'detections_count': len(session['pickup_detections']) if session['phase'] == 'pickup' else len(session['return_detections']),
+        'detections_count': phase_detections_count(session),
+        'cached': cached,
         'current_detection': results
     }
 
+@app.post('/api/inspection/{session_id}/detect-batch', tags=["Inspection Workflow"], summary="Detect Damages in Multiple Images", response_description="Per-image detection results with annotated images")
+async def detect_damage_batch_in_session(session_id: str, files: List[UploadFile] = File(...), tiled: bool = False, accept: Optional[str] = Header(None)):
+    """
+    Analyze several uploaded vehicle images in a single round trip.
+    
+    All images are queued together and run through the model in batched forward passes, then decoded
+    per image. Each result is stored in the session's current phase exactly as if it
+    had been uploaded to `/api/inspection/{session_id}/detect`, in upload order.
+    
+    **Parameters:**
+    - `session_id` (path): The unique session ID from `/api/inspection/start`
+    - `files` (body): One or more image files (JPEG, PNG)
+    - `tiled` (query): `true` for tiled inference on every image, as in `/detect`
+    
+    **Returns:**
+    - `session_id`: Your session ID
+    - `phase`: Current phase (pickup or return)
+    - `detections_count`: Total detections uploaded in current phase
+    - `results`: List (one entry per uploaded file) of objects containing:
+      - `filename`: Name of the uploaded file
+      - `cached`: `true` when the model was not run again for this file
+      - `detection`: Same structure as `current_detection` from `/detect`
+    
+    **Response formats** (`Accept` header):
+    - `application/json` (default): As described above
+    - `application/vnd.car-damage.compact+json`: Detections as `i` (image index), `c` (class indices into `classes`),
+      `b` (flat box list), `p` (confidences); `repair_costs` once per class and `image_url` as a template instead of per detection
+    - `application/msgpack`: The compact form as MessagePack
+    - `multipart/mixed`: The compact form, followed by the annotated images as raw JPEG parts (`Content-ID: <image-{i}>`)
+    
+    **Errors:**
+    - `400`: An image could not be decoded
+    - `404`: Session not found
+    - `413`: An image larger than `UPLOAD_MAX_MB`, or the request body larger than `REQUEST_MAX_MB`
+    - `415`: A file that is not an image
+    - `503`: All inference workers are busy; retry after the `Retry-After` header
+    
+    **Example:**
+    ```
+    POST /api/inspection/{session_id}/detect-batch
+    Content-Type: multipart/form-data
+    files: <image file>
+    files: <image file>
+    ```
+    """
+    session = await run_in_threadpool(get_session_or_404, session_id)
+    
+    with stage('upload'):
+        uploads = [(upload.filename, await read_upload(upload, UPLOAD_MAX_BYTES)) for upload in files]
+    with stage('cache'):
+        image_digests, cache_keys, batch_results = await run_in_threadpool(lookup_results, [data for _, data in uploads], tiled)
+    
+    # Only images not seen before go through the model
+    misses = [i for i, result in enumerate(batch_results) if result is None]
+    if misses:
+        phase = session['phase']
+        try:
+            miss_results = await run_on_inference_pool(run_batch_detection_pipeline, [uploads[i] for i in misses], phase_hashes(session), tiled)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        tag_duplicates(miss_results, phase)
+        new_results = []
+        for i, result in zip(misses, miss_results):
+            if 'duplicate_of_upload' in result:
+                # Position among the misses -> position in the request
+                result['duplicate_of_upload'] = misses[result['duplicate_of_upload']]
+            elif result.get('duplicate_of') is None:
+                new_results.append((cache_keys[i], result))
+            batch_results[i] = result
+        await run_in_threadpool(cache_results, new_results)
+    
+    with stage('record'):
+        session, detections = await run_in_threadpool(
+            update_session_or_404, session_id, lambda session: record_batch(session, batch_results, [data for _, data in uploads], image_digests)
+        )
+    
+    missed = set(misses)
+    results = [
+        {'filename': filename, 'cached': i not in missed, 'detection': detection_result}
+        for i, ((filename, _), detection_result) in enumerate(zip(uploads, detections))
+    ]
+    
+    return await negotiated_response_async({
+        'session_id': session_id,
+        'phase': session['phase'],
+        'detections_count': phase_detections_count(session),
+        'results': results
+    }, accept, [result['detection']['image_index'] for result in results])
+
+@app.post('/api/inspection/{session_id}/detect-video', tags=["Inspection Workflow"], summary="Detect Damages in a Walk-Around Video", response_description="Per-keyframe detection results with annotated images")
+async def detect_damage_in_video(session_id: str, file: UploadFile = File(...), tiled: bool = False, accept: Optional[str] = Header(None)):
+    """
+    Analyze a walk-around video of the vehicle.
+    
+    The video is read frame by frame and only sharp frames showing a new view are kept
+    (see the `VIDEO_*` environment variables): blurred frames, frames taken while the camera
+    moved fast and frames showing the same view as the previous keyframe are skipped.
+    Keyframes run through the model in batches and each one is stored in the session's current
+    phase exactly as if it had been uploaded as a photo, in video order.
+    
+    **Parameters:**
+    - `session_id` (path): The unique session ID from `/api/inspection/start`
+    - `file` (body): Video file (MP4, MOV, WebM, MKV, AVI)
+    - `tiled` (query): `true` for tiled inference on every keyframe, as in `/detect`
+    
+    **Returns:**
+    - `session_id`: Your session ID
+    - `phase`: Current phase (pickup or return)
+    - `detections_count`: Total detections uploaded in current phase
+    - `video`: Frames read (`frames`, `fps`), frames analyzed (`sampled`) and skipped as `blurry`,
+      `moving` or `redundant`, `keyframes` kept, and `truncated` when reading stopped at `VIDEO_MAX_KEYFRAMES`
+    - `results`: List (one entry per keyframe) of objects containing:
+      - `frame`: Frame number in the video
+      - `timestamp`: Position in the video in seconds
+      - `detection`: Same structure as `current_detection` from `/detect`
+    
+    **Response formats** (`Accept` header): As for `/detect-batch`
+    
+    **Errors:**
+    - `400`: The video could not be decoded
+    - `404`: Session not found
+    - `413`: Video larger than `VIDEO_MAX_MB` (or request body larger than `REQUEST_MAX_MB`)
+    - `415`: A file that is not a video
+    - `503`: All inference workers are busy; retry after the `Retry-After` header
+    
+    **Example:**
+    ```
+    POST /api/inspection/{session_id}/detect-video
+    Content-Type: multipart/form-data
+    file: <video file>
+    ```
+    """
+    session = await run_in_threadpool(get_session_or_404, session_id)
+    
+    # The decoder reads the video from disk, a chunk at a time
+    with tempfile.NamedTemporaryFile(suffix='.video') as video_file:
+        with stage('upload'):
+            await save_upload(file, VIDEO_MAX_BYTES, video_file)
+        phase = session['phase']
+        try:
+            video_results, video_stats = await run_on_inference_pool(run_video_pipeline, video_file.name, phase_hashes(session), tiled)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    tag_duplicates(video_results, phase)
+    
+    frames = [(result.pop('frame'), result.pop('timestamp')) for result in video_results]
+    images = [result.pop('image_data') for result in video_results]
+    with stage('record'):
+        session, detections = await run_in_threadpool(
+            update_session_or_404, session_id, lambda session: record_batch(session, video_results, images, [None] * len(images))
+        )
+    
+    results = [
+        {'frame': frame, 'timestamp': timestamp, 'detection': detection_result}
+        for (frame, timestamp), detection_result in zip(frames, detections)
+    ]
+    
+    return await negotiated_response_async({
+        'session_id': session_id,
+        'phase': session['phase'],
+        'detections_count': phase_detections_count(session),
+        'video': video_stats,
+        'results': results
+    }, accept, [result['detection']['image_index'] for result in results])
+
+@app.websocket('/api/inspection/{session_id}/stream')
+async def stream_detections(websocket: WebSocket, session_id: str, images: Literal['full', 'thumb', 'none'] = 'thumb', tiled: bool = False):
+    """
+    Stream photos into the session's current phase over a WebSocket, without waiting for each result.
+    
+    Every binary message is one photo, analyzed and recorded exactly like an upload to `/detect`.
+    Results come back as soon as each photo is done; annotated images follow as separate,
+    lower-priority messages, so they never hold up detections.
+    
+    **Parameters:**
+    - `session_id` (path): Your session ID
+    - `images` (query): Annotated images to send back: `thumb` (default), `full` or `none`
+    - `tiled` (query): `true` for tiled inference on every photo, as in `/detect`
+    
+    **Messages from the server:**
+    - `{"type": "detection", "seq": n, ...}`: Photo n (0-based, in send order) with the fields of a `/detect` response
+    - `{"type": "error", "seq": n, "status": 413|415|503|..., "detail": "..."}`: Photo n was not analyzed
+    - `{"type": "image", "seq": n, "image_index": i, "bytes": size}`, then a binary message with the JPEG
+    - `{"type": "end", "detections_count": n}`: Answer to `{"type": "end"}` once everything was sent; the socket closes
+    
+    **Errors:**
+    - Close code `4404`: Session not found
+    """
+    await websocket.accept()
+    session = await run_in_threadpool(inspection_sessions.get, session_id)
+    if session is None or session['phase'] == 'completed':
+        await websocket.close(code=4404, reason="Session not found")
+        return
+    
+    async def detect(data: bytes) -> dict:
+        check_image(data, UPLOAD_MAX_BYTES)
+        return await detect_and_record(session_id, data, tiled)
+    
+    render = None if images == 'none' else partial(render_session_image, session_id, size=images)
+    await DetectionStream(websocket, detect, render, max_in_flight=STREAM_MAX_IN_FLIGHT).run()
+
+@app.get('/api/inspection/{session_id}/images/{image_index}.jpg', tags=["Inspection Workflow"], summary="Get Annotated Image", response_class=Response, response_description="JPEG image with bounding boxes")
+def get_annotated_image(
+    session_id: str,
+    image_index: int,
+    size: Literal['full', 'thumb'] = 'full',
+    quality: Optional[int] = Query(None, ge=10, le=100),
+    if_none_match: Optional[str] = Header(None)
+):
+    """
+    Download the annotated image for the n-th photo uploaded in a session.
+    
+    Detection results only carry the URL of this image (`annotated_image`). Boxes are
+    drawn on first request and the result is cached, so rendering is only paid for
+    images that are actually viewed. Images stay available after `/complete` until
+    the artifact store evicts them.
+    
+    **Parameters:**
+    - `session_id` (path): Your session ID
+    - `image_index` (path): `image_index` from the detection result (0-based, in upload order)
+    - `size` (query): `full` (original resolution, default) or `thumb` (longest side 320px)
+    - `quality` (query): JPEG quality 10-100 (default 95 for `full`, 75 for `thumb`)
+    
+    **Caching:**
+    - Responses carry an `ETag` derived from the image, its detections and the render options;
+      send it back in `If-None-Match` to get `304 Not Modified` without any rendering
+    """
+    record = session_record(inspection_sessions.get(session_id), image_index)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    
+    digest = record['image_digest']
+    detections = {key: record[key] for key in ('boxes', 'confidences', 'classes')}
+    quality = quality or RENDER_SIZES[size]['quality']
+    key = render_key(digest, detections, RENDER_STYLE, size, quality)
+    
+    etag = f'"{key}"'
+    headers = {'ETag': etag, 'Cache-Control': 'private, max-age=86400, immutable'}
+    if if_none_match is not None and etag in [tag.strip() for tag in if_none_match.split(',')]:
+        return Response(status_code=304, headers=headers)
+    
+    data = render_annotated_image(digest, detections, size, quality)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Image no longer available")
+    
+    return Response(content=data, media_type='image/jpeg', headers=headers)
+
 @app.post('/api/inspection/{session_id}/switch-to-return', tags=["Inspection Workflow"], summary="Switch to Return Phase", response_description="Confirmation of phase switch")
 def switch_to_return_phase(session_id: str):
     """
@@ -368,11 +1548,7 @@ def switch_to_return_phase(session_id: str):
     Response: {"session_id": "...", "message": "Switched to return phase", "pickup_images_count": 3}
     ```
     """
-    if session_id not in inspection_sessions:
-        raise HTTPException(status_code=404, detail="Session not found")
-    
-    session = inspection_sessions[session_id]
-    session['phase'] = 'return'
+    session, _ = update_session_or_404(session_id, lambda session: session.update(phase='return'))
     
     return {
         'session_id': session_id,
@@ -380,8 +1556,44 @@ def switch_to_return_phase(session_id: str):
         'pickup_images_count': len(session['pickup_detections'])
     }
 
+@app.get('/api/inspection/{session_id}/summary', tags=["Inspection Workflow"], summary="Get Inspection Progress", response_description="Running per-phase totals and new damages so far")
+def get_inspection_summary(session_id: str):
+    """
+    Live progress of an inspection, without completing it.
+    
+    The totals are kept up to date as photos are analyzed, so this is cheap to poll
+    from the UI after every upload. New damages are counted as `/complete` does with
+    `count` matching.
+    
+    **Parameters:**
+    - `session_id` (path): Your session ID
+    
+    **Returns:**
+    - `session_id`: Your session ID
+    - `phase`: Current phase (pickup or return)
+    - `pickup_phase`, `return_phase`: Images count, near-duplicate images, total damages, damages by type,
+      repair cost of all its damages (`min`/`max`)
+    - `new_damages_detected`: Same structure as in `/complete`
+    
+    **Errors:**
+    - `404`: Session not found
+    """
+    session = get_session_or_404(session_id)
+    pickup_summary = phase_summary(session, 'pickup')
+    return_summary = phase_summary(session, 'return')
+    
+    return {
+        'session_id': session_id,
+        'phase': session['phase'],
+        'pickup_phase': pickup_summary,
+        'return_phase': return_summary,
+        'new_damages_detected': estimate_new_damages(
+            count_new_damages(pickup_summary['damages_by_type'], return_summary['damages_by_type'])
+        )
+    }
+
 @app.post('/api/inspection/{session_id}/complete', tags=["Inspection Workflow"], summary="Complete Inspection & Get Cost Estimate", response_description="Comparison results and repair cost estimate")
-def complete_inspection(session_id: str):
+def complete_inspection(session_id: str, matching: Optional[Literal['count', 'spatial']] = None, accept: Optional[str] = Header(None)):
     """
     Finalize inspection and retrieve damage comparison and cost estimate.
     
@@ -391,21 +1603,39 @@ def complete_inspection(session_id: str):
     **Smart Comparison:**
     - Only damages detected in return but NOT in pickup phase are charged
     - Duplicates are counted (e.g., 3 dents in return vs 1 in pickup = 2 new dents to charge)
-    - Session is automatically cleaned up after completion
+    - Near-duplicate photos of the same shot (`duplicate_of` set) are only counted once
+    - Session is closed after completion; only its image records are kept for the report URLs
+    
+    **Matching modes:**
+    - `count`: Per damage type, return count minus pickup count is new (default unless `DAMAGE_MATCHING` says otherwise)
+    - `spatial`: Each return photo is aligned with the pickup photo of the same view (ORB keypoints and a
+      RANSAC homography), and a return damage is new only if no pickup damage of the same type overlaps it
+      there. Return photos that match no pickup photo fall back to counting against the unmatched pickup damages
     
     **Parameters:**
     - `session_id` (path): Your session ID
+    - `matching` (query): `count` or `spatial`
     
     **Returns:**
     - `session_id`: Your session ID
     - `inspection_summary`: 
-      - `pickup_phase`: Images count, total damages, damages by type
-      - `return_phase`: Images count, total damages, damages by type
+      - `pickup_phase`: Images count, near-duplicate images, total damages, damages by type, repair cost of all its damages
+      - `return_phase`: Same for the return phase
     - `new_damages_detected`:
       - `total_new_damages`: Count of new damages
       - `damages_breakdown`: List of new damages with cost per unit
       - `estimated_repair_cost`: Min/max/average cost estimate
-    - `return_detections_with_boxes`: Full detection data from return phase
+    - `matching`: Mode used; for `spatial` also `aligned_images` (return photos aligned with a pickup photo)
+      and `matched_damages` (pickup damages found again at the same place)
+    - `return_detections_with_boxes`: Full detection data from return phase (annotated images as URLs);
+      with `spatial` matching each also has `new_damages` (one flag per box) and `aligned_to` (pickup `image_index` or null)
+    
+    **Response formats** (`Accept` header):
+    - `application/json` (default): As described above
+    - `application/vnd.car-damage.compact+json`: Detections as `i` (image index), `c` (class indices into `classes`),
+      `b` (flat box list), `p` (confidences); `repair_costs` once per class and `image_url` as a template instead of per detection
+    - `application/msgpack`: The compact form as MessagePack
+    - `multipart/mixed`: The compact form, followed by the annotated return images as raw JPEG parts (`Content-ID: <image-{i}>`)
     
     **Example Response:**
     ```json
@@ -425,97 +1655,175 @@ def complete_inspection(session_id: str):
     ```
     
     **After calling this endpoint:**
-    - Session is automatically deleted
+    - Session is closed: further uploads get `404`, annotated image URLs keep working until the session expires or the image is evicted
     - To perform another inspection, call `/api/inspection/start` again
     """
-    if session_id not in inspection_sessions:
-        raise HTTPException(status_code=404, detail="Session not found")
-    
-    session = inspection_sessions[session_id]
+    session = get_session_or_404(session_id)
+    matching = matching or DAMAGE_MATCHING
     
-    # Extract all damage types from pickup
-    pickup_damages = []
-    for detection_result in session['pickup_detections']:
-        pickup_damages.extend(detection_result.get('classes', []))
+    # Per-phase totals are kept up to date on every detect (near-duplicates are not counted twice)
+    pickup_summary = phase_summary(session, 'pickup')
+    return_summary = phase_summary(session, 'return')
     
-    # Extract all damage types from return
-    return_damages = []
-    return_detections_with_boxes = []
-    for detection_result in session['return_detections']:
-        return_damages.extend(detection_result.get('classes', []))
-        return_detections_with_boxes.append(detection_result)
+    return_detections_with_boxes = [expand_record(session_id, record) for record in session['return_detections']]
     
     # Find NEW damages: damages in return that weren't in pickup
-    # Count occurrences to handle multiple same damages
-    pickup_damage_counts = {}
-    for dmg in pickup_damages:
-        pickup_damage_counts[dmg] = pickup_damage_counts.get(dmg, 0) + 1
-    
-    return_damage_counts = {}
-    for dmg in return_damages:
-        return_damage_counts[dmg] = return_damage_counts.get(dmg, 0) + 1
-    
-    # Calculate new damages
-    new_damages = []
-    new_damage_counts = {}
-    for damage_type, count in return_damage_counts.items():
-        pickup_count = pickup_damage_counts.get(damage_type, 0)
-        if count > pickup_count:
-            new_count = count - pickup_count
-            new_damages.extend([damage_type] * new_count)
-            new_damage_counts[damage_type] = new_count
-    
-    # Calculate costs for new damages
-    total_min_cost = 0
-    total_max_cost = 0
-    new_damages_breakdown = []
-    
-    for damage_type, count in new_damage_counts.items():
-        cost = REPAIR_COSTS.get(damage_type.lower(), {'min': 100, 'max': 500})
-        total_min_cost += cost['min'] * count
-        total_max_cost += cost['max'] * count
-        new_damages_breakdown.append({
-            'damage_type': damage_type,
-            'count': count,
-            'cost_per_unit': cost
-        })
+    if matching == 'spatial':
+        with stage('matching'):
+            matches = spatial_new_damages(session)
+        new_damage_counts = {}
+        for detection_result in return_detections_with_boxes:
+            detection_result['new_damages'] = matches['new'][detection_result['image_index']]
+            detection_result['aligned_to'] = matches['aligned_to'][detection_result['image_index']]
+            if detection_result.get('duplicate_of') is None:
+                for dmg, is_new in zip(detection_result['classes'], detection_result['new_damages']):
+                    if is_new:
+                        new_damage_counts[dmg] = new_damage_counts.get(dmg, 0) + 1
+        matching_report = {
+            'mode': matching,
+            'aligned_images': sum(1 for pickup_index in matches['aligned_to'].values() if pickup_index is not None),
+            'matched_damages': matches['matched']
+        }
+    else:
+        # Count occurrences to handle multiple same damages
+        new_damage_counts = count_new_damages(pickup_summary['damages_by_type'], return_summary['damages_by_type'])
+        matching_report = {'mode': matching}
     
     # Prepare response
     response = {
         'session_id': session_id,
         'inspection_summary': {
-            'pickup_phase': {
-                'images_uploaded': len(session['pickup_detections']),
-                'total_damages': len(pickup_damages),
-                'damages_by_type': pickup_damage_counts
-            },
-            'return_phase': {
-                'images_uploaded': len(session['return_detections']),
-                'total_damages': len(return_damages),
-                'damages_by_type': return_damage_counts
-            }
-        },
-        'new_damages_detected': {
-            'total_new_damages': len(new_damages),
-            'damages_breakdown': new_damages_breakdown,
-            'estimated_repair_cost': {
-                'min': total_min_cost,
-                'max': total_max_cost,
-                'average': (total_min_cost + total_max_cost) // 2
-            }
+            'pickup_phase': pickup_summary,
+            'return_phase': return_summary
         },
+        'new_damages_detected': estimate_new_damages(new_damage_counts),
+        'matching': matching_report,
         'return_detections_with_boxes': return_detections_with_boxes
     }
     
-    # Cleanup session
-    del inspection_sessions[session_id]
+    # Only what the report's image URLs need is kept, until the session expires
+    def close(session: Dict):
+        for key in set(session) - {'session_id', 'pickup_detections', 'return_detections'}:
+            del session[key]
+        session['phase'] = 'completed'
+    update_session_or_404(session_id, close)
     
-    return response
+    return negotiated_response(response, accept, [record['image_index'] for record in return_detections_with_boxes])
 
 
+@app.get('/api/inference/stats', tags=["Monitoring"], summary="Inference Scheduler Statistics", response_description="Queue depth and batch-size histograms")
+def inference_stats():
+    """
+    Report how the micro-batching scheduler in front of the model is behaving.
+    
+    Use these numbers to tune the trade-off between latency and throughput via the
+    `INFERENCE_MAX_BATCH_SIZE` and `INFERENCE_MAX_WAIT_MS` environment variables.
+    
+    **Returns:**
+    - `max_batch_size`, `max_wait_ms`: Current scheduler settings
+    - `queue_depth`: Images currently waiting for a batch
+    - `requests_total`, `batches_total`, `average_batch_size`: Lifetime counters
+    - `batch_size_histogram`: Number of batches run per batch size
+    - `queue_depth_histogram`: Images left waiting each time a batch was dispatched
+    - `executor`: Inference worker pool size, in-flight requests and 503 rejections
+    - `model_workers`: Model worker processes (only when `INFERENCE_MODEL_WORKERS` is set)
+    - `sessions`: Session store backend, live session count and their serialized size
+    - `artifacts`, `render_cache`: Stored uploads and rendered annotated images (size, hit rate)
+    - `result_cache`: Cached detection results (size, hit rate, disk tier)
+    - `postprocess`: Active threshold preset and its thresholds and caps
+    - `backend`: Inference backend running the model and its thread settings (once loaded)
+    - `model`: Model load state, as in `/health/ready`
+    """
+    stats = scheduler.stats()
+    # Not loading the model just to describe it
+    stats['backend'] = detection.model.describe() if detection.loaded else {'backend': INFERENCE_BACKEND}
+    stats['model'] = model_loader.status()
+    stats['postprocess'] = {'preset': DETECTION_PRESET, **detection.postprocess}
+    stats['executor'] = inference_pool.stats()
+    if model_pool is not None:
+        stats['model_workers'] = model_pool.stats()
+    stats['sessions'] = inspection_sessions.stats()
+    stats['artifacts'] = artifacts.stats()
+    stats['render_cache'] = render_cache.stats()
+    stats['result_cache'] = result_cache.stats()
+    return stats
+
+
+INFERENCE_IN_FLIGHT = metrics.Gauge('car_damage_inference_in_flight', 'Requests running or waiting on the inference pool')
+INFERENCE_QUEUE_DEPTH = metrics.Gauge('car_damage_inference_queue_depth', 'Images waiting for the batching scheduler')
+SESSIONS = metrics.Gauge('car_damage_sessions', 'Live inspection sessions')
+SESSION_STORE_BYTES = metrics.Gauge('car_damage_session_store_bytes', 'Serialized size of the live inspection sessions')
+
+@app.get('/metrics', tags=["Monitoring"], summary="Prometheus Metrics", response_class=Response, response_description="Metrics in the Prometheus text format")
+def prometheus_metrics():
+    """
+    Latency histograms and load gauges for Prometheus to scrape.
+    
+    Each API worker process reports its own metrics.
+    
+    **Histograms:**
+    - `car_damage_stage_seconds{stage}`: Time per pipeline stage: `upload`, `cache`, `decode`, `hash`, `inference`
+      (in turn `queue`, `preprocess`, `forward`, `postprocess` with the in-process model), `record`, `matching`,
+      `encode`, `render`. Batch stages are counted once per batch
+    - `car_damage_request_seconds{method,route,status}`: Whole request latency per route
+    
+    **Gauges:**
+    - `car_damage_inference_in_flight`: Requests running or waiting on the inference pool
+    - `car_damage_inference_queue_depth`: Images waiting for the batching scheduler
+    - `car_damage_sessions`: Live inspection sessions
+    - `car_damage_session_store_bytes`: Serialized size of the live sessions
+    
+    **Per-request breakdown:** Send `X-Timing: 1` with any request (or set `SERVER_TIMING=1`) to get its stages
+    in a `Server-Timing` response header, in milliseconds, e.g. `decode;dur=4.10, forward;dur=38.52, total;dur=51.07`
+    """
+    session_stats = inspection_sessions.stats()
+    INFERENCE_IN_FLIGHT.set(inference_pool.in_flight)
+    INFERENCE_QUEUE_DEPTH.set(scheduler.stats()['queue_depth'])
+    SESSIONS.set(session_stats['sessions'])
+    SESSION_STORE_BYTES.set(session_stats['bytes_used'])
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get('/health/live', tags=["Monitoring"], summary="Liveness Probe", response_description="Whether the process is serving")
+async def liveness():
+    """
+    Liveness probe: answers as long as the server is serving requests, whatever the model's
+    state. Restart the instance when this fails. A model that failed to load is reported by
+    `/health/ready` instead, since restarting would not fix it (e.g. a bad model path).
+    """
+    return {'status': 'alive'}
+
+@app.get('/health/ready', tags=["Monitoring"], summary="Readiness Probe", response_description="Whether the model is loaded and warmed up")
+def readiness():
+    """
+    Readiness probe: route traffic to this instance once it answers 200.
+    
+    The model is loaded and warmed up after startup (see `MODEL_LOAD`); until then the
+    instance answers 503 so no request has to wait for it. With `MODEL_LOAD=lazy` the
+    instance is ready right away and the first request loads the model.
+    
+    **Returns:**
+    - `status`: `ready` or `not_ready`
+    - `model`: Load `state` (`not_loaded`, `loading`, `ready`, `failed`), `mode`,
+      `load_seconds` (load plus warm-up) and the `error` of a failed load
+    - `model_workers`: Model worker processes (only when `INFERENCE_MODEL_WORKERS` is set)
+    
+    **Errors:**
+    - `503`: Not ready yet, with the same body
+    """
+    ready = model_loader.ready
+    body = {'status': None, 'model': model_loader.status()}
+    if model_pool is not None:
+        body['model_workers'] = model_pool.stats()
+        # A worker that died after warming up takes its share of the work with it
+        if model_loader.state == 'ready':
+            ready = body['model_workers']['workers_alive'] == model_pool.num_workers
+    body['status'] = 'ready' if ready else 'not_ready'
+    return body if ready else JSONResponse(body, status_code=503)
 
 
 if __name__ == '__main__':
+    import uvicorn
     uvicorn.run("main:app", host="127.0.0.1", port=8000)
 
 
@@ -0,0 +1,228 @@
+"""
+Spatial matching of return-phase damages against pickup-phase damages.
+
+Count matching (the original `/complete` behaviour) charges any surplus of a
+damage class in return over pickup, wherever the boxes are. Spatial matching
+asks, for each damage found at return, whether it was already there at pickup:
+
+1. Each return photo is aligned with a pickup photo of the same view. The
+   candidates are the pickup photos with the closest perceptual hashes; a
+   candidate is confirmed by ORB keypoint matches and a RANSAC homography
+   with enough inliers (the one with most inliers wins).
+2. The pickup boxes are projected into the return photo through that
+   homography and assigned to the return boxes of the same class by Hungarian
+   assignment on IoU. Return boxes assigned with IoU >= min_iou are
+   pre-existing damage, the others are new.
+3. Return photos no pickup photo aligns with (another view, or the images were
+   evicted from the artifact store) fall back to count matching against the
+   pickup damages step 2 did not claim.
+
+Keypoints are computed once per photo and each return photo only tries a few
+candidates, so the cost grows linearly with the number of photos. Assignment is
+cubic, but only in the number of boxes of one class in one pair of photos.
+"""
+
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from numpy import ndarray
+
+from duplicates import hamming
+
+# (keypoint coordinates, ORB descriptors, (x, y) factors from decoded to original coordinates)
+Features = Tuple[ndarray, ndarray, Tuple[float, float]]
+
+# Lowe's ratio test for keypoint matches, RANSAC reprojection error in decoded pixels
+MATCH_RATIO = 0.75
+RANSAC_THRESHOLD = 5.0
+
+
+def iou_matrix(boxes_a: List[List[int]], boxes_b: List[List[int]]) -> ndarray:
+    """Pairwise IoU of two lists of ltwh boxes"""
+    a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 4)
+    b = np.asarray(boxes_b, dtype=np.float64).reshape(-1, 4)
+    inter_w = np.clip(np.minimum(a[:, None, 0] + a[:, None, 2], b[None, :, 0] + b[None, :, 2]) - np.maximum(a[:, None, 0], b[None, :, 0]), 0, None)
+    inter_h = np.clip(np.minimum(a[:, None, 1] + a[:, None, 3], b[None, :, 1] + b[None, :, 3]) - np.maximum(a[:, None, 1], b[None, :, 1]), 0, None)
+    inter = inter_w * inter_h
+    union = (a[:, 2] * a[:, 3])[:, None] + (b[:, 2] * b[:, 3])[None, :] - inter
+    return np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+
+
+def linear_assignment(cost: ndarray) -> List[Tuple[int, int]]:
+    """Minimum cost one-to-one assignment of rows to columns (Hungarian algorithm, O(n^2 m))"""
+    cost = np.asarray(cost, dtype=np.float64)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n, m = cost.shape
+
+    # Potentials u (rows) and v (columns); p[j] is the row assigned to column j, 1-based with 0 as a sentinel
+    u, v = np.zeros(n + 1), np.zeros(m + 1)
+    p, way = np.zeros(m + 1, dtype=int), np.zeros(m + 1, dtype=int)
+    for i in range(1, n + 1):
+        p[0], j0 = i, 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while p[j0] != 0:
+            used[j0] = True
+            reduced = cost[p[j0] - 1] - u[p[j0]] - v[1:]
+            free = ~used[1:]
+            improve = free & (reduced < minv[1:])
+            minv[1:][improve] = reduced[improve]
+            way[1:][improve] = j0
+
+            candidates = np.where(free, minv[1:], np.inf)
+            j1 = int(np.argmin(candidates)) + 1
+            delta = candidates[j1 - 1]
+            u[p[used]] += delta
+            v[used] -= delta
+            minv[1:][free] -= delta
+            j0 = j1
+        # Augment along the alternating path back to the sentinel
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+
+    pairs = [(int(p[j]) - 1, j - 1) for j in range(1, m + 1) if p[j]]
+    return sorted((j, i) for i, j in pairs) if transposed else sorted(pairs)
+
+
+def match_boxes(reference_boxes, reference_classes, boxes, classes, min_iou: float) -> List[Tuple[int, int]]:
+    """Same-class (reference, candidate) index pairs with the highest total IoU, each pair at least min_iou"""
+    pairs = []
+    for damage_type in set(reference_classes) & set(classes):
+        rows = [i for i, c in enumerate(reference_classes) if c == damage_type]
+        cols = [j for j, c in enumerate(classes) if c == damage_type]
+        overlap = iou_matrix([reference_boxes[i] for i in rows], [boxes[j] for j in cols])
+        for r, c in linear_assignment(1 - overlap):
+            if overlap[r, c] >= min_iou:
+                pairs.append((rows[r], cols[c]))
+    return sorted(pairs)
+
+
+def project_boxes(boxes: List[List[int]], homography: ndarray) -> List[List[int]]:
+    """Bounding boxes of ltwh boxes mapped through a homography"""
+    if not boxes:
+        return []
+    b = np.asarray(boxes, dtype=np.float64)
+    corners = np.stack([
+        b[:, :2],
+        b[:, :2] + b[:, 2:] * [1, 0],
+        b[:, :2] + b[:, 2:],
+        b[:, :2] + b[:, 2:] * [0, 1]
+    ], axis=1)
+    projected = cv2.perspectiveTransform(corners.reshape(-1, 1, 2), homography).reshape(-1, 4, 2)
+    low, high = np.rint(projected.min(axis=1)), np.rint(projected.max(axis=1))
+    return [[int(x), int(y), int(w), int(h)] for (x, y), (w, h) in zip(low, high - low)]
+
+
+def image_features(image: ndarray, scale: Tuple[float, float] = (1.0, 1.0), max_features: int = 1000) -> Optional[Features]:
+    """ORB keypoints of a decoded photo; None if it has too little texture to align"""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    keypoints, descriptors = cv2.ORB_create(nfeatures=max_features).detectAndCompute(gray, None)
+    if descriptors is None or len(keypoints) < 2:
+        return None
+    return np.float32([keypoint.pt for keypoint in keypoints]), descriptors, scale
+
+
+def estimate_homography(source: Features, target: Features, min_inliers: int) -> Tuple[Optional[ndarray], int]:
+    """Homography from source to target original coordinates, and its RANSAC inlier count"""
+    matches = cv2.BFMatcher(cv2.NORM_HAMMING).knnMatch(source[1], target[1], k=2)
+    good = [m[0] for m in matches if len(m) == 2 and m[0].distance < MATCH_RATIO * m[1].distance]
+    if len(good) < max(min_inliers, 4):
+        return None, 0
+
+    src = source[0][[m.queryIdx for m in good]]
+    dst = target[0][[m.trainIdx for m in good]]
+    # USAC stops early on pairs that clearly do not match, where plain RANSAC runs all its iterations
+    homography, mask = cv2.findHomography(src, dst, cv2.USAC_DEFAULT, RANSAC_THRESHOLD)
+    inliers = int(mask.sum()) if mask is not None else 0
+    if homography is None or inliers < min_inliers:
+        return None, inliers
+
+    # Keypoints are in decoded coordinates, boxes in original ones
+    to_original = np.diag([target[2][0], target[2][1], 1.0])
+    from_original = np.diag([1 / source[2][0], 1 / source[2][1], 1.0])
+    return to_original @ homography @ from_original, inliers
+
+
+def nearest_photos(record: dict, photos: List[dict], count: int) -> List[dict]:
+    """The count photos with perceptual hashes closest to the record's (unhashed photos last)"""
+    def distance(photo):
+        if record.get('image_hash') is None or photo.get('image_hash') is None:
+            return 65
+        return hamming(record['image_hash'], photo['image_hash'])
+    return sorted(photos, key=distance)[:count]
+
+
+def match_inspection(
+    pickup: List[dict],
+    returns: List[dict],
+    load_features: Callable[[int], Optional[Features]],
+    candidates: int = 3,
+    min_iou: float = 0.3,
+    min_inliers: int = 15
+) -> Dict:
+    """
+    Decide which return damages are new.
+
+    `pickup` and `returns` are session detection records (`image_index`, `image_hash`,
+    `boxes`, `classes`) of distinct photos; `load_features` returns the keypoints of a
+    photo by image index, or None if it is no longer available.
+
+    Returns `new` (return image index -> one flag per box), `aligned_to` (return image
+    index -> pickup image index, or None) and `matched` (boxes matched spatially).
+    """
+    features = {}
+
+    def features_of(image_index):
+        if image_index not in features:
+            features[image_index] = load_features(image_index)
+        return features[image_index]
+
+    new, aligned_to, unaligned, claimed = {}, {}, [], set()
+    for record in returns:
+        image_index = record['image_index']
+        target, best = features_of(image_index), None
+        if target is not None:
+            for candidate in nearest_photos(record, pickup, candidates):
+                source = features_of(candidate['image_index'])
+                if source is None:
+                    continue
+                homography, inliers = estimate_homography(source, target, min_inliers)
+                if homography is not None and (best is None or inliers > best[2]):
+                    best = (candidate, homography, inliers)
+
+        if best is None:
+            aligned_to[image_index] = None
+            unaligned.append(record)
+            continue
+
+        candidate, homography, _ = best
+        aligned_to[image_index] = candidate['image_index']
+        projected = project_boxes(candidate['boxes'], homography)
+        flags = [True] * len(record['classes'])
+        for i, j in match_boxes(projected, candidate['classes'], record['boxes'], record['classes'], min_iou):
+            flags[j] = False
+            claimed.add((candidate['image_index'], i))
+        new[image_index] = flags
+
+    matched = len(claimed)
+    remaining = Counter(
+        damage_type
+        for record in pickup
+        for i, damage_type in enumerate(record['classes'])
+        if (record['image_index'], i) not in claimed
+    )
+    for record in unaligned:
+        flags = []
+        for damage_type in record['classes']:
+            flags.append(remaining[damage_type] == 0)
+            if remaining[damage_type]:
+                remaining[damage_type] -= 1
+        new[record['image_index']] = flags
+
+    return {'new': new, 'aligned_to': aligned_to, 'matched': matched}
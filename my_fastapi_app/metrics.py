@@ -0,0 +1,205 @@
+"""
+Per-stage latency metrics, exposed in the Prometheus text format.
+
+stage(name) times a block of work into the `car_damage_stage_seconds` histogram
+and, while a request is being served, into that request's own breakdown (a
+stage run several times in one request, e.g. decoding each image of a batch,
+adds up). The breakdown follows the request onto the inference pool threads;
+the batching scheduler adds the time a request waited in its queue (`queue`)
+and the stages of the batch it ran in. Stages can nest: `inference` covers the
+whole wait for the model, `queue`, `preprocess`, `forward` and `postprocess`
+break it down when the model runs in-process, and `postprocess` is split into
+`decode_output` (candidates from the raw output) and `nms`.
+
+TimingMiddleware times every HTTP request into `car_damage_request_seconds`
+by route, and answers with a `Server-Timing` header carrying the breakdown when
+the request asks for it (`X-Timing: 1`) or when it is always on.
+
+Metrics live in the process that records them: with several API workers each
+one is scraped on its own, and stages run inside model worker processes
+(INFERENCE_MODEL_WORKERS, INFERENCE_EXECUTOR=process) only show up as the
+`inference` stage around them.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Tuple
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds; from a fast NMS pass up to a large batch on a busy CPU
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics: List = []
+
+# Stage name -> seconds for the request being served, None outside of one
+_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar('timings', default=None)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # Label values -> [count per bucket (not cumulative), sum, count]
+        self._series: Dict[Tuple, List] = {}
+        _metrics.append(self)
+
+    def observe(self, labels: Tuple, seconds: float):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += seconds
+            series[2] += 1
+
+    def snapshot(self) -> Dict[Tuple, Dict]:
+        """Label values -> cumulative bucket counts, sum and count"""
+        with self._lock:
+            series = {labels: (list(buckets), total, count) for labels, (buckets, total, count) in self._series.items()}
+        snapshot = {}
+        for labels, (buckets, total, count) in series.items():
+            cumulative, running = {}, 0
+            for bound, bucket_count in zip(self.buckets, buckets):
+                running += bucket_count
+                cumulative[bound] = running
+            snapshot[labels] = {'buckets': cumulative, 'sum': total, 'count': count}
+        return snapshot
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for labels, series in sorted(self.snapshot().items()):
+            for bound, count in list(series['buckets'].items()) + [('+Inf', series['count'])]:
+                bucket_labels = _format_labels(self.labelnames, labels, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(series['sum'])}")
+            lines.append(f"{self.name}_count{label_text} {series['count']}")
+        return lines
+
+
+class Gauge:
+    """A value set when the metrics are scraped"""
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0.0
+        _metrics.append(self)
+
+    def set(self, value: float):
+        self.value = value
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge', f'{self.name} {_format_value(self.value)}']
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format"""
+    return '\n'.join(line for metric in _metrics for line in metric.render()) + '\n'
+
+
+STAGE_SECONDS = Histogram('car_damage_stage_seconds', 'Time spent per pipeline stage', ('stage',))
+REQUEST_SECONDS = Histogram('car_damage_request_seconds', 'HTTP request latency by route', ('method', 'route', 'status'))
+
+
+def current_timings() -> Optional[Dict[str, float]]:
+    return _timings.get()
+
+
+def add_timing(timings: Optional[Dict[str, float]], name: str, seconds: float):
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+def observe(name: str, seconds: float):
+    STAGE_SECONDS.observe((name,), seconds)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe(name, elapsed)
+        add_timing(_timings.get(), name, elapsed)
+
+
+@contextmanager
+def collect() -> Iterator[Dict[str, float]]:
+    """Collect the stages run inside the block into a new breakdown"""
+    timings = {}
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+def server_timing(timings: Dict[str, float], total: float) -> str:
+    """Server-Timing header value, durations in milliseconds"""
+    entries = [f'{name};dur={seconds * 1000:.2f}' for name, seconds in timings.items()]
+    entries.append(f'total;dur={total * 1000:.2f}')
+    return ', '.join(entries)
+
+
+class TimingMiddleware:
+    """ASGI middleware timing HTTP requests, with an opt-in Server-Timing header"""
+
+    def __init__(self, app, always: bool = False):
+        self.app = app
+        self.always = always
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        requested = dict(scope['headers']).get(b'x-timing', b'').strip().lower() not in (b'', b'0', b'false', b'no')
+        send_header = self.always or requested
+        start = time.perf_counter()
+        status = 500
+
+        async def timed_send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                if send_header:
+                    value = server_timing(timings, time.perf_counter() - start)
+                    message = dict(message, headers=list(message.get('headers', [])) + [
+                        (b'server-timing', value.encode()),
+                        (b'timing-allow-origin', b'*')
+                    ])
+            await send(message)
+
+        with collect() as timings:
+            try:
+                await self.app(scope, receive, timed_send)
+            finally:
+                # Route templates rather than paths, so session ids do not become label values
+                route = scope.get('route')
+                REQUEST_SECONDS.observe(
+                    (scope['method'], getattr(route, 'path', 'unmatched'), status),
+                    time.perf_counter() - start
+                )
@@ -0,0 +1,139 @@
+"""
+Content-addressed cache of detection results.
+
+Retried and re-sent uploads are the same bytes, so their detections are looked
+up by the SHA-256 of the upload combined with a fingerprint of everything else
+that affects the result (model file, post-processing thresholds, decode size).
+A hit skips decode and inference entirely.
+
+Results live in a byte-bounded in-memory LRU, optionally backed by a directory
+on disk (one small JSON file per result, oldest evicted first) so the cache
+survives restarts and is shared by processes on the same host.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from typing import Callable, Dict, Optional, Union
+
+from artifacts import ByteLRU
+
+RESULT_KEYS = ('boxes', 'confidences', 'classes', 'image_hash', 'image_size', 'tiles')
+
+
+def fingerprint(model_path: str, settings: Dict) -> str:
+    """Digest of the model weights and the settings that shape its results"""
+    digest = hashlib.sha256()
+    with open(model_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class DiskTier:
+    """Directory of cached results, bounded by total size (oldest files evicted first)"""
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.bytes_used = sum(entry.stat().st_size for entry in os.scandir(path) if entry.name.endswith('.json'))
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.json")
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._file(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, data: bytes):
+        target = self._file(key)
+        if os.path.exists(target):
+            return
+        # Write then rename, so readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, target)
+
+        with self._lock:
+            self.bytes_used += len(data)
+            if self.bytes_used > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        entries = sorted(
+            (entry for entry in os.scandir(self.path) if entry.name.endswith('.json')),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        self.bytes_used = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self.bytes_used <= self.max_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self.bytes_used -= size
+            except FileNotFoundError:
+                pass
+
+
+class ResultCache:
+    def __init__(self, fingerprint: Union[str, Callable[[], str]], max_bytes: int = 32 * 1024 * 1024, disk_path: Optional[str] = None, disk_max_bytes: int = 512 * 1024 * 1024):
+        # A callable is only called on first use, so creating the cache does not read the model
+        self._fingerprint = fingerprint
+        self._fingerprint_lock = threading.Lock()
+        self._memory = ByteLRU(max_bytes)
+        self._disk = DiskTier(disk_path, disk_max_bytes) if disk_path else None
+        self.disk_hits = 0
+
+    @property
+    def fingerprint(self) -> str:
+        if callable(self._fingerprint):
+            with self._fingerprint_lock:
+                if callable(self._fingerprint):
+                    self._fingerprint = self._fingerprint()
+        return self._fingerprint
+
+    def key(self, image_digest: str, mode: Optional[str] = None) -> str:
+        """Cache key of an image's results; `mode` tells apart results of other inference modes (e.g. tiled)"""
+        material = f"{image_digest}:{self.fingerprint}" + (f":{mode}" if mode else '')
+        return hashlib.sha256(material.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        data = self._memory.get(key)
+        if data is None and self._disk is not None:
+            data = self._disk.get(key)
+            if data is not None:
+                self.disk_hits += 1
+                self._memory.put(key, data)
+        return json.loads(data) if data is not None else None
+
+    def put(self, key: str, results: dict):
+        data = json.dumps({k: results[k] for k in RESULT_KEYS if k in results}, separators=(',', ':')).encode()
+        self._memory.put(key, data)
+        if self._disk is not None:
+            self._disk.put(key, data)
+
+    def stats(self) -> Dict:
+        stats = self._memory.stats()
+        lookups = stats['hits'] + stats['misses']
+        # A memory miss served from disk still counts as a cache hit
+        hits = stats['hits'] + self.disk_hits
+        stats['memory_hit_rate'] = stats['hit_rate']
+        stats['hit_rate'] = hits / lookups if lookups else 0.0
+        if self._disk is not None:
+            stats['disk'] = {
+                'path': self._disk.path,
+                'bytes_used': self._disk.bytes_used,
+                'max_bytes': self._disk.max_bytes,
+                'hits': self.disk_hits
+            }
+        return stats
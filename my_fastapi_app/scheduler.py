@@ -0,0 +1,140 @@
+"""
+Dynamic micro-batching scheduler for the shared Detection engine.
+
+Requests arriving within a short window are collected into one batch and run
+as a single batched forward pass on a dedicated thread, so concurrent callers
+share the model instead of queueing for it one at a time. Since all inference
+goes through this one thread, the underlying cv2.dnn.Net is never used from
+two threads at once.
+"""
+
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from typing import Dict, List
+
+from numpy import ndarray
+
+import metrics
+
+
+class _Request:
+    __slots__ = ('image', 'future', 'queued_at', 'timings')
+
+    def __init__(self, image: ndarray):
+        self.image = image
+        self.future: Future = Future()
+        self.queued_at = time.perf_counter()
+        # Breakdown of the request being served by the submitting thread, if any
+        self.timings = metrics.current_timings()
+
+
+class BatchScheduler:
+    def __init__(self, detection, max_batch_size: int = 8, max_wait_ms: float = 10.0):
+        self.detection = detection
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait_ms = max(0.0, float(max_wait_ms))
+
+        self._queue: "queue.Queue[_Request]" = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+        # Tuning statistics: how full batches get and how much work is waiting
+        self.requests_total = 0
+        self.batches_total = 0
+        self.batch_size_histogram: Counter = Counter()
+        self.queue_depth_histogram: Counter = Counter()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='batch-scheduler', daemon=True)
+                self._thread.start()
+
+    def submit(self, image: ndarray) -> Future:
+        """Queue one image for detection; the future resolves to its results dict"""
+        self.start()
+        request = _Request(image)
+        self._queue.put(request)
+        return request.future
+
+    def detect(self, image: ndarray, return_annotated: bool = False) -> dict:
+        """Blocking single-image detection through the batching queue"""
+        results = self.submit(image).result()
+        # Annotation only needs the decoded boxes, so it runs on the caller's
+        # thread instead of holding up the next batch
+        if return_annotated:
+            results['annotated_image'] = self.detection.annotate(image, results)
+        return results
+
+    def detect_batch(self, images: List[ndarray], return_annotated: bool = False) -> List[dict]:
+        futures = [self.submit(image) for image in images]
+        batch_results = [future.result() for future in futures]
+        if return_annotated:
+            for image, results in zip(images, batch_results):
+                results['annotated_image'] = self.detection.annotate(image, results)
+        return batch_results
+
+    def _collect(self) -> List[_Request]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait_ms / 1000.0
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+
+            self.requests_total += len(batch)
+            self.batches_total += 1
+            self.batch_size_histogram[len(batch)] += 1
+            self.queue_depth_histogram[self._queue.qsize()] += 1
+
+            # Images of one /detect-batch call share a breakdown; it gets the longest wait and the batch stages once
+            started, waits = time.perf_counter(), {}
+            for request in batch:
+                wait = started - request.queued_at
+                metrics.observe('queue', wait)
+                if request.timings is not None:
+                    previous = waits.get(id(request.timings), (None, 0.0))[1]
+                    waits[id(request.timings)] = (request.timings, max(previous, wait))
+
+            try:
+                with metrics.collect() as batch_timings:
+                    batch_results = self.detection.detect_batch([request.image for request in batch])
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            finally:
+                for timings, wait in waits.values():
+                    metrics.add_timing(timings, 'queue', wait)
+                    for name, seconds in batch_timings.items():
+                        metrics.add_timing(timings, name, seconds)
+
+            for request, results in zip(batch, batch_results):
+                request.future.set_result(results)
+
+    def stats(self) -> Dict:
+        return {
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait_ms,
+            'queue_depth': self._queue.qsize(),
+            'requests_total': self.requests_total,
+            'batches_total': self.batches_total,
+            'average_batch_size': self.requests_total / self.batches_total if self.batches_total else 0.0,
+            'batch_size_histogram': dict(sorted(self.batch_size_histogram.items())),
+            'queue_depth_histogram': dict(sorted(self.queue_depth_histogram.items()))
+        }
@@ -0,0 +1,320 @@
+"""
+Session stores for inspection sessions.
+
+Endpoints talk to a SessionStore instead of a bare dict: `create`, `get`,
+`save`, `update` and `delete`. `update` applies a change to the latest copy of
+a session and saves it atomically, so concurrent uploads to one session do not
+overwrite each other's records. MemorySessionStore keeps sessions in-process
+with a sliding TTL and a max-size LRU bound, so abandoned sessions are freed;
+like the other stores it hands out copies, never the stored session itself.
+RedisSessionStore keeps them in any Redis-protocol server (shared between API
+workers), serialized compactly: class names become indices, boxes a flat list
+and confidences are rounded; updates use optimistic locking (WATCH/MULTI).
+"""
+
+import copy
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+DETECTION_LISTS = ('pickup_detections', 'return_detections')
+
+
+class SessionStore:
+    """Interface shared by all session stores"""
+
+    def create(self, session: Dict):
+        self.save(session)
+
+    def get(self, session_id: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    def save(self, session: Dict):
+        raise NotImplementedError
+
+    def update(self, session_id: str, change: Callable[[Dict], Any]) -> Optional[Tuple[Dict, Any]]:
+        """
+        Apply `change` to the latest copy of a session and save it, atomically with respect
+        to other updates; returns the session and what `change` returned, None if there is
+        no such session. `change` may run more than once, so it should only modify the session.
+        """
+        raise NotImplementedError
+
+    def delete(self, session_id: str):
+        raise NotImplementedError
+
+    def stats(self) -> Dict:
+        raise NotImplementedError
+
+    def __contains__(self, session_id: str) -> bool:
+        return self.get(session_id) is not None
+
+    def __getitem__(self, session_id: str) -> Dict:
+        session = self.get(session_id)
+        if session is None:
+            raise KeyError(session_id)
+        return session
+
+
+class MemorySessionStore(SessionStore):
+    def __init__(self, ttl_seconds: float = 6 * 3600, max_sessions: int = 10000):
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        # Ordered by last access, so expired and least recently used sessions are at the front;
+        # entries are [expires_at, session, serialized size, (records, their size) per detection list]
+        self._sessions: "OrderedDict[str, List]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes_used = 0
+        self.expired_total = 0
+        self.evicted_total = 0
+
+    def _evict(self, now: float):
+        while self._sessions:
+            session_id, (expires_at, _, size, _) = next(iter(self._sessions.items()))
+            if expires_at > now:
+                break
+            del self._sessions[session_id]
+            self.bytes_used -= size
+            self.expired_total += 1
+
+        while len(self._sessions) > self.max_sessions:
+            self.bytes_used -= self._sessions.popitem(last=False)[1][2]
+            self.evicted_total += 1
+
+    def get(self, session_id: str) -> Optional[Dict]:
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            entry[0] = now + self.ttl_seconds
+            self._sessions.move_to_end(session_id)
+            # A copy, like the other stores return: changes only land through save or update
+            return copy.deepcopy(entry[1])
+
+    @staticmethod
+    def _size(session: Dict, counted: Optional[Dict]) -> Tuple[int, Dict]:
+        """
+        JSON size of a session, standing in for the memory it holds. Detection lists only
+        grow, so only the records added since the last save are serialized.
+        """
+        size = len(json.dumps({k: v for k, v in session.items() if k not in DETECTION_LISTS}, separators=(',', ':'), default=str))
+        counts = {}
+        for key in DETECTION_LISTS:
+            records = session.get(key, [])
+            count, records_size = (counted or {}).get(key, (0, 0))
+            if count > len(records):
+                count, records_size = 0, 0
+            records_size += sum(len(json.dumps(record, separators=(',', ':'), default=str)) + 1 for record in records[count:])
+            counts[key] = (len(records), records_size)
+            size += records_size
+        return size, counts
+
+    def _save(self, session: Dict, now: float):
+        previous = self._sessions.get(session['session_id'])
+        size, counts = self._size(session, previous[3] if previous is not None else None)
+        if previous is not None:
+            self.bytes_used -= previous[2]
+        self._sessions[session['session_id']] = [now + self.ttl_seconds, session, size, counts]
+        self.bytes_used += size
+        self._sessions.move_to_end(session['session_id'])
+        self._evict(now)
+
+    def save(self, session: Dict):
+        session = copy.deepcopy(session)
+        with self._lock:
+            self._save(session, time.monotonic())
+
+    def update(self, session_id: str, change: Callable[[Dict], Any]) -> Optional[Tuple[Dict, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            # Changed on a copy, so a change that raises halfway leaves the stored session as it was
+            session = copy.deepcopy(entry[1])
+            result = change(session)
+            self._save(session, now)
+            return copy.deepcopy(session), result
+
+    def delete(self, session_id: str):
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            if entry is not None:
+                self.bytes_used -= entry[2]
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            self._evict(time.monotonic())
+            return {
+                'backend': 'memory',
+                'sessions': len(self._sessions),
+                'bytes_used': self.bytes_used,
+                'max_sessions': self.max_sessions,
+                'ttl_seconds': self.ttl_seconds,
+                'expired_total': self.expired_total,
+                'evicted_total': self.evicted_total
+            }
+
+
+def pack_record(record: Dict, class_ids: Dict[str, int]) -> Dict:
+    """Detection record with class indices, a flat box list and rounded confidences"""
+    return {
+        'i': record.get('image_index'),
+        'c': [class_ids[name] for name in record['classes']],
+        'b': [v for box in record['boxes'] for v in box],
+        'p': [round(conf, 2) for conf in record['confidences']],
+        # Anything else recorded alongside the detections is kept as-is
+        **{k: v for k, v in record.items() if k not in ('image_index', 'classes', 'boxes', 'confidences')}
+    }
+
+
+def unpack_record(packed: Dict, classes: List[str]) -> Dict:
+    packed = dict(packed)
+    flat = packed.pop('b')
+    record = {
+        'boxes': [flat[i:i + 4] for i in range(0, len(flat), 4)],
+        'confidences': packed.pop('p'),
+        'classes': [classes[i] for i in packed.pop('c')],
+        'image_index': packed.pop('i')
+    }
+    record.update(packed)
+    return record
+
+
+def pack_session(session: Dict, classes: List[str]) -> bytes:
+    """Serialize a session with detection records in compact form"""
+    class_ids = {name: i for i, name in enumerate(classes)}
+    packed = dict(session)
+    for key in DETECTION_LISTS:
+        packed[key] = [pack_record(record, class_ids) for record in session.get(key, [])]
+    return json.dumps(packed, separators=(',', ':')).encode()
+
+
+def unpack_session(data: bytes, classes: List[str]) -> Dict:
+    session = json.loads(data)
+    for key in DETECTION_LISTS:
+        session[key] = [unpack_record(packed, classes) for packed in session.get(key, [])]
+    return session
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Sessions in a Redis-protocol store (redis.Redis, fakeredis, ...), one key
+    per session with the TTL refreshed on every write. Writes go through
+    WATCH/MULTI on the session key and are retried when another API worker
+    wrote the session in between.
+
+    Session count and total size are kept next to the sessions (a sorted set
+    of expiry times, a hash of sizes and a byte counter), so stats() does not
+    scan every key; sessions that expired are taken off them on the next call.
+    """
+
+    def __init__(self, client, classes: List[str], ttl_seconds: float = 6 * 3600, prefix: str = 'inspection:'):
+        self.client = client
+        self.classes = classes
+        self.ttl_seconds = int(ttl_seconds)
+        self.prefix = prefix
+        self._expiry_key = f"{prefix}~expiry"
+        self._size_key = f"{prefix}~size"
+        self._bytes_key = f"{prefix}~bytes"
+
+    def _key(self, session_id: str) -> str:
+        return f"{self.prefix}{session_id}"
+
+    def get(self, session_id: str) -> Optional[Dict]:
+        data = self.client.get(self._key(session_id))
+        if data is None:
+            return None
+        return unpack_session(data, self.classes)
+
+    def _write(self, session_id: str, change: Callable[[Optional[Dict]], Tuple[Optional[Dict], Any]]):
+        """
+        Read a session under WATCH, write (or delete, for None) what `change` makes of it
+        in a transaction, retrying if the session was written in between
+        """
+        from redis.exceptions import WatchError
+
+        key = self._key(session_id)
+        with self.client.pipeline() as pipeline:
+            while True:
+                try:
+                    pipeline.watch(key)
+                    data = pipeline.get(key)
+                    old_size = int(pipeline.hget(self._size_key, session_id) or 0) if data is not None else 0
+                    session, result = change(unpack_session(data, self.classes) if data is not None else None)
+
+                    pipeline.multi()
+                    if session is None:
+                        pipeline.delete(key)
+                        pipeline.zrem(self._expiry_key, session_id)
+                        pipeline.hdel(self._size_key, session_id)
+                        pipeline.decrby(self._bytes_key, old_size)
+                    else:
+                        packed = pack_session(session, self.classes)
+                        pipeline.set(key, packed, ex=self.ttl_seconds)
+                        pipeline.zadd(self._expiry_key, {session_id: time.time() + self.ttl_seconds})
+                        pipeline.hset(self._size_key, session_id, len(packed))
+                        pipeline.incrby(self._bytes_key, len(packed) - old_size)
+                    pipeline.execute()
+                    return result
+                except WatchError:
+                    continue
+
+    def save(self, session: Dict):
+        self._write(session['session_id'], lambda _: (session, None))
+
+    def update(self, session_id: str, change: Callable[[Dict], Any]) -> Optional[Tuple[Dict, Any]]:
+        def apply(session: Optional[Dict]):
+            if session is None:
+                return None, None
+            return session, (session, change(session))
+        return self._write(session_id, apply)
+
+    def delete(self, session_id: str):
+        self._write(session_id, lambda _: (None, None))
+
+    def __contains__(self, session_id: str) -> bool:
+        return bool(self.client.exists(self._key(session_id)))
+
+    def _forget_expired(self):
+        """Take sessions that expired on their own off the count and byte total"""
+        from redis.exceptions import WatchError
+
+        with self.client.pipeline() as pipeline:
+            while True:
+                try:
+                    pipeline.watch(self._expiry_key)
+                    expired = pipeline.zrangebyscore(self._expiry_key, '-inf', time.time())
+                    if not expired:
+                        pipeline.unwatch()
+                        return
+                    sizes = pipeline.hmget(self._size_key, expired)
+                    pipeline.multi()
+                    pipeline.zrem(self._expiry_key, *expired)
+                    pipeline.hdel(self._size_key, *expired)
+                    pipeline.decrby(self._bytes_key, sum(int(size or 0) for size in sizes))
+                    pipeline.execute()
+                    return
+                except WatchError:
+                    continue
+
+    def __len__(self) -> int:
+        self._forget_expired()
+        return self.client.zcard(self._expiry_key)
+
+    def stats(self) -> Dict:
+        self._forget_expired()
+        return {
+            'backend': 'redis',
+            'sessions': self.client.zcard(self._expiry_key),
+            'bytes_used': int(self.client.get(self._bytes_key) or 0),
+            'ttl_seconds': self.ttl_seconds
+        }
@@ -0,0 +1,72 @@
+"""
+Model loading and warm-up, off the import path.
+
+Importing the app no longer builds the model: Detection loads its backend on
+first use, and ModelLoader runs the load plus a warm-up forward pass (graph
+initialization, memory arena allocation) once, either in the background while
+the server already answers liveness probes, before the server accepts requests,
+or not at all until the first request needs the model. Its state backs the
+readiness endpoint.
+"""
+
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+LOAD_MODES = ('background', 'startup', 'lazy')
+
+
+class ModelLoader:
+    def __init__(self, load: Callable[[], None], mode: str = 'background', loaded: Optional[Callable[[], bool]] = None):
+        if mode not in LOAD_MODES:
+            raise ValueError(f"Unknown model load mode: {mode} (expected one of {', '.join(LOAD_MODES)})")
+        self._load = load
+        # Tells whether the model got loaded some other way, e.g. by the first request in lazy mode
+        self._loaded = loaded
+        self.mode = mode
+        self.state = 'not_loaded'
+        self.error: Optional[str] = None
+        self.load_seconds: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def load(self) -> bool:
+        """Load and warm up the model unless already done, return whether it is ready"""
+        with self._lock:
+            if self.state == 'ready':
+                return True
+            self.state, self.error = 'loading', None
+            start = time.perf_counter()
+            try:
+                self._load()
+            except Exception as e:
+                self.state, self.error = 'failed', f"{type(e).__name__}: {e}"
+                return False
+            self.state, self.load_seconds = 'ready', time.perf_counter() - start
+            return True
+
+    def start(self):
+        """Load in a background thread"""
+        with self._lock:
+            if self.state != 'not_loaded':
+                return
+            self.state = 'loading'
+        threading.Thread(target=self.load, name='model-loader', daemon=True).start()
+
+    def _check_loaded(self):
+        if self.state == 'not_loaded' and self._loaded is not None and self._loaded():
+            self.state = 'ready'
+
+    @property
+    def ready(self) -> bool:
+        self._check_loaded()
+        # Lazily loaded models are served on demand, so the app takes traffic right away
+        return self.state == 'ready' or (self.mode == 'lazy' and self.state == 'not_loaded')
+
+    def status(self) -> Dict:
+        self._check_loaded()
+        status = {'state': self.state, 'mode': self.mode}
+        if self.load_seconds is not None:
+            status['load_seconds'] = round(self.load_seconds, 3)
+        if self.error is not None:
+            status['error'] = self.error
+        return status
@@ -0,0 +1,127 @@
+"""
+WebSocket protocol for streaming photos into an inspection session.
+
+The client sends each photo as a binary message and keeps sending without
+waiting for results. Up to `max_in_flight` photos are analyzed at once (the
+socket is not read further until one finishes, so a fast client is throttled
+rather than buffered). The server answers in completion order:
+
+- `{"type": "detection", "seq": n, ...}` as soon as photo n (0-based, in send
+  order) is analyzed, with the same fields as a `/detect` response.
+- `{"type": "error", "seq": n, "status": ..., "detail": ...}` if it could not be.
+- `{"type": "image", "seq": n, "image_index": i, "bytes": size}` followed by a
+  binary message with the annotated JPEG. Images are lower priority: they are
+  only sent while no detection or error message is waiting.
+- `{"type": "end", "detections_count": ...}` after the client sent
+  `{"type": "end"}` and all its photos and images were answered; the server
+  then closes the socket.
+"""
+
+import asyncio
+import itertools
+import json
+import logging
+from typing import Awaitable, Callable, Optional
+
+from fastapi import HTTPException, WebSocket
+from starlette.concurrency import run_in_threadpool
+
+DETECTION_PRIORITY, IMAGE_PRIORITY, END_PRIORITY = 0, 1, 2
+
+logger = logging.getLogger(__name__)
+
+
+class DetectionStream:
+    def __init__(
+        self,
+        websocket: WebSocket,
+        detect: Callable[[bytes], Awaitable[dict]],
+        render: Optional[Callable[[int], Optional[bytes]]],
+        max_in_flight: int = 8
+    ):
+        self.websocket = websocket
+        self.detect = detect
+        self.render = render
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._outbox = asyncio.PriorityQueue()
+        self._order = itertools.count()
+        self._tasks = set()
+        self.detections_count = 0
+
+    def _post(self, priority: int, messages):
+        # The counter keeps messages of equal priority in order (and never compares the messages)
+        self._outbox.put_nowait((priority, next(self._order), messages))
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send_loop(self):
+        while True:
+            _, _, messages = await self._outbox.get()
+            if messages is None:
+                return
+            for message in messages:
+                if isinstance(message, bytes):
+                    await self.websocket.send_bytes(message)
+                else:
+                    await self.websocket.send_text(json.dumps(message, separators=(',', ':')))
+
+    async def _process(self, seq: int, data: bytes):
+        try:
+            reply = await self.detect(data)
+        except HTTPException as e:
+            self._post(DETECTION_PRIORITY, [{'type': 'error', 'seq': seq, 'status': e.status_code, 'detail': e.detail}])
+            return
+        except Exception:
+            # A server fault, not the client's: logged and answered like an HTTP endpoint would
+            logger.exception("Streamed photo %d failed", seq)
+            self._post(DETECTION_PRIORITY, [{'type': 'error', 'seq': seq, 'status': 500, 'detail': 'Internal Server Error'}])
+            return
+        finally:
+            self._slots.release()
+
+        # Photos finish out of order, the last one recorded has the highest count
+        self.detections_count = max(self.detections_count, reply.get('detections_count', 0))
+        self._post(DETECTION_PRIORITY, [{'type': 'detection', 'seq': seq, **reply}])
+        if self.render is not None:
+            self._spawn(self._send_image(seq, reply['current_detection']['image_index']))
+
+    async def _send_image(self, seq: int, image_index: int):
+        data = await run_in_threadpool(self.render, image_index)
+        if data is not None:
+            self._post(IMAGE_PRIORITY, [{'type': 'image', 'seq': seq, 'image_index': image_index, 'bytes': len(data)}, data])
+
+    async def run(self):
+        sender = asyncio.create_task(self._send_loop())
+        seq = 0
+        try:
+            while True:
+                # Stop reading until a slot frees up, so the client is throttled by the socket
+                await self._slots.acquire()
+                message = await self.websocket.receive()
+                if message['type'] == 'websocket.disconnect':
+                    return
+                if message.get('bytes') is not None:
+                    self._spawn(self._process(seq, message['bytes']))
+                    seq += 1
+                    continue
+
+                self._slots.release()
+                try:
+                    request = json.loads(message.get('text') or '{}')
+                except ValueError:
+                    request = {}
+                if request.get('type') == 'end':
+                    break
+
+            while self._tasks:
+                await asyncio.gather(*list(self._tasks))
+            self._post(END_PRIORITY, [{'type': 'end', 'detections_count': self.detections_count}])
+            self._post(END_PRIORITY, None)
+            await sender
+            await self.websocket.close()
+        finally:
+            for task in list(self._tasks) + [sender]:
+                task.cancel()
@@ -8,10 +8,34 @@ import pytest
 import json
 import io
 import os
+import subprocess
+import sys
+import asyncio
+import threading
+import time
+from fastapi import FastAPI, File, UploadFile, WebSocketDisconnect
 from fastapi.testclient import TestClient
+from starlette.formparsers import MultiPartParser
 from PIL import Image
 import numpy as np
-from main import app, inspection_sessions
+import cv2
+from main import app, inspection_sessions, detection
+from scheduler import BatchScheduler
+from workers import InferencePool, ModelProcessPool, PoolSaturated
+from functools import partial
+import main
+from artifacts import ArtifactStore, RedisArtifactStore
+from sessions import MemorySessionStore, RedisSessionStore, pack_session, unpack_record, unpack_session
+from result_cache import ResultCache
+from duplicates import HASHES, find_duplicate, hamming, phash
+from matching import image_features, linear_assignment, match_boxes, match_inspection, project_boxes
+from uploads import BodySizeLimitMiddleware, sniff_image_type, sniff_video_type, spooling_route_class
+from tiling import merge_detections, tile_grid
+from video import empty_video_stats, select_keyframes
+from startup import ModelLoader
+import formats
+import metrics
+import msgpack
 
 
 client = TestClient(app)
@@ -143,6 +167,1146 @@ class TestDetectionEndpoint:
         assert len(current_detection["confidences"]) == len(current_detection["classes"])
 
 
+class TestDetectionStream:
+    """Test the WebSocket upload stream"""
+
+    def create_dummy_image(self, color):
+        img_bytes = io.BytesIO()
+        Image.new("RGB", (320, 240), color=color).save(img_bytes, format="JPEG")
+        return img_bytes.getvalue()
+
+    def run_stream(self, session_id, frames, images="thumb"):
+        """Send all frames up front, then collect messages until the server ends the stream"""
+        messages = []
+        with client.websocket_connect(f"/api/inspection/{session_id}/stream?images={images}") as ws:
+            for frame in frames:
+                ws.send_bytes(frame)
+            ws.send_json({"type": "end"})
+            while True:
+                message = ws.receive()
+                if message.get("bytes") is not None:
+                    messages.append(message["bytes"])
+                    continue
+                messages.append(json.loads(message["text"]))
+                if messages[-1]["type"] == "end":
+                    return messages
+
+    def test_stream_detections_and_images(self):
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        frames = [self.create_dummy_image(color) for color in ("red", "green", "blue")]
+        messages = self.run_stream(session_id, frames[:2] + [b"not an image"] + frames[2:])
+
+        detections = {m["seq"]: m for m in messages if isinstance(m, dict) and m["type"] == "detection"}
+        errors = [m for m in messages if isinstance(m, dict) and m["type"] == "error"]
+        assert sorted(detections) == [0, 1, 3]
+        assert errors == [{"type": "error", "seq": 2, "status": 415, "detail": errors[0]["detail"]}]
+        assert {d["current_detection"]["image_index"] for d in detections.values()} == {0, 1, 2}
+        assert messages[-1] == {"type": "end", "detections_count": 3}
+        assert len(inspection_sessions[session_id]["pickup_detections"]) == 3
+
+        # Each image header is followed by its JPEG
+        headers = [i for i, m in enumerate(messages) if isinstance(m, dict) and m["type"] == "image"]
+        assert len(headers) == 3
+        for i in headers:
+            assert messages[i + 1][:2] == b"\xff\xd8"
+            assert len(messages[i + 1]) == messages[i]["bytes"]
+
+    def test_stream_without_images(self):
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        messages = self.run_stream(session_id, [self.create_dummy_image("white")], images="none")
+        assert [m["type"] for m in messages] == ["detection", "end"]
+
+    def test_stream_server_fault_is_500(self, monkeypatch, caplog):
+        """Unexpected failures are logged and reported as server errors, not as bad photos"""
+        async def broken(*args):
+            raise RuntimeError("pool crashed")
+        monkeypatch.setattr(main, "detect_and_record", broken)
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        messages = self.run_stream(session_id, [self.create_dummy_image("white")], images="none")
+        assert messages[0] == {"type": "error", "seq": 0, "status": 500, "detail": "Internal Server Error"}
+        assert "pool crashed" in caplog.text
+
+    def test_stream_unknown_session(self):
+        with pytest.raises(WebSocketDisconnect) as closed:
+            with client.websocket_connect("/api/inspection/invalid-session-id/stream") as ws:
+                ws.receive_json()
+        assert closed.value.code == 4404
+
+
+class TestModelLoading:
+    """Test lazy model loading, warm-up and the health probes"""
+
+    def test_detection_loads_model_on_first_use(self):
+        engine = main.Detection(model_path=main.MODEL_PATH, classes=main.DAMAGE_CLASSES)
+        assert not engine.loaded
+        engine.warm_up()
+        assert engine.loaded
+        # A missing model only fails once it is needed
+        missing = main.Detection(model_path="missing.onnx", classes=main.DAMAGE_CLASSES)
+        with pytest.raises(Exception):
+            missing.warm_up()
+
+    def test_import_does_not_read_model(self):
+        """Importing the app neither loads nor hashes the model file"""
+        script = (
+            "import builtins, io, sys\n"
+            "opened = []\n"
+            "real_open = io.open\n"
+            "def recording_open(file, *args, **kwargs):\n"
+            "    opened.append(str(file))\n"
+            "    return real_open(file, *args, **kwargs)\n"
+            "builtins.open = io.open = recording_open\n"
+            "import main\n"
+            "print(any(name.endswith('.onnx') for name in opened), main.detection.loaded)\n"
+        )
+        output = subprocess.run(
+            [sys.executable, "-c", script], cwd=os.path.dirname(os.path.abspath(main.__file__)),
+            capture_output=True, text=True, timeout=60
+        ).stdout
+        assert output.split() == ["False", "False"]
+
+    def test_warm_up_waits_for_running_forward(self):
+        """Warm-up on the loader thread never runs the backend alongside the scheduler thread"""
+        class SlowBackend:
+            running = peak = 0
+            def forward(self, blob):
+                SlowBackend.running += 1
+                SlowBackend.peak = max(SlowBackend.peak, SlowBackend.running)
+                time.sleep(0.02)
+                SlowBackend.running -= 1
+                return np.zeros((len(blob), 12, 8400), dtype=np.float32)
+
+        engine = main.Detection(model_path=main.MODEL_PATH, classes=main.DAMAGE_CLASSES)
+        engine._model = SlowBackend()
+        threads = [threading.Thread(target=engine.warm_up) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        engine.detect_batch([np.zeros((64, 64, 3), dtype=np.uint8)])
+        for thread in threads:
+            thread.join()
+        assert SlowBackend.peak == 1
+
+    def test_lazy_load_updates_state(self):
+        engine = main.Detection(model_path=main.MODEL_PATH, classes=main.DAMAGE_CLASSES)
+        loader = ModelLoader(engine.warm_up, mode="lazy", loaded=lambda: engine.loaded)
+        assert loader.status()["state"] == "not_loaded"
+        # The first request loads the model without going through the loader
+        engine.detect_batch([np.zeros((64, 64, 3), dtype=np.uint8)])
+        assert loader.status()["state"] == "ready"
+        assert loader.ready
+
+    def test_ready_after_startup_load(self, monkeypatch):
+        monkeypatch.setattr(main, "model_loader", ModelLoader(main.load_model, mode="startup"))
+        with TestClient(app) as started:
+            response = started.get("/health/ready")
+            assert response.status_code == 200
+            assert response.json()["model"]["state"] == "ready"
+            assert response.json()["model"]["load_seconds"] >= 0
+            assert started.get("/health/live").json() == {"status": "alive"}
+
+    def test_not_ready_while_loading_in_background(self, monkeypatch):
+        release = threading.Event()
+        loader = ModelLoader(lambda: release.wait(5), mode="background")
+        monkeypatch.setattr(main, "model_loader", loader)
+        with TestClient(app) as started:
+            response = started.get("/health/ready")
+            assert response.status_code == 503
+            assert response.json()["model"]["state"] == "loading"
+            # Alive while loading, so the instance is not restarted
+            assert started.get("/health/live").status_code == 200
+            release.set()
+            for _ in range(100):
+                if loader.state == "ready":
+                    break
+                time.sleep(0.01)
+            assert started.get("/health/ready").status_code == 200
+
+    def test_failed_load(self, monkeypatch):
+        def fail():
+            raise RuntimeError("model file is corrupt")
+        loader = ModelLoader(fail, mode="background")
+        loader.load()
+        monkeypatch.setattr(main, "model_loader", loader)
+        response = client.get("/health/ready")
+        assert response.status_code == 503
+        assert response.json()["model"]["error"] == "RuntimeError: model file is corrupt"
+        # Restarting would not fix a bad model: the process stays live, just never ready
+        assert client.get("/health/live").status_code == 200
+
+    def test_lazy_mode_is_ready_before_loading(self, monkeypatch):
+        monkeypatch.setattr(main, "model_loader", ModelLoader(main.load_model, mode="lazy"))
+        response = client.get("/health/ready")
+        assert response.status_code == 200
+        assert response.json()["model"]["state"] == "not_loaded"
+        with pytest.raises(ValueError):
+            ModelLoader(main.load_model, mode="eager")
+
+
+class TestMetrics:
+    """Test the per-stage timers, /metrics and the Server-Timing header"""
+
+    def create_noise_image(self, seed):
+        # Noise, so neither the result cache nor duplicate detection skips the model
+        pixels = np.random.default_rng(seed).integers(0, 256, (240, 320, 3), dtype=np.uint8)
+        img_bytes = io.BytesIO()
+        Image.fromarray(pixels).save(img_bytes, format="JPEG")
+        return img_bytes.getvalue()
+
+    def test_metrics_exposes_stage_histograms_and_gauges(self):
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        client.post(f"/api/inspection/{session_id}/detect", files={"file": ("car.jpg", self.create_noise_image(1), "image/jpeg")})
+
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+        text = response.text
+        for name in ("upload", "cache", "decode", "hash", "inference", "queue", "preprocess", "forward", "postprocess", "decode_output", "nms", "record"):
+            assert f'car_damage_stage_seconds_count{{stage="{name}"}}' in text
+        assert 'car_damage_request_seconds_count{method="POST",route="/api/inspection/{session_id}/detect",status="200"}' in text
+        assert session_id not in text
+        for gauge in ("inference_in_flight", "inference_queue_depth", "sessions", "session_store_bytes"):
+            assert f"\ncar_damage_{gauge} " in text
+
+    def test_histogram_buckets_are_cumulative(self):
+        before = metrics.STAGE_SECONDS.snapshot().get(("test-stage",), {"count": 0})["count"]
+        metrics.observe("test-stage", 0.003)
+        metrics.observe("test-stage", 0.2)
+        series = metrics.STAGE_SECONDS.snapshot()[("test-stage",)]
+        assert series["count"] == before + 2
+        assert series["buckets"][0.0025] == 0
+        assert series["buckets"][0.005] == 1
+        assert series["buckets"][10.0] == 2
+
+    def test_server_timing_header_is_opt_in(self):
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        plain = client.post(f"/api/inspection/{session_id}/detect", files={"file": ("a.jpg", self.create_noise_image(2), "image/jpeg")})
+        assert "server-timing" not in plain.headers
+
+        timed = client.post(
+            f"/api/inspection/{session_id}/detect",
+            files={"file": ("b.jpg", self.create_noise_image(3), "image/jpeg")},
+            headers={"X-Timing": "1"}
+        )
+        assert timed.status_code == 200
+        stages = dict(entry.split(";dur=") for entry in timed.headers["server-timing"].split(", "))
+        # Stages run on the inference pool and the scheduler thread are part of the request's breakdown
+        assert {"upload", "cache", "decode", "inference", "queue", "forward", "postprocess", "record", "total"} <= set(stages)
+        assert float(stages["forward"]) <= float(stages["inference"]) <= float(stages["total"])
+
+    def test_batch_stages_counted_once_per_request(self):
+        scheduler = BatchScheduler(detection, max_batch_size=4, max_wait_ms=50)
+        images = [np.zeros((64, 64, 3), dtype=np.uint8)] * 3
+        with metrics.collect() as timings:
+            scheduler.detect_batch(images)
+        # nms only runs when some candidate clears the score threshold
+        assert set(timings) - {"nms"} == {"queue", "preprocess", "forward", "postprocess", "decode_output"}
+        assert timings["forward"] < 10
+
+    def test_session_store_bytes(self):
+        store = MemorySessionStore(ttl_seconds=60, max_sessions=1)
+        store.save({"session_id": "a", "pickup_detections": []})
+        size = store.stats()["bytes_used"]
+        assert size > 0
+        store.save({"session_id": "a", "pickup_detections": [{"image_index": 0}]})
+        assert store.stats()["bytes_used"] > size
+        store.save({"session_id": "b", "pickup_detections": []})
+        assert store.stats()["bytes_used"] == size
+        store.delete("b")
+        assert store.stats()["bytes_used"] == 0
+
+        fakeredis = pytest.importorskip("fakeredis")
+        redis_store = RedisSessionStore(fakeredis.FakeRedis(), classes=main.DAMAGE_CLASSES, ttl_seconds=60)
+        redis_store.save({"session_id": "a", "pickup_detections": []})
+        assert redis_store.stats()["sessions"] == 1
+        assert redis_store.stats()["bytes_used"] == len(pack_session({"session_id": "a", "pickup_detections": []}, main.DAMAGE_CLASSES))
+
+
+class TestAnnotatedImages:
+    """Test annotated images served from the artifact store"""
+
+    def create_dummy_image(self):
+        img = Image.new("RGB", (640, 480), color="orange")
+        img_bytes = io.BytesIO()
+        img.save(img_bytes, format="PNG")
+        img_bytes.seek(0)
+        return img_bytes
+
+    def upload(self, session_id):
+        response = client.post(
+            f"/api/inspection/{session_id}/detect",
+            files={"file": ("test.png", self.create_dummy_image(), "image/png")}
+        )
+        return response.json()["current_detection"]
+
+    def test_session_keeps_compact_records(self):
+        """Sessions store image URLs, not base64 data"""
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        current = self.upload(session_id)
+
+        assert current["annotated_image"] == f"/api/inspection/{session_id}/images/0.jpg"
+        stored = inspection_sessions[session_id]["pickup_detections"][0]
+        assert set(stored) == {"boxes", "confidences", "classes", "image_index", "image_digest", "image_hash", "image_size"}
+
+    def test_get_annotated_image_with_etag(self):
+        """Images are served as JPEG with an ETag and honour If-None-Match"""
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        self.upload(session_id)
+        current = self.upload(session_id)
+        assert current["image_index"] == 1
+
+        response = client.get(current["annotated_image"])
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "image/jpeg"
+        assert response.content[:2] == b"\xff\xd8"
+        etag = response.headers["ETag"]
+
+        response = client.get(current["annotated_image"], headers={"If-None-Match": etag})
+        assert response.status_code == 304
+
+    def test_images_available_after_complete(self):
+        """Report image URLs keep working after the session is cleaned up"""
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        client.post(f"/api/inspection/{session_id}/switch-to-return")
+        self.upload(session_id)
+        report = client.post(f"/api/inspection/{session_id}/complete").json()
+
+        url = report["return_detections_with_boxes"][0]["annotated_image"]
+        assert client.get(url).status_code == 200
+
+    def test_unknown_image_returns_404(self):
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        response = client.get(f"/api/inspection/{session_id}/images/5.jpg")
+        assert response.status_code == 404
+
+    def test_artifact_store_is_bounded(self):
+        """Least recently used images are evicted beyond the byte budget"""
+        store = ArtifactStore(max_bytes=250)
+        digests = [store.put(bytes([i]) * 100) for i in range(4)]
+
+        assert store.stats()["bytes_used"] <= 250
+        assert store.get(digests[0]) is None
+        assert store.get(digests[3]) == bytes([3]) * 100
+
+        # Identical content is stored once
+        store.put(bytes([3]) * 100)
+        assert store.stats()["items"] == 2
+
+    def test_redis_artifacts_shared_between_workers(self):
+        """A photo uploaded through one worker can be read by another"""
+        fakeredis = pytest.importorskip("fakeredis")
+        server = fakeredis.FakeServer()
+        worker_a = RedisArtifactStore(fakeredis.FakeRedis(server=server), ttl_seconds=60)
+        worker_b = RedisArtifactStore(fakeredis.FakeRedis(server=server), ttl_seconds=60)
+
+        digest = worker_a.put(b"photo")
+        assert worker_b.get(digest) == b"photo"
+        assert worker_a.put(b"photo") == digest
+        assert 0 < worker_b.client.ttl(f"artifact:{digest}") <= 60
+        assert worker_b.get("missing") is None
+        assert worker_b.stats()["hits"] == 1 and worker_b.stats()["misses"] == 1
+
+    def test_image_index_comes_from_session(self):
+        """Indices and image digests live in the session, whatever other sessions do in between"""
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        first = self.upload(session_id)
+        for _ in range(3):
+            self.upload(client.post("/api/inspection/start").json()["session_id"])
+        img_bytes = io.BytesIO()
+        Image.new("RGB", (300, 200), color=(200, 30, 30)).save(img_bytes, format="JPEG")
+        second = client.post(f"/api/inspection/{session_id}/detect", files={"file": ("red.jpg", img_bytes.getvalue(), "image/jpeg")}).json()["current_detection"]
+
+        assert (first["image_index"], second["image_index"]) == (0, 1)
+        records = inspection_sessions.get(session_id)["pickup_detections"]
+        assert [len(record["image_digest"]) for record in records] == [64, 64]
+        assert "image_digest" not in second
+        images = [client.get(f"/api/inspection/{session_id}/images/{i}.jpg") for i in (0, 1)]
+        assert [image.status_code for image in images] == [200, 200]
+        sizes = [Image.open(io.BytesIO(image.content)).size for image in images]
+        assert sizes[1] == (300, 200) and sizes[0] != sizes[1]
+
+    def test_render_is_lazy_and_cached(self):
+        """Nothing is rendered at detect time; each variant renders once"""
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        before = main.render_cache.stats()
+        current = self.upload(session_id)
+        assert main.render_cache.stats()["items"] == before["items"]
+
+        first = client.get(current["annotated_image"])
+        rendered = main.render_cache.stats()
+        second = client.get(current["annotated_image"])
+        assert first.content == second.content
+        assert first.headers["ETag"] == second.headers["ETag"]
+        assert main.render_cache.stats()["hits"] == rendered["hits"] + 1
+        assert main.render_cache.stats()["items"] == rendered["items"]
+
+    def test_thumbnail_variant(self):
+        """size=thumb returns a smaller image with its own ETag"""
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        current = self.upload(session_id)
+
+        full = client.get(current["annotated_image"])
+        thumb = client.get(current["annotated_image"], params={"size": "thumb"})
+        assert thumb.status_code == 200
+        assert thumb.headers["ETag"] != full.headers["ETag"]
+        assert max(Image.open(io.BytesIO(thumb.content)).size) == 320
+        assert Image.open(io.BytesIO(full.content)).size == (640, 480)
+
+        response = client.get(current["annotated_image"], params={"size": "huge"})
+        assert response.status_code == 422
+
+
+class TestBatchDetection:
+    """Test batched multi-image inference"""
+
+    def create_dummy_image(self, color, size=(640, 480)):
+        img = Image.new("RGB", size, color=color)
+        img_bytes = io.BytesIO()
+        img.save(img_bytes, format="PNG")
+        img_bytes.seek(0)
+        return img_bytes
+
+    def test_detect_batch_matches_single_image_calls(self):
+        """One batched forward pass gives the same results as per-image calls"""
+        images = [
+            np.full((480, 640, 3), 40, dtype=np.uint8),
+            np.random.default_rng(0).integers(0, 255, (720, 1280, 3), dtype=np.uint8),
+        ]
+        batch_results = detection.detect_batch(images)
+        assert len(batch_results) == 2
+        for image, results in zip(images, batch_results):
+            single = detection(image)
+            assert results["classes"] == single["classes"]
+            assert results["boxes"] == single["boxes"]
+            assert np.allclose(results["confidences"], single["confidences"], atol=1e-3)
+
+    def test_detect_batch_endpoint(self):
+        """Batch endpoint returns one result per upload and stores each in the session"""
+        response = client.post("/api/inspection/start")
+        session_id = response.json()["session_id"]
+
+        response = client.post(
+            f"/api/inspection/{session_id}/detect-batch",
+            files=[
+                ("files", ("a.png", self.create_dummy_image("red"), "image/png")),
+                ("files", ("b.png", self.create_dummy_image("blue"), "image/png")),
+                ("files", ("c.png", self.create_dummy_image("white"), "image/png")),
+            ]
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert data["phase"] == "pickup"
+        assert data["detections_count"] == 3
+        assert [r["filename"] for r in data["results"]] == ["a.png", "b.png", "c.png"]
+        for result in data["results"]:
+            assert "annotated_image" in result["detection"]
+            assert len(result["detection"]["repair_costs"]) == len(result["detection"]["classes"])
+        assert len(inspection_sessions[session_id]["pickup_detections"]) == 3
+
+    def test_detect_batch_without_session(self):
+        """Batch detection on non-existent session returns 404"""
+        response = client.post(
+            "/api/inspection/invalid-session-id/detect-batch",
+            files=[("files", ("a.png", self.create_dummy_image("red"), "image/png"))]
+        )
+        assert response.status_code == 404
+
+
+class TestResultCache:
+    """Test the content-addressed detection result cache"""
+
+    def create_dummy_image(self, color):
+        img = Image.new("RGB", (320, 240), color=color)
+        img_bytes = io.BytesIO()
+        img.save(img_bytes, format="PNG")
+        return img_bytes.getvalue()
+
+    def test_reupload_skips_inference(self, monkeypatch):
+        """The same bytes uploaded twice run the model once and are recorded twice"""
+        monkeypatch.setattr(main, "result_cache", ResultCache(main.result_cache.fingerprint))
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        data = self.create_dummy_image("purple")
+
+        first = client.post(f"/api/inspection/{session_id}/detect", files={"file": ("a.png", data, "image/png")}).json()
+        assert first["cached"] is False
+
+        def fail(*args):
+            raise AssertionError("inference should not run for a cached image")
+        monkeypatch.setattr(main, "run_detection_pipeline", fail)
+
+        second = client.post(f"/api/inspection/{session_id}/detect", files={"file": ("a.png", data, "image/png")}).json()
+        assert second["cached"] is True
+        assert second["detections_count"] == 2
+        assert second["current_detection"]["image_index"] == 1
+        assert second["current_detection"]["classes"] == first["current_detection"]["classes"]
+        assert main.result_cache.stats()["hit_rate"] == 0.5
+
+    def test_batch_only_runs_misses(self, monkeypatch):
+        monkeypatch.setattr(main, "result_cache", ResultCache(main.result_cache.fingerprint))
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        seen = self.create_dummy_image("navy")
+        client.post(f"/api/inspection/{session_id}/detect", files={"file": ("a.png", seen, "image/png")})
+
+        response = client.post(
+            f"/api/inspection/{session_id}/detect-batch",
+            files=[
+                ("files", ("a.png", seen, "image/png")),
+                ("files", ("b.png", self.create_dummy_image("teal"), "image/png")),
+            ]
+        )
+        assert [r["cached"] for r in response.json()["results"]] == [True, False]
+        assert response.json()["detections_count"] == 3
+
+    def test_fingerprint_separates_settings(self):
+        """Results cached under other thresholds or another model are not reused"""
+        results = {"boxes": [[1, 2, 3, 4]], "confidences": [50.0], "classes": ["dent"]}
+        cache = ResultCache("model-a")
+        cache.put(cache.key("digest"), results)
+        assert cache.get(cache.key("digest")) == results
+        other = ResultCache("model-b")
+        assert other.key("digest") != cache.key("digest")
+
+    def test_disk_tier_survives_restart(self, tmp_path):
+        results = {"boxes": [[1, 2, 3, 4]], "confidences": [50.0], "classes": ["dent"]}
+        cache = ResultCache("model", disk_path=str(tmp_path))
+        cache.put(cache.key("digest"), results)
+
+        restarted = ResultCache("model", disk_path=str(tmp_path))
+        assert restarted.get(restarted.key("digest")) == results
+        assert restarted.stats()["disk"]["hits"] == 1
+        assert restarted.stats()["hit_rate"] == 1.0
+
+    def test_disk_tier_is_bounded(self, tmp_path):
+        results = {"boxes": [[1, 2, 3, 4]], "confidences": [50.0], "classes": ["dent"]}
+        cache = ResultCache("model", disk_path=str(tmp_path), disk_max_bytes=300)
+        for i in range(20):
+            cache.put(cache.key(f"digest-{i}"), results)
+        stored = [path for path in tmp_path.iterdir() if path.suffix == ".json"]
+        assert sum(path.stat().st_size for path in stored) <= 300
+        assert 0 < len(stored) < 20
+
+
+class TestNearDuplicates:
+    """Test perceptual near-duplicate detection within a phase"""
+
+    def create_textured_image(self, seed, size=(320, 240), fmt="PNG", quality=95):
+        cells = np.random.default_rng(seed).integers(0, 255, (6, 8, 3), dtype=np.uint8)
+        img = Image.fromarray(cells).resize(size, Image.BILINEAR)
+        img_bytes = io.BytesIO()
+        img.save(img_bytes, format=fmt, quality=quality)
+        return img_bytes.getvalue()
+
+    def upload(self, session_id, data):
+        return client.post(f"/api/inspection/{session_id}/detect", files={"file": ("a.jpg", data, "image/jpeg")}).json()
+
+    def test_hashes_tolerate_reencoding(self):
+        original = main.decode_image(self.create_textured_image(1))[0]
+        reencoded = main.decode_image(self.create_textured_image(1, size=(480, 360), fmt="JPEG", quality=60))[0]
+        different = main.decode_image(self.create_textured_image(2))[0]
+        for perceptual_hash in HASHES.values():
+            assert hamming(perceptual_hash(original), perceptual_hash(reencoded)) <= 4
+            assert hamming(perceptual_hash(original), perceptual_hash(different)) > 10
+
+    def test_flat_images_are_not_hashed(self):
+        flat = np.full((240, 320, 3), 90, dtype=np.uint8)
+        assert phash(flat) is None
+        assert find_duplicate(None, [(0, "0" * 16)], 64) is None
+
+    def test_reshot_photo_reuses_detections(self, monkeypatch):
+        """A near-duplicate skips the model, reuses the original's detections and is counted once"""
+        monkeypatch.setattr(main, "result_cache", ResultCache(main.result_cache.fingerprint))
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        first = self.upload(session_id, self.create_textured_image(3))
+
+        def fail(*args):
+            raise AssertionError("inference should not run for a near-duplicate")
+        monkeypatch.setattr(main, "inference_engine", fail)
+
+        second = self.upload(session_id, self.create_textured_image(3, fmt="JPEG", quality=70))
+        assert second["current_detection"]["duplicate_of"] == 0
+        assert second["current_detection"]["classes"] == first["current_detection"]["classes"]
+        assert second["detections_count"] == 2
+
+        report = client.post(f"/api/inspection/{session_id}/complete").json()
+        pickup = report["inspection_summary"]["pickup_phase"]
+        assert pickup["images_uploaded"] == 2
+        assert pickup["duplicate_images"] == 1
+
+    def test_different_photo_runs_model(self, monkeypatch):
+        monkeypatch.setattr(main, "result_cache", ResultCache(main.result_cache.fingerprint))
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        self.upload(session_id, self.create_textured_image(4))
+        second = self.upload(session_id, self.create_textured_image(5))
+        assert "duplicate_of" not in second["current_detection"]
+
+    def test_phases_are_separate(self, monkeypatch):
+        """The return photo of a panel is compared with pickup, not deduplicated against it"""
+        monkeypatch.setattr(main, "result_cache", ResultCache(main.result_cache.fingerprint))
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        self.upload(session_id, self.create_textured_image(6))
+        client.post(f"/api/inspection/{session_id}/switch-to-return")
+        returned = self.upload(session_id, self.create_textured_image(6, fmt="JPEG", quality=70))
+        assert "duplicate_of" not in returned["current_detection"]
+
+    def test_phase_switch_during_inference(self, monkeypatch):
+        """A pickup duplicate recorded after the switch to return is kept as a return photo"""
+        monkeypatch.setattr(main, "result_cache", ResultCache(main.result_cache.fingerprint))
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        first = self.upload(session_id, self.create_textured_image(8))
+        run_on_inference_pool = main.run_on_inference_pool
+
+        async def switch_then_run(fn, *args):
+            results = await run_on_inference_pool(fn, *args)
+            main.inspection_sessions.update(session_id, lambda session: session.update(phase='return'))
+            return results
+        monkeypatch.setattr(main, "run_on_inference_pool", switch_then_run)
+
+        response = client.post(
+            f"/api/inspection/{session_id}/detect",
+            files={"file": ("a.jpg", self.create_textured_image(8, fmt="JPEG", quality=70), "image/jpeg")}
+        )
+        assert response.status_code == 200
+        returned = response.json()
+        assert returned["phase"] == "return"
+        assert "duplicate_of" not in returned["current_detection"]
+        assert returned["current_detection"]["classes"] == first["current_detection"]["classes"]
+        assert returned["detections_count"] == 1
+
+    def test_batch_duplicates(self, monkeypatch):
+        monkeypatch.setattr(main, "result_cache", ResultCache(main.result_cache.fingerprint))
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        self.upload(session_id, self.create_textured_image(7))
+
+        response = client.post(
+            f"/api/inspection/{session_id}/detect-batch",
+            files=[
+                ("files", ("a.jpg", self.create_textured_image(8), "image/jpeg")),
+                ("files", ("b.jpg", self.create_textured_image(7, fmt="JPEG", quality=70), "image/jpeg")),
+                ("files", ("c.jpg", self.create_textured_image(8, fmt="JPEG", quality=70), "image/jpeg")),
+            ]
+        )
+        detections = [result["detection"] for result in response.json()["results"]]
+        assert "duplicate_of" not in detections[0]
+        assert detections[1]["duplicate_of"] == 0
+        assert detections[2]["duplicate_of"] == detections[0]["image_index"]
+
+    def test_can_be_disabled(self, monkeypatch):
+        monkeypatch.setattr(main, "result_cache", ResultCache(main.result_cache.fingerprint))
+        monkeypatch.setattr(main, "DUPLICATE_MAX_DISTANCE", -1)
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        self.upload(session_id, self.create_textured_image(9))
+        second = self.upload(session_id, self.create_textured_image(9, fmt="JPEG", quality=70))
+        assert "duplicate_of" not in second["current_detection"]
+
+
+class TestUploadLimits:
+    """Test upload size limits and image sniffing"""
+
+    def create_dummy_image(self, fmt="PNG"):
+        img_bytes = io.BytesIO()
+        Image.new("RGB", (320, 240), color="olive").save(img_bytes, format=fmt)
+        return img_bytes.getvalue()
+
+    def limited_app(self, max_bytes):
+        mini = FastAPI()
+        mini.add_middleware(BodySizeLimitMiddleware, max_bytes=max_bytes)
+
+        @mini.post("/upload")
+        async def upload(file: UploadFile = File(...)):
+            return {"size": len(await file.read())}
+        return TestClient(mini)
+
+    def test_sniff_image_type(self):
+        assert sniff_image_type(self.create_dummy_image("JPEG")) == "jpeg"
+        assert sniff_image_type(self.create_dummy_image("PNG")) == "png"
+        assert sniff_image_type(self.create_dummy_image("WEBP")) == "webp"
+        assert sniff_image_type(b"%PDF-1.7 ...") is None
+        assert sniff_image_type(self.create_dummy_image("BMP")) == "bmp"
+        assert sniff_image_type(b"BMW 320d, rear bumper scratched") is None
+
+    def test_non_image_rejected_before_inference(self, monkeypatch):
+        def fail(*args):
+            raise AssertionError("a non-image must not reach the model")
+        monkeypatch.setattr(main, "run_detection_pipeline", fail)
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+
+        response = client.post(f"/api/inspection/{session_id}/detect", files={"file": ("notes.txt", b"not an image at all", "image/png")})
+        assert response.status_code == 415
+        assert inspection_sessions[session_id]["pickup_detections"] == []
+
+    def test_undecodable_image_rejected(self):
+        """A file with an image signature that does not decode is a 400 on /detect, as in a batch"""
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        truncated = self.create_dummy_image("JPEG")[:200]
+        bogus_bmp = b"BM" + bytes(12) + (40).to_bytes(4, "little") + b"no pixels here"
+        for name, data in (("a.jpg", truncated), ("a.bmp", bogus_bmp)):
+            response = client.post(f"/api/inspection/{session_id}/detect", files={"file": (name, data, "image/jpeg")})
+            assert response.status_code == 400
+        response = client.post(f"/api/inspection/{session_id}/detect-batch", files=[("files", ("a.jpg", truncated, "image/jpeg"))])
+        assert response.status_code == 400
+        assert inspection_sessions[session_id]["pickup_detections"] == []
+
+    def test_spool_threshold_is_app_scoped(self):
+        """Uploads to the app spool at UPLOAD_SPOOL_MB, other apps keep Starlette's parser"""
+        default = MultiPartParser.spool_max_size
+        mini = FastAPI()
+        mini.router.route_class = spooling_route_class(1000)
+
+        @mini.post("/upload")
+        async def upload(file: UploadFile = File(...)):
+            return {"rolled": file.file._rolled}
+        assert TestClient(mini).post("/upload", files={"file": ("a.bin", b"x" * 5000)}).json() == {"rolled": True}
+        assert TestClient(mini).post("/upload", files={"file": ("a.bin", b"x" * 500)}).json() == {"rolled": False}
+        assert MultiPartParser.spool_max_size == default == 1024 * 1024
+
+    def test_oversized_image_rejected(self, monkeypatch):
+        monkeypatch.setattr(main, "UPLOAD_MAX_BYTES", 1024)
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        big = np.random.default_rng(0).integers(0, 255, (200, 200, 3), dtype=np.uint8)
+        data = cv2.imencode(".png", big)[1].tobytes()
+
+        response = client.post(f"/api/inspection/{session_id}/detect", files={"file": ("big.png", data, "image/png")})
+        assert response.status_code == 413
+
+        response = client.post(
+            f"/api/inspection/{session_id}/detect-batch",
+            files=[("files", ("a.png", self.create_dummy_image(), "image/png")), ("files", ("big.png", data, "image/png"))]
+        )
+        assert response.status_code == 413
+        assert inspection_sessions[session_id]["pickup_detections"] == []
+
+    def test_body_limit_from_content_length(self):
+        limited = self.limited_app(max_bytes=1000)
+        assert limited.post("/upload", files={"file": ("a.bin", b"x" * 100)}).json() == {"size": 100}
+        response = limited.post("/upload", files={"file": ("a.bin", b"x" * 5000)})
+        assert response.status_code == 413
+
+    def test_body_limit_while_streaming(self):
+        """Chunked bodies without a Content-Length are cut off once they pass the limit"""
+        limited = self.limited_app(max_bytes=1000)
+        boundary = "limit-test"
+        head = f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="a.bin"\r\n\r\n'.encode()
+        chunks = iter([head] + [b"x" * 500] * 10 + [f"\r\n--{boundary}--\r\n".encode()])
+        response = limited.post("/upload", content=chunks, headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
+        assert response.status_code == 413
+
+
+class TestResponseFormats:
+    """Test content negotiation of detection responses"""
+
+    def create_dummy_image(self):
+        cells = np.random.default_rng(30).integers(0, 255, (6, 8, 3), dtype=np.uint8)
+        img_bytes = io.BytesIO()
+        Image.fromarray(cells).resize((320, 240), Image.BILINEAR).save(img_bytes, format="PNG")
+        return img_bytes.getvalue()
+
+    def detect(self, session_id, accept=None):
+        headers = {"Accept": accept} if accept else {}
+        return client.post(
+            f"/api/inspection/{session_id}/detect",
+            files={"file": ("a.png", self.create_dummy_image(), "image/png")},
+            headers=headers
+        )
+
+    def split_multipart(self, response):
+        boundary = response.headers["content-type"].split("boundary=")[1].encode()
+        parts = response.content.split(b"--" + boundary)[1:-1]
+        return [part.strip(b"\r\n").split(b"\r\n\r\n", 1) for part in parts]
+
+    def test_negotiate(self):
+        assert formats.negotiate(None) == formats.JSON
+        assert formats.negotiate("*/*") == formats.JSON
+        assert formats.negotiate("application/msgpack, application/json;q=0.5") == formats.MSGPACK
+        assert formats.negotiate("application/msgpack;q=0.2, application/vnd.car-damage.compact+json") == formats.COMPACT_JSON
+        assert formats.negotiate("application/x-msgpack") == formats.MSGPACK
+        assert formats.negotiate("text/html") == formats.JSON
+
+    def test_compact_json_round_trips(self):
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        full = self.detect(session_id)
+        compact = self.detect(session_id, formats.COMPACT_JSON)
+
+        assert compact.headers["content-type"] == formats.COMPACT_JSON
+        assert len(compact.content) < len(full.content)
+        data = compact.json()
+        detection = unpack_record(data["current_detection"], data["classes"])
+        expected = full.json()["current_detection"]
+        assert detection["classes"] == expected["classes"]
+        assert detection["boxes"] == expected["boxes"]
+        assert detection["confidences"] == [round(conf, 2) for conf in expected["confidences"]]
+        assert data["image_url"].format(i=detection["image_index"]) == f"/api/inspection/{session_id}/images/1.jpg"
+        assert len(data["repair_costs"]) == len(data["classes"])
+
+    def test_msgpack(self):
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        response = self.detect(session_id, formats.MSGPACK)
+        assert response.headers["content-type"] == formats.MSGPACK
+        data = msgpack.unpackb(response.content)
+        assert data["session_id"] == session_id
+        assert len(data["current_detection"]["b"]) == 4 * len(data["current_detection"]["c"])
+
+    def test_multipart_carries_jpeg(self):
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        response = self.detect(session_id, "multipart/mixed")
+        assert response.headers["content-type"].startswith("multipart/mixed; boundary=")
+
+        (json_headers, json_body), (image_headers, image_body) = self.split_multipart(response)
+        assert formats.COMPACT_JSON.encode() in json_headers
+        assert json.loads(json_body)["current_detection"]["i"] == 0
+        assert b"Content-ID: <image-0>" in image_headers
+        assert image_body[:2] == b"\xff\xd8"
+        assert image_body == client.get(f"/api/inspection/{session_id}/images/0.jpg").content
+
+    def test_multipart_renders_off_event_loop(self, monkeypatch):
+        """Annotated images for multipart responses are rendered on a worker thread"""
+        render = main.render_annotated_image
+        loops = []
+        def recording_render(*args, **kwargs):
+            try:
+                loops.append(asyncio.get_running_loop())
+            except RuntimeError:
+                loops.append(None)
+            return render(*args, **kwargs)
+        monkeypatch.setattr(main, "render_annotated_image", recording_render)
+
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        assert self.detect(session_id, "multipart/mixed").status_code == 200
+        assert loops == [None]
+
+    def test_complete_formats(self):
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        client.post(f"/api/inspection/{session_id}/switch-to-return")
+        self.detect(session_id)
+        response = client.post(f"/api/inspection/{session_id}/complete", headers={"Accept": "multipart/mixed"})
+        parts = self.split_multipart(response)
+        report = json.loads(parts[0][1])
+        assert report["new_damages_detected"]["total_new_damages"] >= 0
+        assert "c" in report["return_detections_with_boxes"][0]
+        assert len(parts) == 2
+
+
+class TestImageDecoding:
+    """Test the fast decode path used before inference"""
+
+    def encode(self, size, format="JPEG"):
+        img = Image.new("RGB", size, color=(200, 30, 60))
+        img_bytes = io.BytesIO()
+        img.save(img_bytes, format=format)
+        return img_bytes.getvalue()
+
+    def test_full_resolution_decode_is_bgr(self):
+        """Without min_size the image is decoded at full size, in BGR order"""
+        image, scale = main.decode_image(self.encode((300, 200), "PNG"))
+        assert image.shape == (200, 300, 3)
+        assert tuple(image[0, 0]) == (60, 30, 200)
+        assert scale == (1.0, 1.0)
+
+    def test_large_jpeg_decoded_reduced(self):
+        """Large photos decode at the smallest scale that stays above min_size"""
+        image, scale = main.decode_image(self.encode((4000, 3000)), min_size=640)
+        assert image.shape == (750, 1000, 3)
+        assert scale == (4.0, 4.0)
+
+        image, scale = main.decode_image(self.encode((1000, 800)), min_size=640)
+        assert image.shape == (800, 1000, 3)
+
+    def test_pil_fallback_for_other_formats(self):
+        """Formats OpenCV can't read still decode through PIL"""
+        image, scale = main.decode_image(self.encode((64, 64), "ICO"))
+        assert image.shape == (64, 64, 3)
+        assert tuple(image[0, 0]) == (60, 30, 200)
+
+    def test_rescale_boxes(self):
+        results = main.rescale_boxes({"boxes": [[10, 20, 30, 40]]}, (4.0, 2.0))
+        assert results["boxes"] == [[40, 40, 120, 80]]
+
+
+class TestBatchScheduler:
+    """Test the micro-batching inference scheduler"""
+
+    def test_requests_within_window_share_a_batch(self):
+        """Requests submitted inside the wait window run as one batch"""
+        batching = BatchScheduler(detection, max_batch_size=4, max_wait_ms=500)
+        images = [np.full((320, 320, 3), value, dtype=np.uint8) for value in (10, 80, 160, 240)]
+
+        futures = [batching.submit(image) for image in images]
+        results = [future.result(timeout=30) for future in futures]
+
+        for image, result in zip(images, results):
+            assert result["classes"] == detection(image)["classes"]
+        stats = batching.stats()
+        assert stats["requests_total"] == 4
+        assert stats["batch_size_histogram"] == {4: 1}
+        assert stats["queue_depth"] == 0
+
+    def test_batch_size_is_capped(self):
+        """No batch exceeds the configured maximum size"""
+        batching = BatchScheduler(detection, max_batch_size=2, max_wait_ms=200)
+        images = [np.zeros((64, 64, 3), dtype=np.uint8)] * 5
+
+        batching.detect_batch(images)
+
+        stats = batching.stats()
+        assert stats["requests_total"] == 5
+        assert max(stats["batch_size_histogram"]) <= 2
+
+    def test_stats_endpoint(self):
+        """GET /api/inference/stats exposes queue depth and histograms"""
+        response = client.get("/api/inference/stats")
+        assert response.status_code == 200
+        data = response.json()
+        assert "queue_depth" in data
+        assert "batch_size_histogram" in data
+        assert "queue_depth_histogram" in data
+
+
+class TestInferencePool:
+    """Test the bounded inference worker pool and 503 backpressure"""
+
+    def create_dummy_image(self):
+        img = Image.new("RGB", (640, 640), color="blue")
+        img_bytes = io.BytesIO()
+        img.save(img_bytes, format="PNG")
+        img_bytes.seek(0)
+        return img_bytes
+
+    def test_saturated_pool_rejects_immediately(self):
+        """Work beyond workers + queue raises PoolSaturated instead of waiting"""
+        pool = InferencePool(max_workers=1, max_queue=0)
+        release = threading.Event()
+
+        async def scenario():
+            first = asyncio.ensure_future(pool.run(release.wait, 10))
+            await asyncio.sleep(0.05)
+            with pytest.raises(PoolSaturated):
+                await pool.run(sum, [1, 2])
+            release.set()
+            assert await first is True
+            assert await pool.run(sum, [1, 2]) == 3
+
+        asyncio.run(scenario())
+        assert pool.stats()["rejected_total"] == 1
+        assert pool.stats()["in_flight"] == 0
+        pool.shutdown()
+
+    def test_detect_returns_503_when_saturated(self, monkeypatch):
+        """Detect answers 503 with Retry-After while session endpoints stay available"""
+        saturated = InferencePool(max_workers=1, max_queue=0)
+        saturated._slots.acquire()
+        monkeypatch.setattr(main, "inference_pool", saturated)
+        # A previously seen image would be answered from the result cache
+        monkeypatch.setattr(main, "result_cache", ResultCache(main.result_cache.fingerprint))
+
+        response = client.post("/api/inspection/start")
+        assert response.status_code == 200
+        session_id = response.json()["session_id"]
+
+        response = client.post(
+            f"/api/inspection/{session_id}/detect",
+            files={"file": ("test.png", self.create_dummy_image(), "image/png")}
+        )
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == str(main.INFERENCE_RETRY_AFTER)
+        assert inspection_sessions[session_id]["pickup_detections"] == []
+
+        response = client.post(f"/api/inspection/{session_id}/switch-to-return")
+        assert response.status_code == 200
+
+    def test_blocking_work_runs_off_event_loop(self, monkeypatch):
+        """Session store, hashing, result cache and artifact store calls of /detect stay off the event loop"""
+        monkeypatch.setattr(main, "result_cache", ResultCache(main.result_cache.fingerprint))
+        on_loop = []
+
+        def recording(name, method):
+            def call(*args, **kwargs):
+                try:
+                    asyncio.get_running_loop()
+                    on_loop.append(name)
+                except RuntimeError:
+                    pass
+                return method(*args, **kwargs)
+            return call
+        for target, name in ((main.inspection_sessions, "get"), (main.inspection_sessions, "update"),
+                             (main.result_cache, "get"), (main.result_cache, "put"), (main.artifacts, "put")):
+            monkeypatch.setattr(target, name, recording(name, getattr(target, name)))
+
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        for path, files in (("detect", {"file": ("a.png", self.create_dummy_image(), "image/png")}),
+                            ("detect-batch", [("files", ("b.png", self.create_dummy_image(), "image/png"))])):
+            assert client.post(f"/api/inspection/{session_id}/{path}", files=files).status_code == 200
+        assert on_loop == []
+
+
+class CrashingDetection:
+    """Stands in for a model backend that takes its worker process down"""
+
+    def warm_up(self):
+        pass
+
+    def detect_batch(self, images):
+        os._exit(3)
+
+
+class TestModelProcessPool:
+    """Test multi-process serving with shared-memory frames"""
+
+    def test_dead_worker_fails_fast_and_is_replaced(self):
+        pool = ModelProcessPool(CrashingDetection, num_workers=1, timeout=60)
+        try:
+            start = time.perf_counter()
+            with pytest.raises(RuntimeError, match="exited with code 3"):
+                pool.detect(np.zeros((32, 32, 3), dtype=np.uint8))
+            assert time.perf_counter() - start < 30
+            assert pool.stats()["restarts_total"] == 1
+            assert pool.stats()["pending"] == 0
+            assert pool.wait_ready(timeout=30)
+            assert pool.stats()["workers_alive"] == 1
+        finally:
+            pool.shutdown()
+
+    def test_worker_results_match_in_process_detection(self):
+        """Frames passed through shared memory give the same detections"""
+        pool = ModelProcessPool(
+            partial(main.Detection, model_path=main.MODEL_PATH, classes=main.DAMAGE_CLASSES, postprocess=main.DETECTION_POSTPROCESS),
+            num_workers=2
+        )
+        images = [
+            np.full((480, 640, 3), 30, dtype=np.uint8),
+            np.random.default_rng(1).integers(0, 255, (600, 800, 3), dtype=np.uint8),
+        ]
+        try:
+            results = pool.detect_batch(images, return_annotated=True)
+            assert pool.stats()["workers_alive"] == 2
+            assert pool.stats()["pending"] == 0
+        finally:
+            pool.shutdown()
+
+        for image, result in zip(images, results):
+            expected = detection(image)
+            assert result["classes"] == expected["classes"]
+            assert result["boxes"] == expected["boxes"]
+            assert result["annotated_image"].startswith("data:image/jpeg;base64,")
+
+
+class TestInferenceBackends:
+    """Test the pluggable inference backends"""
+
+    def make_images(self):
+        rng = np.random.default_rng(5)
+        return [rng.integers(0, 255, (480, 640, 3), dtype=np.uint8) for _ in range(3)]
+
+    def assert_same_detections(self, backend):
+        engine = main.Detection(main.MODEL_PATH, main.DAMAGE_CLASSES, postprocess=main.DETECTION_POSTPROCESS, backend=backend)
+        images = self.make_images()
+        for expected, actual in zip(detection.detect_batch(images), engine.detect_batch(images)):
+            assert actual["classes"] == expected["classes"]
+            for box_a, box_b in zip(actual["boxes"], expected["boxes"]):
+                assert max(abs(a - b) for a, b in zip(box_a, box_b)) <= 2
+            assert actual["confidences"] == pytest.approx(expected["confidences"], abs=0.5)
+        assert engine.model.describe()["backend"] == backend
+
+    def test_unknown_backend(self):
+        """Selecting a backend that does not exist fails loudly"""
+        with pytest.raises(ValueError):
+            main.Detection(main.MODEL_PATH, main.DAMAGE_CLASSES, backend="tensorrt")
+
+    def test_onnxruntime_matches_opencv(self):
+        pytest.importorskip("onnxruntime")
+        self.assert_same_detections("onnxruntime")
+
+    def test_openvino_matches_opencv(self):
+        pytest.importorskip("openvino")
+        self.assert_same_detections("openvino")
+
+    def test_stats_report_backend(self):
+        response = client.get("/api/inference/stats")
+        assert response.json()["backend"]["backend"] == main.INFERENCE_BACKEND
+
+
+class TestOutputDecoding:
+    """Test the vectorized YOLOv8 output decoder"""
+
+    def make_preds(self):
+        """Two anchors above threshold (one multi-label), the rest below"""
+        preds = np.zeros((1, 8400, 4 + len(detection.classes)), dtype=np.float32)
+        preds[0, 10, :4] = [320, 320, 64, 32]
+        preds[0, 10, 4] = 0.5
+        preds[0, 10, 4 + 4] = 0.9
+        preds[0, 20, :4] = [100, 100, 20, 20]
+        preds[0, 20, 4] = 0.6
+        preds[0, 20, 4 + 2] = 0.7
+        return preds
+
+    def test_decoder_rescales_boxes_to_image(self):
+        """Boxes are converted from center xywh to ltwh in original image coordinates"""
+        results = detection._Detection__extract_output(
+            preds=self.make_preds(), image_shape=(1280, 640), input_shape=(640, 640)
+        )
+        assert [288, 608, 64, 64] in results["boxes"]
+        assert len(results["boxes"]) == len(results["classes"]) == len(results["confidences"])
+
+    def test_decoder_multi_label_and_argmax(self):
+        """Multi-label keeps every class above threshold, argmax keeps one per anchor"""
+        kwargs = dict(preds=self.make_preds(), image_shape=(640, 640), input_shape=(640, 640), nms=1.0)
+        multi = detection._Detection__extract_output(**kwargs)
+        single = detection._Detection__extract_output(multi_label=False, **kwargs)
+        assert sorted(multi["classes"]) == sorted(["damaged door", "dent", "damaged door", "damaged headlight"])
+        assert sorted(single["classes"]) == sorted(["dent", "damaged headlight"])
+
+    def test_decoder_empty_predictions(self):
+        """No candidates above threshold gives empty result lists"""
+        preds = np.zeros((1, 8400, 4 + len(detection.classes)), dtype=np.float32)
+        results = detection._Detection__extract_output(
+            preds=preds, image_shape=(640, 640), input_shape=(640, 640)
+        )
+        assert results == {"boxes": [], "confidences": [], "classes": []}
+
+    def test_decoder_confidence_is_class_score(self):
+        """Each detection reports the score of its own class"""
+        results = detection._Detection__extract_output(
+            preds=self.make_preds(), image_shape=(640, 640), input_shape=(640, 640), nms=1.0
+        )
+        scores = dict(zip(results["classes"], results["confidences"]))
+        assert scores["dent"] == pytest.approx(90.0)
+        assert scores["damaged headlight"] == pytest.approx(70.0)
+
+    def test_decoder_class_aware_nms(self):
+        """Overlapping boxes of different classes survive class-aware NMS only"""
+        kwargs = dict(preds=self.make_preds(), image_shape=(640, 640), input_shape=(640, 640), nms=0.45)
+        aware = detection._Detection__extract_output(class_aware=True, **kwargs)
+        agnostic = detection._Detection__extract_output(class_aware=False, **kwargs)
+        assert sorted(aware["classes"]) == sorted(["dent", "damaged door", "damaged headlight", "damaged door"])
+        assert sorted(agnostic["classes"]) == sorted(["dent", "damaged headlight"])
+
+    def make_crowded_preds(self, anchors=5000):
+        """Many non-overlapping anchors above threshold with distinct scores"""
+        preds = np.zeros((1, 8400, 4 + len(detection.classes)), dtype=np.float32)
+        ids = np.arange(anchors)
+        preds[0, ids, 0] = (ids % 100) * 8 + 4
+        preds[0, ids, 1] = (ids // 100) * 8 + 4
+        preds[0, ids, 2:4] = 4
+        preds[0, ids, 4] = np.linspace(0.3, 0.99, anchors)
+        return preds
+
+    def test_decoder_top_k_and_max_detections(self):
+        """Candidates are capped before NMS and results after it, best scores first"""
+        kwargs = dict(preds=self.make_crowded_preds(), image_shape=(800, 800), input_shape=(800, 800))
+        assert len(detection._Detection__extract_output(top_k=0, max_detections=0, **kwargs)["boxes"]) == 5000
+        capped = detection._Detection__extract_output(top_k=200, max_detections=0, **kwargs)
+        assert len(capped["boxes"]) == 200
+        assert min(capped["confidences"]) == pytest.approx(max(capped["confidences"]) - 199 * 69 / 4999, abs=1e-3)
+        limited = detection._Detection__extract_output(top_k=200, max_detections=10, **kwargs)
+        assert limited["confidences"] == capped["confidences"][:10]
+
+    def test_presets_apply_to_detect_batch(self):
+        """The engine's preset is used unless thresholds are passed explicitly"""
+        engine = main.Detection(main.MODEL_PATH, main.DAMAGE_CLASSES, postprocess=main.POSTPROCESS_PRESETS["precision"])
+        image = np.random.default_rng(3).integers(0, 255, (480, 640, 3), dtype=np.uint8)
+        precise = engine(image)
+        assert len(precise["boxes"]) <= main.POSTPROCESS_PRESETS["precision"]["max_detections"]
+        assert all(conf >= 50 for conf in precise["confidences"])
+        assert len(engine(image, score=0.0001, confidence=0.0001)["boxes"]) >= len(precise["boxes"])
+
+
 class TestCompletionWorkflow:
     """Test the inspection completion and comparison logic"""
 
@@ -188,8 +1352,9 @@ class TestCompletionWorkflow:
         assert "new_damages_detected" in data
         assert "return_detections_with_boxes" in data
 
-        # Verify session is deleted
-        assert session_id not in inspection_sessions
+        # Verify session is closed, only its image records are left
+        assert client.get(f"/api/inspection/{session_id}/summary").status_code == 404
+        assert set(inspection_sessions[session_id]) == {"session_id", "phase", "pickup_detections", "return_detections"}
 
     def test_complete_inspection_summary_structure(self):
         """Test that completion response has proper structure"""
@@ -233,6 +1398,275 @@ class TestCompletionWorkflow:
         assert "average" in cost
 
 
+class TestSpatialMatching:
+    """Test spatial pickup/return damage matching"""
+
+    def create_scene(self, offset=(0, 0), seed=0):
+        """A textured 640x480 view of a larger scene, shifted by offset"""
+        cells = np.random.default_rng(seed).integers(0, 255, (40, 50, 3), dtype=np.uint8)
+        scene = np.kron(cells, np.ones((16, 16, 1), dtype=np.uint8))
+        x, y = offset
+        return np.ascontiguousarray(scene[40 + y:520 + y, 40 + x:680 + x])
+
+    def encode(self, image):
+        return cv2.imencode(".png", image)[1].tobytes()
+
+    def test_assignment_beats_greedy(self):
+        """Hungarian assignment maximises total IoU instead of taking the best pair first"""
+        overlap = np.array([[0.9, 0.8], [0.7, 0.0]])
+        assert linear_assignment(1 - overlap) == [(0, 1), (1, 0)]
+        assert linear_assignment(np.ones((3, 1))) == [(0, 0)]
+
+    def test_match_boxes_per_class(self):
+        reference = [[0, 0, 10, 10], [100, 100, 10, 10]]
+        pairs = match_boxes(reference, ["dent", "dent"], [[101, 101, 10, 10], [1, 0, 10, 10]], ["dent", "dent"], 0.3)
+        assert pairs == [(0, 1), (1, 0)]
+        assert match_boxes(reference, ["dent", "dent"], [[0, 0, 10, 10]], ["damaged door"], 0.3) == []
+
+    def test_project_boxes(self):
+        shift = np.array([[1, 0, 25], [0, 1, -10], [0, 0, 1]], dtype=np.float64)
+        assert project_boxes([[100, 100, 50, 40]], shift) == [[125, 90, 50, 40]]
+
+    def test_shifted_view_is_aligned(self):
+        """A re-shot of the same view keeps its old damage and flags the new one"""
+        pickup_image, return_image = self.create_scene(), self.create_scene(offset=(30, 20))
+        features = {0: image_features(pickup_image), 1: image_features(return_image)}
+        pickup = [{"image_index": 0, "image_hash": None, "boxes": [[200, 150, 80, 60]], "classes": ["dent"]}]
+        returns = [{"image_index": 1, "image_hash": None, "boxes": [[170, 130, 80, 60], [400, 300, 50, 50]], "classes": ["dent", "dent"]}]
+
+        matches = match_inspection(pickup, returns, features.get)
+        assert matches["aligned_to"] == {1: 0}
+        assert matches["new"] == {1: [False, True]}
+        assert matches["matched"] == 1
+
+    def test_moved_damage_is_new(self):
+        """Same view, same class, but a different place on the car"""
+        image = self.create_scene()
+        features = {0: image_features(image), 1: image_features(image)}
+        pickup = [{"image_index": 0, "image_hash": None, "boxes": [[50, 50, 60, 60]], "classes": ["dent"]}]
+        returns = [{"image_index": 1, "image_hash": None, "boxes": [[400, 300, 60, 60]], "classes": ["dent"]}]
+        assert match_inspection(pickup, returns, features.get)["new"] == {1: [True]}
+
+    def test_unaligned_photos_fall_back_to_counts(self):
+        pickup = [{"image_index": 0, "image_hash": None, "boxes": [[0, 0, 10, 10]], "classes": ["dent"]}]
+        returns = [{"image_index": 1, "image_hash": None, "boxes": [[0, 0, 10, 10], [50, 50, 10, 10]], "classes": ["dent", "dent"]}]
+        matches = match_inspection(pickup, returns, lambda image_index: None)
+        assert matches["aligned_to"] == {1: None}
+        assert matches["new"] == {1: [False, True]}
+
+    def test_complete_with_spatial_matching(self):
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        client.post(f"/api/inspection/{session_id}/detect", files={"file": ("a.png", self.encode(self.create_scene()), "image/png")})
+        client.post(f"/api/inspection/{session_id}/switch-to-return")
+        client.post(f"/api/inspection/{session_id}/detect", files={"file": ("b.png", self.encode(self.create_scene()), "image/png")})
+
+        data = client.post(f"/api/inspection/{session_id}/complete", params={"matching": "spatial"}).json()
+        assert data["matching"]["mode"] == "spatial"
+        assert data["matching"]["aligned_images"] == 1
+        returned = data["return_detections_with_boxes"][0]
+        assert returned["aligned_to"] == 0
+        assert len(returned["new_damages"]) == len(returned["classes"])
+        # The same photo at return: everything was already there
+        assert data["new_damages_detected"]["total_new_damages"] == 0
+
+    def test_invalid_matching_mode(self):
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        response = client.post(f"/api/inspection/{session_id}/complete", params={"matching": "magic"})
+        assert response.status_code == 422
+
+
+class TestTiledInference:
+    """Test tiled inference for high-resolution photos"""
+
+    def create_large_image(self, seed, size=(2000, 1500)):
+        pixels = np.random.default_rng(seed).integers(0, 256, (size[1] // 10, size[0] // 10, 3), dtype=np.uint8)
+        img_bytes = io.BytesIO()
+        Image.fromarray(pixels).resize(size).save(img_bytes, format="JPEG")
+        return img_bytes.getvalue()
+
+    def test_tile_grid_covers_photo_within_cap(self):
+        assert tile_grid(640, 480) == [(0, 0, 640, 480)]
+        for width, height in ((1280, 960), (4000, 3000), (3000, 4000), (6000, 1000)):
+            grid = tile_grid(width, height, tile_size=640, overlap=0.2, max_tiles=16)
+            assert 1 < len(grid) <= 16
+            covered = np.zeros((height, width), dtype=bool)
+            for left, top, w, h in grid:
+                assert w >= 640 or w == width
+                covered[top:top + h, left:left + w] = True
+            assert covered.all()
+            # Neighbouring columns overlap by at least the requested share of a tile
+            lefts = sorted({left for left, _, _, _ in grid})
+            tile_width = grid[0][2]
+            assert all(b - a <= tile_width * 0.8 + 1 for a, b in zip(lefts, lefts[1:]))
+
+    def test_merge_joins_damage_cut_by_seam(self):
+        # A dent across the seam of two tiles at x=500: partial boxes in both, full box in the whole-photo pass
+        whole = {"boxes": [[450, 100, 100, 50]], "confidences": [60.0], "classes": ["dent"]}
+        left_tile = {"boxes": [[450, 100, 70, 50], [10, 10, 30, 30]], "confidences": [90.0, 50.0], "classes": ["dent", "dent"]}
+        right_tile = {"boxes": [[0, 100, 50, 50], [0, 100, 50, 50]], "confidences": [80.0, 70.0], "classes": ["dent", "damaged door"]}
+        merged = merge_detections([whole, left_tile, right_tile], [(0, 0), (0, 0), (500, 0)], min_overlap=0.5)
+        assert merged["classes"] == ["dent", "damaged door", "dent"]
+        assert merged["confidences"] == [90.0, 70.0, 50.0]
+        assert merged["boxes"][0] == [450, 100, 100, 50]
+        assert merged["boxes"][1] == [500, 100, 50, 50]
+        assert merge_detections([whole, left_tile], [(0, 0), (0, 0)], max_detections=1)["boxes"] == [[450, 100, 100, 50]]
+
+    def test_detect_tiled_on_request(self):
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        data = self.create_large_image(1)
+        tiled = client.post(f"/api/inspection/{session_id}/detect?tiled=true", files={"file": ("big.jpg", data, "image/jpeg")})
+        assert tiled.status_code == 200
+        detection_result = tiled.json()["current_detection"]
+        assert detection_result["tiles"] == len(tile_grid(2000, 1500, main.TILE_SIZE, main.TILE_OVERLAP, main.TILE_MAX_COUNT))
+        # Tile boxes are mapped back into the photo
+        assert all(box[0] < 2000 and box[1] < 1500 and box[0] + box[2] > 0 and box[1] + box[3] > 0 for box in detection_result["boxes"])
+
+        # Whole-photo results of the same bytes are cached apart from tiled ones
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        plain = client.post(f"/api/inspection/{session_id}/detect", files={"file": ("big.jpg", data, "image/jpeg")}).json()
+        assert plain["cached"] is False
+        assert "tiles" not in plain["current_detection"]
+
+    def test_detect_batch_tiled(self):
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        files = [
+            ("files", ("big.jpg", self.create_large_image(2), "image/jpeg")),
+            ("files", ("small.jpg", self.create_large_image(3, size=(600, 400)), "image/jpeg"))
+        ]
+        response = client.post(f"/api/inspection/{session_id}/detect-batch?tiled=true", files=files)
+        assert response.status_code == 200
+        assert [r["detection"]["tiles"] for r in response.json()["results"]] == [len(tile_grid(2000, 1500)), 1]
+
+
+class TestVideoIngestion:
+    """Test walk-around video ingestion"""
+
+    def view(self, seed):
+        pixels = np.random.default_rng(seed).integers(0, 256, (24, 32, 3), dtype=np.uint8)
+        return cv2.resize(pixels, (320, 240), interpolation=cv2.INTER_NEAREST)
+
+    def create_video(self, path, seeds=(1, 2, 3)):
+        """Two seconds per view at 10 fps: blurred while the camera settles, then sharp; a fast pan between views"""
+        writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"mp4v"), 10, (320, 240))
+        for seed in seeds:
+            view = self.view(seed)
+            for i in range(20):
+                writer.write(cv2.GaussianBlur(view, (0, 0), 8) if i < 6 else view)
+            for shift in range(1, 5):
+                writer.write(np.roll(view, shift * 60, axis=1))
+        writer.release()
+        return str(path)
+
+    def test_select_keyframes(self, tmp_path):
+        path = self.create_video(tmp_path / "walk.mp4")
+        stats = empty_video_stats()
+        keyframes = list(select_keyframes(path, stats, sample_fps=5))
+        assert len(keyframes) == 3
+        assert stats["frames"] == 72 and stats["sampled"] == 36
+        assert stats["blurry"] > 0 and stats["moving"] > 0 and stats["redundant"] > 0
+        # One sharp frame of each view, in order
+        for (frame_index, timestamp, frame), start in zip(keyframes, (0, 24, 48)):
+            assert start + 6 <= frame_index < start + 20
+            assert timestamp == pytest.approx(frame_index / 10)
+            assert np.abs(frame.astype(int) - self.view(start // 24 + 1)).mean() < 20
+
+        stats = empty_video_stats()
+        assert len(list(select_keyframes(path, stats, max_keyframes=2))) == 2
+        assert stats["truncated"] is True
+
+    def test_detect_video_records_keyframes(self, tmp_path):
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        with open(self.create_video(tmp_path / "walk.mp4"), "rb") as f:
+            response = client.post(f"/api/inspection/{session_id}/detect-video", files={"file": ("walk.mp4", f, "video/mp4")})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["video"]["keyframes"] == 3
+        assert [result["detection"]["image_index"] for result in data["results"]] == [0, 1, 2]
+        assert all(result["timestamp"] == pytest.approx(result["frame"] / 10) for result in data["results"])
+        # Stored like photos, annotated images included
+        assert len(inspection_sessions.get(session_id)["pickup_detections"]) == 3
+        image = client.get(f"/api/inspection/{session_id}/images/2.jpg")
+        assert image.status_code == 200 and image.headers["content-type"] == "image/jpeg"
+
+    def test_detect_video_keyframe_cap(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(main, "VIDEO_MAX_KEYFRAMES", 1)
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        with open(self.create_video(tmp_path / "walk.mp4"), "rb") as f:
+            data = client.post(f"/api/inspection/{session_id}/detect-video", files={"file": ("walk.mp4", f, "video/mp4")}).json()
+        assert len(data["results"]) == 1
+        assert data["video"]["truncated"] is True
+
+    def test_detect_video_rejects_non_video(self):
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        img_bytes = io.BytesIO()
+        Image.new("RGB", (64, 64)).save(img_bytes, format="JPEG")
+        response = client.post(f"/api/inspection/{session_id}/detect-video", files={"file": ("photo.jpg", img_bytes.getvalue(), "image/jpeg")})
+        assert response.status_code == 415
+        # A video signature in front of garbage cannot be decoded
+        response = client.post(f"/api/inspection/{session_id}/detect-video", files={"file": ("bad.mp4", b"\x00\x00\x00\x18ftypmp42" + b"\x00" * 1000, "video/mp4")})
+        assert response.status_code == 400
+        assert sniff_video_type(b"\x1a\x45\xdf\xa3\x01") == "webm"
+        assert sniff_video_type(b"RIFF\x00\x00\x00\x00AVI LIST") == "avi"
+
+
+class TestInspectionSummary:
+    """Test the running per-phase totals behind /summary and /complete"""
+
+    def create_image(self, seed):
+        cells = np.random.default_rng(seed).integers(0, 255, (6, 8, 3), dtype=np.uint8)
+        img_bytes = io.BytesIO()
+        Image.fromarray(cells).resize((320, 240), Image.BILINEAR).save(img_bytes, format="PNG")
+        return img_bytes.getvalue()
+
+    def upload(self, session_id, data):
+        return client.post(f"/api/inspection/{session_id}/detect", files={"file": ("a.png", data, "image/png")}).json()
+
+    def test_summary_tracks_uploads(self):
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        first = self.upload(session_id, self.create_image(20))["current_detection"]
+        self.upload(session_id, self.create_image(20))
+
+        summary = client.get(f"/api/inspection/{session_id}/summary").json()
+        pickup = summary["pickup_phase"]
+        assert summary["phase"] == "pickup"
+        assert pickup["images_uploaded"] == 2
+        # The second upload is the same photo, counted as an image but not as damages
+        assert pickup["duplicate_images"] == 1
+        assert pickup["total_damages"] == len(first["classes"])
+        assert sum(pickup["damages_by_type"].values()) == len(first["classes"])
+        assert pickup["repair_cost"]["min"] == sum(cost["min"] for cost in first["repair_costs"])
+        assert summary["return_phase"]["images_uploaded"] == 0
+        assert summary["new_damages_detected"]["total_new_damages"] == 0
+
+    def test_summary_matches_complete(self):
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        self.upload(session_id, self.create_image(21))
+        client.post(f"/api/inspection/{session_id}/switch-to-return")
+        self.upload(session_id, self.create_image(22))
+        self.upload(session_id, self.create_image(23))
+
+        summary = client.get(f"/api/inspection/{session_id}/summary").json()
+        report = client.post(f"/api/inspection/{session_id}/complete").json()
+        assert report["inspection_summary"]["pickup_phase"] == summary["pickup_phase"]
+        assert report["inspection_summary"]["return_phase"] == summary["return_phase"]
+        assert report["new_damages_detected"] == summary["new_damages_detected"]
+
+    def test_sessions_without_totals_are_rebuilt(self):
+        """Sessions stored before running totals were kept still report correctly"""
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        current = self.upload(session_id, self.create_image(24))["current_detection"]
+        session = inspection_sessions[session_id]
+        del session["pickup_summary"], session["return_summary"]
+
+        summary = client.get(f"/api/inspection/{session_id}/summary").json()
+        assert summary["pickup_phase"]["total_damages"] == len(current["classes"])
+        assert summary["pickup_phase"]["images_uploaded"] == 1
+
+    def test_summary_without_session(self):
+        response = client.get("/api/inspection/invalid-session-id/summary")
+        assert response.status_code == 404
+
+
 class TestSessionManagement:
     """Test session management and state handling"""
 
@@ -251,6 +1685,169 @@ class TestSessionManagement:
         assert session_id2 in inspection_sessions
 
 
+class TestSessionStores:
+    """Test the in-memory and Redis-protocol session stores"""
+
+    def make_session(self, session_id="s1"):
+        return {
+            "session_id": session_id,
+            "created_at": "2025-01-01T00:00:00",
+            "phase": "return",
+            "pickup_detections": [],
+            "return_detections": [{
+                "boxes": [[1, 2, 30, 40], [5, 6, 70, 80]],
+                "confidences": [91.234, 12.5],
+                "classes": ["dent", "damaged hood"],
+                "image_index": 0
+            }]
+        }
+
+    def test_memory_store_ttl_expiry(self):
+        """Sessions untouched for longer than the TTL are freed"""
+        store = MemorySessionStore(ttl_seconds=0.05)
+        store.create(self.make_session())
+        assert "s1" in store
+        time.sleep(0.1)
+        assert store.get("s1") is None
+        assert store.stats()["sessions"] == 0
+        assert store.stats()["expired_total"] == 1
+
+    def test_memory_store_hands_out_copies(self):
+        """Sessions only change through save/update, and a failed update changes nothing"""
+        store = MemorySessionStore()
+        store.create(self.make_session())
+        store.get("s1")["return_detections"].clear()
+        assert len(store.get("s1")["return_detections"]) == 1
+
+        def partial_change(session):
+            session["return_detections"].append(dict(session["return_detections"][0], image_index=1))
+            raise ValueError("conflict")
+        with pytest.raises(ValueError):
+            store.update("s1", partial_change)
+        assert len(store.get("s1")["return_detections"]) == 1
+
+    def test_memory_store_lru_bound(self):
+        """Abandoned-session churn never grows the store past max_sessions"""
+        store = MemorySessionStore(max_sessions=3)
+        for i in range(10):
+            store.create(self.make_session(f"s{i}"))
+            store.get("s0")
+        assert len(store) == 3
+        assert "s0" in store
+        assert "s8" in store and "s9" in store
+        assert store.stats()["evicted_total"] == 7
+
+    def test_compact_serialization_round_trip(self):
+        """Detection records survive the compact encoding"""
+        session = self.make_session()
+        data = pack_session(session, main.DAMAGE_CLASSES)
+        restored = unpack_session(data, main.DAMAGE_CLASSES)
+
+        assert b"damaged hood" not in data
+        assert restored["return_detections"][0]["boxes"] == [[1, 2, 30, 40], [5, 6, 70, 80]]
+        assert restored["return_detections"][0]["classes"] == ["dent", "damaged hood"]
+        assert restored["return_detections"][0]["confidences"] == [91.23, 12.5]
+        assert restored["phase"] == "return"
+
+    def test_redis_store(self):
+        """RedisSessionStore works against a Redis-protocol stand-in"""
+        fakeredis = pytest.importorskip("fakeredis")
+        store = RedisSessionStore(fakeredis.FakeRedis(), classes=main.DAMAGE_CLASSES, ttl_seconds=60)
+
+        store.create(self.make_session())
+        assert "s1" in store
+        assert store["s1"]["return_detections"][0]["classes"] == ["dent", "damaged hood"]
+        assert store.client.ttl("inspection:s1") > 0
+
+        store.delete("s1")
+        assert store.get("s1") is None
+        assert len(store) == 0
+
+    def test_memory_store_tracks_size_incrementally(self):
+        """Saving a session only measures the records added since the last save"""
+        store = MemorySessionStore()
+        session = self.make_session()
+        store.create(session)
+        before = store.stats()["bytes_used"]
+        record = dict(session["return_detections"][0], image_index=1)
+        session["return_detections"].append(record)
+        store.save(session)
+        assert store.stats()["bytes_used"] - before == len(json.dumps(record, separators=(",", ":"))) + 1
+
+        result = store.update("s1", lambda current: current["return_detections"].append(dict(record, image_index=2)) or "done")
+        assert result[1] == "done"
+        assert len(store["s1"]["return_detections"]) == 3
+        assert store.update("missing", lambda current: None) is None
+        store.delete("s1")
+        assert store.stats()["bytes_used"] == 0
+
+    def test_redis_concurrent_updates_keep_both_records(self):
+        """An update racing another worker's write is retried on the fresh copy"""
+        fakeredis = pytest.importorskip("fakeredis")
+        server = fakeredis.FakeServer()
+        worker_a = RedisSessionStore(fakeredis.FakeRedis(server=server), classes=main.DAMAGE_CLASSES)
+        worker_b = RedisSessionStore(fakeredis.FakeRedis(server=server), classes=main.DAMAGE_CLASSES)
+        worker_a.create(self.make_session())
+        record = worker_a["s1"]["return_detections"][0]
+
+        attempts = []
+        def add_a(session):
+            attempts.append(len(session["return_detections"]))
+            if len(attempts) == 1:
+                # Another worker records a photo between this worker's read and write
+                worker_b.update("s1", lambda other: other["return_detections"].append(dict(record, image_index=1)))
+            session["return_detections"].append(dict(record, image_index=len(session["return_detections"])))
+
+        worker_a.update("s1", add_a)
+        assert attempts == [1, 2]
+        assert [r["image_index"] for r in worker_b["s1"]["return_detections"]] == [0, 1, 2]
+
+    def test_redis_stats_use_counters(self):
+        """Session count and size come from counters kept on write, expired sessions included"""
+        fakeredis = pytest.importorskip("fakeredis")
+        client = fakeredis.FakeRedis()
+        store = RedisSessionStore(client, classes=main.DAMAGE_CLASSES, ttl_seconds=60)
+        store.create(self.make_session("s1"))
+        store.create(self.make_session("s2"))
+        assert store.stats()["sessions"] == 2
+        assert store.stats()["bytes_used"] == client.strlen("inspection:s1") + client.strlen("inspection:s2")
+
+        store.delete("s1")
+        assert store.stats()["bytes_used"] == client.strlen("inspection:s2")
+        # s2 expires on its own
+        client.delete("inspection:s2")
+        client.zadd("inspection:~expiry", {"s2": 0})
+        assert store.stats()["sessions"] == 0
+        assert store.stats()["bytes_used"] == 0
+        assert len(store) == 0
+
+    def test_workflow_with_redis_store(self, monkeypatch):
+        """The full inspection workflow runs on the Redis-backed store"""
+        fakeredis = pytest.importorskip("fakeredis")
+        store = RedisSessionStore(fakeredis.FakeRedis(), classes=main.DAMAGE_CLASSES)
+        monkeypatch.setattr(main, "inspection_sessions", store)
+
+        session_id = client.post("/api/inspection/start").json()["session_id"]
+        img = Image.new("RGB", (320, 240), color="purple")
+        img_bytes = io.BytesIO()
+        img.save(img_bytes, format="PNG")
+        response = client.post(
+            f"/api/inspection/{session_id}/detect",
+            files={"file": ("a.png", img_bytes.getvalue(), "image/png")}
+        )
+        assert response.status_code == 200
+        client.post(f"/api/inspection/{session_id}/switch-to-return")
+        assert store[session_id]["phase"] == "return"
+        assert len(store[session_id]["pickup_detections"]) == 1
+
+        response = client.post(f"/api/inspection/{session_id}/complete")
+        assert response.status_code == 200
+        assert store.get(session_id)["phase"] == "completed"
+        assert client.post(f"/api/inspection/{session_id}/switch-to-return").status_code == 404
+        # Image digests travel with the records, so any worker can serve the report images
+        assert client.get(f"/api/inspection/{session_id}/images/0.jpg").status_code == 200
+
+
 class TestErrorHandling:
     """Test error cases and edge cases"""
 
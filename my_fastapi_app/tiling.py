@@ -0,0 +1,107 @@
+"""
+Tiled inference for high-resolution photos.
+
+The whole-photo pass shrinks a 4000 px photo to the 640 px model input, so a
+small dent is only a few pixels wide by the time the model sees it. In tiled
+mode the photo is also cut into overlapping tiles that are each resized to the
+model input on their own:
+
+- tile_grid lays the tiles out: as large as the model input while covering the
+  photo takes at most max_tiles of them, larger (so downscaled less than the
+  whole photo, but downscaled) beyond that. Tiles are spread evenly, so
+  neighbours overlap by at least `overlap` of a tile.
+- The tiles run through the model together with the whole photo, which still
+  finds damage larger than a tile.
+- merge_detections maps tile boxes to photo coordinates and merges the copies of
+  one damage found in several tiles: starting from the most confident box, boxes
+  of the same class join it while their intersection with the merged box covers
+  at least `min_overlap` of the smaller of the two. Intersection over the smaller
+  box rather than IoU, since a damage cut by a tile seam is found as partial
+  boxes inside the complete one.
+"""
+
+import math
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+# (left, top, width, height) in photo pixels
+Tile = Tuple[int, int, int, int]
+
+
+def _tile_count(length: int, size: int, overlap: float) -> int:
+    if length <= size:
+        return 1
+    return math.ceil((length - size) / (size * (1 - overlap))) + 1
+
+
+def _tile_starts(length: int, size: int, count: int) -> List[int]:
+    if count == 1:
+        return [0]
+    return [round(i * (length - size) / (count - 1)) for i in range(count)]
+
+
+def tile_grid(width: int, height: int, tile_size: int = 640, overlap: float = 0.2, max_tiles: int = 16) -> List[Tile]:
+    """Overlapping tiles covering a width x height photo, at most max_tiles (a single tile: the whole photo)"""
+    size = tile_size
+    while _tile_count(width, size, overlap) * _tile_count(height, size, overlap) > max(1, max_tiles):
+        size = math.ceil(size * 1.1)
+
+    tile_width, tile_height = min(size, width), min(size, height)
+    columns, rows = _tile_count(width, size, overlap), _tile_count(height, size, overlap)
+    return [
+        (left, top, tile_width, tile_height)
+        for top in _tile_starts(height, tile_height, rows)
+        for left in _tile_starts(width, tile_width, columns)
+    ]
+
+
+def merge_detections(results: List[Dict], offsets: List[Tuple[int, int]], min_overlap: float = 0.5, max_detections: int = 0) -> Dict:
+    """
+    One set of detections from the results of several crops of a photo.
+
+    `offsets` are the (left, top) positions of the crops in the photo. Returns boxes
+    in photo coordinates, most confident first, like the Detection engine does.
+    """
+    boxes, confidences, classes = [], [], []
+    for crop_results, (left, top) in zip(results, offsets):
+        boxes.extend([x + left, y + top, w, h] for x, y, w, h in crop_results['boxes'])
+        confidences.extend(crop_results['confidences'])
+        classes.extend(crop_results['classes'])
+    if not boxes:
+        return {'boxes': [], 'confidences': [], 'classes': []}
+
+    ltwh = np.asarray(boxes, dtype=np.int64)
+    corners = np.concatenate([ltwh[:, :2], ltwh[:, :2] + ltwh[:, 2:]], axis=1)
+    areas = np.maximum(ltwh[:, 2] * ltwh[:, 3], 1)
+    class_names = np.asarray(classes)
+    merged = np.zeros(len(boxes), dtype=bool)
+
+    kept_boxes, kept_confidences, kept_classes = [], [], []
+    for i in np.argsort(-np.asarray(confidences), kind='stable'):
+        if merged[i]:
+            continue
+        candidates = ~merged & (class_names == class_names[i])
+        group = np.zeros(len(boxes), dtype=bool)
+        group[i] = True
+        box = corners[i]
+        # Grow the merged box until no other box overlaps it enough: the two halves of a
+        # damage cut by a seam may barely overlap each other, but both lie inside the whole
+        while True:
+            inter_w = np.clip(np.minimum(box[2], corners[:, 2]) - np.maximum(box[0], corners[:, 0]), 0, None)
+            inter_h = np.clip(np.minimum(box[3], corners[:, 3]) - np.maximum(box[1], corners[:, 1]), 0, None)
+            box_area = max((box[2] - box[0]) * (box[3] - box[1]), 1)
+            joining = candidates & ~group & (inter_w * inter_h / np.minimum(box_area, areas) >= min_overlap)
+            if not joining.any():
+                break
+            group |= joining
+            box = np.concatenate([corners[group, :2].min(axis=0), corners[group, 2:].max(axis=0)])
+        merged |= group
+
+        kept_boxes.append([int(box[0]), int(box[1]), int(box[2] - box[0]), int(box[3] - box[1])])
+        kept_confidences.append(confidences[i])
+        kept_classes.append(classes[i])
+        if max_detections and len(kept_boxes) == max_detections:
+            break
+
+    return {'boxes': kept_boxes, 'confidences': kept_confidences, 'classes': kept_classes}
@@ -0,0 +1,201 @@
+"""
+Bounded handling of image and video uploads.
+
+- BodySizeLimitMiddleware rejects a request body over the limit with 413: from
+  its Content-Length before anything is read, or while it streams in (chunked
+  uploads), so an oversized body is never buffered whole.
+- Routes built with spooling_route_class parse multipart bodies with a parser
+  that spools each file to a temporary file once it is larger than the spool
+  threshold, so concurrent large uploads do not sit in memory. Starlette's own
+  parser, used by any other app in the process, is left as it is.
+- read_upload checks the first bytes for an image signature (415 otherwise) and
+  the spooled size against the per-image limit (413) before reading the file
+  into the single buffer that hashing, decoding and the artifact store share.
+- save_upload does the same for a video, copying it in chunks to a file that
+  the decoder reads from, so a video is never held in memory whole.
+"""
+
+from contextlib import aclosing
+from typing import BinaryIO, Optional, Type
+
+from fastapi import HTTPException, Request, UploadFile
+from fastapi.routing import APIRoute
+from starlette.formparsers import MultiPartException, MultiPartParser, parse_options_header
+
+# Enough for every signature below, and for the BMP header size at bytes 14-18
+SNIFF_BYTES = 18
+
+# BITMAPCOREHEADER, BITMAPINFOHEADER, the V2/V3 extensions, BITMAPV4HEADER and BITMAPV5HEADER
+BMP_HEADER_SIZES = (12, 40, 52, 56, 108, 124)
+
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),  # and a known DIB header size, see sniff_image_type
+    (b'II*\x00', 'tiff'),
+    (b'MM\x00*', 'tiff'),
+    (b'\x00\x00\x01\x00', 'ico')
+)
+
+
+class UploadTooLarge(HTTPException):
+    def __init__(self, detail: str):
+        super().__init__(status_code=413, detail=detail)
+
+
+class UnsupportedUpload(HTTPException):
+    def __init__(self, detail: str):
+        super().__init__(status_code=415, detail=detail)
+
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """Image format from the first bytes of a file, None if it does not look like an image"""
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    for signature, image_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            if image_type == 'bmp' and int.from_bytes(head[14:18], 'little') not in BMP_HEADER_SIZES:
+                # Plenty of text starts with "BM"; a bitmap is followed by one of the DIB header sizes
+                return None
+            return image_type
+    return None
+
+
+def sniff_video_type(head: bytes) -> Optional[str]:
+    """Video container from the first bytes of a file, None if it does not look like a video"""
+    if head[4:8] == b'ftyp':
+        return 'mov' if head[8:10] == b'qt' else 'mp4'
+    if head.startswith(b'\x1a\x45\xdf\xa3'):
+        return 'webm'
+    if head[:4] == b'RIFF' and head[8:12] == b'AVI ':
+        return 'avi'
+    return None
+
+
+def spooling_route_class(max_bytes: int) -> Type[APIRoute]:
+    """Route class whose uploaded files are spooled to disk above max_bytes while the request is parsed"""
+    # Starlette renamed the attribute from max_file_size to spool_max_size in 0.36
+    attribute = 'spool_max_size' if hasattr(MultiPartParser, 'spool_max_size') else 'max_file_size'
+    parser_class = type('SpoolingMultiPartParser', (MultiPartParser,), {attribute: max_bytes})
+
+    class SpoolingRequest(Request):
+        async def _get_form(self, *, max_files=1000, max_fields=1000, max_part_size=1024 * 1024):
+            content_type, _ = parse_options_header(self.headers.get('Content-Type'))
+            if self._form is None and content_type == b'multipart/form-data':
+                try:
+                    async with aclosing(self.stream()) as stream:
+                        parser = parser_class(self.headers, stream, max_files=max_files, max_fields=max_fields, max_part_size=max_part_size)
+                        self._form = await parser.parse()
+                except MultiPartException as exc:
+                    raise HTTPException(status_code=400, detail=exc.message)
+            return await super()._get_form(max_files=max_files, max_fields=max_fields, max_part_size=max_part_size)
+
+    class SpoolingRoute(APIRoute):
+        def get_route_handler(self):
+            handler = super().get_route_handler()
+
+            async def spooling_handler(request: Request):
+                return await handler(SpoolingRequest(request.scope, request.receive))
+            return spooling_handler
+
+    return SpoolingRoute
+
+
+def _check_type(head: bytes, name: str):
+    if sniff_image_type(head) is None:
+        raise UnsupportedUpload(f"{name} is not a supported image (JPEG, PNG, WebP, BMP, TIFF, GIF)")
+
+
+def _check_size(size: int, max_bytes: int, name: str):
+    if size > max_bytes:
+        raise UploadTooLarge(f"{name} is larger than {max_bytes // (1024 * 1024)} MB")
+
+
+def check_image(data: bytes, max_bytes: int, name: str = 'Image'):
+    """The same checks as read_upload, for an image already received whole (e.g. a WebSocket frame)"""
+    _check_type(data[:SNIFF_BYTES], name)
+    _check_size(len(data), max_bytes, name)
+
+
+async def read_upload(upload: UploadFile, max_bytes: int) -> bytes:
+    """Contents of an uploaded image, rejected by signature and size before the full read"""
+    _check_type(await upload.read(SNIFF_BYTES), upload.filename)
+    if upload.size is not None:
+        _check_size(upload.size, max_bytes, upload.filename)
+
+    await upload.seek(0)
+    data = await upload.read(max_bytes + 1)
+    _check_size(len(data), max_bytes, upload.filename)
+    return data
+
+
+async def save_upload(upload: UploadFile, max_bytes: int, destination: BinaryIO, chunk_size: int = 1024 * 1024):
+    """Copy an uploaded video to `destination` in chunks, rejected by signature and size like read_upload"""
+    if sniff_video_type(await upload.read(SNIFF_BYTES)) is None:
+        raise UnsupportedUpload(f"{upload.filename} is not a supported video (MP4, MOV, WebM, MKV, AVI)")
+    if upload.size is not None:
+        _check_size(upload.size, max_bytes, upload.filename)
+
+    await upload.seek(0)
+    copied = 0
+    while chunk := await upload.read(chunk_size):
+        copied += len(chunk)
+        _check_size(copied, max_bytes, upload.filename)
+        destination.write(chunk)
+    destination.flush()
+
+
+class BodySizeLimitMiddleware:
+    """ASGI middleware answering 413 to request bodies over max_bytes"""
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        detail = f"Request body is larger than {self.max_bytes // (1024 * 1024)} MB"
+        content_length = dict(scope['headers']).get(b'content-length', b'')
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            await self._reject(send, detail)
+            return
+
+        received = 0
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > self.max_bytes:
+                    # An HTTPException passes through body parsing and becomes the 413 response
+                    raise UploadTooLarge(detail)
+            return message
+
+        async def tracking_send(message):
+            nonlocal response_started
+            response_started = response_started or message['type'] == 'http.response.start'
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except UploadTooLarge:
+            if response_started:
+                raise
+            await self._reject(send, detail)
+
+    @staticmethod
+    async def _reject(send, detail: str):
+        body = ('{"detail":"%s"}' % detail).encode()
+        await send({
+            'type': 'http.response.start',
+            'status': 413,
+            'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()), (b'connection', b'close')]
+        })
+        await send({'type': 'http.response.body', 'body': body})
@@ -0,0 +1,136 @@
+"""
+Keyframe selection for walk-around videos.
+
+A walk-around video shows the same few views of the car over and over, and
+many of its frames are softened by motion blur. select_keyframes reads the
+video one frame at a time and keeps the sharp frames that show a new view:
+
+- Frames are analyzed at `sample_fps` on a small grayscale copy; the frames in
+  between are only grabbed, not converted.
+- Blur: frames whose Laplacian variance is under `min_sharpness` are skipped.
+- Motion: frames that differ from the previous analyzed frame by more than
+  `max_motion` (mean absolute difference, 0-1) are skipped, since the camera
+  was moving fast (motion blur, rolling shutter).
+- Redundancy: frames whose perceptual hash is within `min_distance` bits of the
+  last keyframe's show the same view and are skipped.
+- Once a new view turns up, the sharpest of the frames analyzed over the next
+  `window` samples that show a new view becomes the keyframe.
+
+Only the current frame, the best candidate and a small grayscale frame are held
+in memory, whatever the video length. Reading stops after `max_keyframes`. A
+video with no frame passing the blur and motion checks still yields its
+sharpest frame.
+"""
+
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+import cv2
+import numpy as np
+from numpy import ndarray
+
+from duplicates import hamming, phash
+
+# Width of the grayscale copies that blur and hashes are measured on, and of the ones for motion
+ANALYSIS_WIDTH = 320
+MOTION_WIDTH = 80
+
+# (frame index, timestamp in seconds, BGR frame)
+Keyframe = Tuple[int, float, ndarray]
+
+
+def empty_video_stats() -> Dict:
+    return {
+        'frames': 0,
+        'fps': 0.0,
+        'sampled': 0,
+        'blurry': 0,
+        'moving': 0,
+        'redundant': 0,
+        'keyframes': 0,
+        'truncated': False
+    }
+
+
+def _resize_to_width(image: ndarray, width: int) -> ndarray:
+    height = max(1, round(image.shape[0] * width / image.shape[1]))
+    return cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+
+
+def sharpness(gray: ndarray) -> float:
+    """Variance of the Laplacian: high for crisp edges, low for blurred or featureless frames"""
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+
+def select_keyframes(
+    path: str,
+    stats: Dict,
+    sample_fps: float = 5.0,
+    max_keyframes: int = 30,
+    min_sharpness: float = 40.0,
+    max_motion: float = 0.12,
+    min_distance: int = 10,
+    window: int = 5,
+    hash_image: Callable[[ndarray], Optional[str]] = phash
+) -> Iterator[Keyframe]:
+    """Sharp, distinct frames of a video file, in order; counters are kept in `stats` (see empty_video_stats)"""
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        capture.release()
+        raise ValueError("Could not open video")
+
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        fps = fps if fps and np.isfinite(fps) and fps > 0 else 30.0
+        stats['fps'] = round(fps, 3)
+        step = max(1, round(fps / sample_fps))
+
+        index, previous, last_hash = -1, None, None
+        # (sharpness, frame index, frame, hash) of the best frame of the current window,
+        # and of the sharpest frame seen at all in case nothing passes the checks
+        candidate, fallback, remaining = None, None, 0
+        while capture.grab():
+            index += 1
+            stats['frames'] = index + 1
+            if index % step:
+                continue
+            ok, frame = capture.retrieve()
+            if not ok:
+                continue
+            stats['sampled'] += 1
+
+            gray = _resize_to_width(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), ANALYSIS_WIDTH)
+            small = _resize_to_width(gray, MOTION_WIDTH).astype(np.int16)
+            motion = float(np.abs(small - previous).mean()) / 255 if previous is not None else 0.0
+            previous = small
+
+            score = sharpness(gray)
+            if score < min_sharpness or motion > max_motion:
+                stats['blurry' if score < min_sharpness else 'moving'] += 1
+                if stats['keyframes'] == 0 and candidate is None and (fallback is None or score > fallback[0]):
+                    fallback = (score, index, frame, hash_image(gray))
+            else:
+                image_hash = hash_image(gray)
+                if image_hash is None or (last_hash is not None and hamming(image_hash, last_hash) <= min_distance):
+                    stats['redundant'] += 1
+                elif candidate is None or score > candidate[0]:
+                    if candidate is None:
+                        remaining = window
+                    candidate = (score, index, frame, image_hash)
+
+            if candidate is not None:
+                remaining -= 1
+                if remaining <= 0:
+                    _, keyframe_index, keyframe, last_hash = candidate
+                    candidate, fallback = None, None
+                    stats['keyframes'] += 1
+                    yield keyframe_index, keyframe_index / fps, keyframe
+                    if stats['keyframes'] >= max_keyframes:
+                        stats['truncated'] = capture.grab()
+                        return
+
+        final = candidate if candidate is not None else (fallback if stats['keyframes'] == 0 else None)
+        if final is not None:
+            stats['keyframes'] += 1
+            yield final[1], final[1] / fps, final[2]
+    finally:
+        capture.release()
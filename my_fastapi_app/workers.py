@@ -0,0 +1,356 @@
+"""
+Worker pools for running the detection pipeline off the event loop.
+
+Async endpoints hand decode + inference + encode to InferencePool instead of
+Starlette's default threadpool. Work beyond the pool size plus a small queue is
+refused immediately (PoolSaturated) so the API can answer 503 with Retry-After
+rather than queueing without limit.
+
+ModelProcessPool scales inference itself across cores: several worker
+processes, each with its own model, fed frames through shared memory.
+"""
+
+import asyncio
+import contextvars
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+from collections import Counter
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import connection, shared_memory
+from typing import Callable, Dict, List, Optional
+
+import cv2
+import numpy as np
+
+
+class PoolSaturated(Exception):
+    """Raised when every worker is busy and the wait queue is full"""
+
+
+class InferencePool:
+    def __init__(self, max_workers: int = 4, max_queue: int = 0, kind: str = 'thread'):
+        if kind not in ('thread', 'process'):
+            raise ValueError(f"Unknown executor kind: {kind}")
+
+        self.kind = kind
+        self.max_workers = max(1, int(max_workers))
+        self.max_queue = max(0, int(max_queue))
+        self._executor: Executor = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_workers + self.max_queue)
+        self.in_flight = 0
+        self.rejected_total = 0
+
+    @property
+    def executor(self) -> Executor:
+        # Created on first use so importing the app never spawns workers
+        with self._lock:
+            if self._executor is None:
+                if self.kind == 'process':
+                    # Each worker process imports the app module and loads its own model
+                    self._executor = ProcessPoolExecutor(
+                        self.max_workers, mp_context=multiprocessing.get_context('spawn')
+                    )
+                else:
+                    self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='inference')
+            return self._executor
+
+    def _release(self, _future=None):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    async def run(self, fn: Callable, *args):
+        """Run fn(*args) on the pool, or raise PoolSaturated without waiting"""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected_total += 1
+            raise PoolSaturated()
+
+        with self._lock:
+            self.in_flight += 1
+        try:
+            if self.kind == 'thread':
+                # Carry the request's context (e.g. its timing breakdown) onto the worker thread
+                future = self.executor.submit(contextvars.copy_context().run, fn, *args)
+            else:
+                future = self.executor.submit(fn, *args)
+        except Exception:
+            self._release()
+            raise
+
+        # The slot is held until the work itself finishes, even if the
+        # awaiting request is cancelled (e.g. the client disconnects)
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict:
+        return {
+            'kind': self.kind,
+            'max_workers': self.max_workers,
+            'max_queue': self.max_queue,
+            'in_flight': self.in_flight,
+            'rejected_total': self.rejected_total
+        }
+
+
+def _detect_shared_frames(detection, batch, segments, results):
+    images = [
+        np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        for (_, _, shape, dtype, _), shm in zip(batch, segments)
+    ]
+    batch_results = detection.detect_batch(images)
+    for (task_id, _, _, _, return_annotated), image, result in zip(batch, images, batch_results):
+        if return_annotated:
+            result['annotated_image'] = detection.annotate(image, result)
+        results.put((task_id, result, None))
+
+
+def _model_worker(index, cores, detection_factory, tasks, results, max_batch_size):
+    """Worker process loop: one Net per process, frames read from shared memory"""
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    cv2.setNumThreads(max(1, len(cores)))
+
+    detection = detection_factory()
+    # Load and warm up before taking work, then tell the pool this worker is ready
+    detection.warm_up()
+    results.put((None, index, None))
+    stopping = False
+
+    while not stopping:
+        task = tasks.get()
+        if task is None:
+            break
+
+        # Whatever else is already waiting runs in the same forward pass
+        batch = [task]
+        while len(batch) < max_batch_size:
+            try:
+                task = tasks.get_nowait()
+            except queue.Empty:
+                break
+            if task is None:
+                stopping = True
+                break
+            batch.append(task)
+
+        segments = []
+        try:
+            for _, shm_name, _, _, _ in batch:
+                segments.append(shared_memory.SharedMemory(name=shm_name))
+            # Array views into the segments only live inside this call, so
+            # the segments can be closed right after
+            _detect_shared_frames(detection, batch, segments, results)
+        except Exception as e:
+            for task_id, *_ in batch:
+                results.put((task_id, None, f"{type(e).__name__}: {e}"))
+        finally:
+            for shm in segments:
+                shm.close()
+
+
+class ModelProcessPool:
+    """
+    Pool of inference worker processes, each holding its own model pinned to a
+    set of cores. Decoded frames are handed over through shared memory instead
+    of being pickled, and only the (small) detection results travel back.
+
+    Every worker has its own task queue, so the pool knows which frames each
+    one holds: when a worker process dies, the callers waiting on it fail right
+    away instead of after the timeout, and a replacement worker is started.
+    """
+
+    def __init__(self, detection_factory: Callable, num_workers: int, cores_per_worker: int = 1,
+                 max_batch_size: int = 8, timeout: float = 60.0, check_interval: float = 0.5):
+        self.detection_factory = detection_factory
+        self.num_workers = max(1, int(num_workers))
+        self.cores_per_worker = max(1, int(cores_per_worker))
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.timeout = timeout
+        self.check_interval = check_interval
+
+        self._lock = threading.Lock()
+        self._context = None
+        self._processes = []
+        self._queues = []
+        self._pending: Dict[int, Future] = {}
+        # Task id -> index of the worker it was sent to
+        self._assigned: Dict[int, int] = {}
+        self._task_ids = itertools.count()
+        self._results = None
+        self._listener = None
+        self._watcher = None
+        self._stopping = False
+        self._ready_workers = set()
+        self._ready = threading.Event()
+        self.restarts_total = 0
+
+    def _worker_cores(self, index: int) -> List[int]:
+        cpu_count = os.cpu_count() or 1
+        first = index * self.cores_per_worker
+        return sorted({(first + i) % cpu_count for i in range(self.cores_per_worker)})
+
+    def _spawn(self, index: int):
+        """Start worker `index` with a fresh task queue (called with the lock held)"""
+        tasks = self._context.Queue()
+        process = self._context.Process(
+            target=_model_worker,
+            args=(index, self._worker_cores(index), self.detection_factory, tasks, self._results, self.max_batch_size),
+            name=f'model-worker-{index}',
+            daemon=True
+        )
+        process.start()
+        self._queues[index] = tasks
+        self._processes[index] = process
+
+    def start(self):
+        with self._lock:
+            if self._processes:
+                return
+            self._context = multiprocessing.get_context('spawn')
+            self._results = self._context.Queue()
+            self._stopping = False
+            self._processes = [None] * self.num_workers
+            self._queues = [None] * self.num_workers
+            for index in range(self.num_workers):
+                self._spawn(index)
+            self._listener = threading.Thread(target=self._listen, name='model-results', daemon=True)
+            self._listener.start()
+            self._watcher = threading.Thread(target=self._watch, name='model-watcher', daemon=True)
+            self._watcher.start()
+
+    def _listen(self):
+        while True:
+            item = self._results.get()
+            if item is None:
+                break
+            task_id, result, error = item
+            if task_id is None:
+                # Worker `result` has loaded and warmed up its model
+                with self._lock:
+                    self._ready_workers.add(result)
+                    if len(self._ready_workers) >= self.num_workers:
+                        self._ready.set()
+                continue
+            with self._lock:
+                future = self._pending.pop(task_id, None)
+                self._assigned.pop(task_id, None)
+            if future is None:
+                continue
+            if error is not None:
+                future.set_exception(RuntimeError(error))
+            else:
+                future.set_result(result)
+
+    def _watch(self):
+        """Fail the work of worker processes that died and start replacements"""
+        while True:
+            with self._lock:
+                if self._stopping:
+                    return
+                sentinels = {process.sentinel: index for index, process in enumerate(self._processes)}
+            for sentinel in connection.wait(list(sentinels), timeout=self.check_interval):
+                self._replace(sentinels[sentinel])
+
+    def _replace(self, index: int):
+        with self._lock:
+            process = self._processes[index] if not self._stopping else None
+            if process is None or process.is_alive():
+                return
+            lost = [task_id for task_id, worker in self._assigned.items() if worker == index]
+            futures = [self._pending.pop(task_id, None) for task_id in lost]
+            for task_id in lost:
+                del self._assigned[task_id]
+            self._ready_workers.discard(index)
+            self._ready.clear()
+            self.restarts_total += 1
+            # Tasks still queued for the dead worker are failed with it; the new one starts empty
+            self._spawn(index)
+
+        error = RuntimeError(f"Model worker {index} exited with code {process.exitcode}")
+        for future in futures:
+            if future is not None and not future.done():
+                future.set_exception(error)
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """Start the workers and wait until every one has loaded and warmed up its model"""
+        self.start()
+        return self._ready.wait(self.timeout if timeout is None else timeout)
+
+    def _submit(self, image, return_annotated: bool):
+        image = np.ascontiguousarray(image)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, image.nbytes))
+        np.ndarray(image.shape, dtype=image.dtype, buffer=shm.buf)[:] = image
+
+        task_id = next(self._task_ids)
+        future = Future()
+        with self._lock:
+            # To the worker with the fewest frames waiting
+            loads = Counter(self._assigned.values())
+            index = min(range(self.num_workers), key=lambda worker: loads[worker])
+            self._pending[task_id] = future
+            self._assigned[task_id] = index
+            self._queues[index].put((task_id, shm.name, image.shape, image.dtype.str, return_annotated))
+        return task_id, future, shm
+
+    def _release(self, task_id: int, shm):
+        with self._lock:
+            self._pending.pop(task_id, None)
+            self._assigned.pop(task_id, None)
+        shm.close()
+        shm.unlink()
+
+    def detect(self, image, return_annotated: bool = False) -> dict:
+        return self.detect_batch([image], return_annotated=return_annotated)[0]
+
+    def detect_batch(self, images, return_annotated: bool = False) -> List[dict]:
+        self.start()
+        submitted = [self._submit(image, return_annotated) for image in images]
+        try:
+            return [future.result(timeout=self.timeout) for _, future, _ in submitted]
+        finally:
+            for task_id, _, shm in submitted:
+                self._release(task_id, shm)
+
+    def shutdown(self):
+        with self._lock:
+            processes, self._processes = self._processes, []
+            queues, self._queues = self._queues, []
+            self._stopping = True
+            self._ready_workers.clear()
+            self._ready.clear()
+            watcher = self._watcher
+        if not processes:
+            return
+        watcher.join()
+        for tasks in queues:
+            tasks.put(None)
+        for process in processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self._results.put(None)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            alive = sum(process.is_alive() for process in self._processes)
+            ready = len(self._ready_workers)
+            pending = len(self._pending)
+        return {
+            'workers': self.num_workers,
+            'workers_alive': alive,
+            'workers_ready': ready,
+            'cores_per_worker': self.cores_per_worker,
+            'pending': pending,
+            'restarts_total': self.restarts_total
+        }
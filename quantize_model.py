@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Model Quantization Script - INT8 and FP16 variants of best.onnx
+Writes my_fastapi_app/best.int8.onnx (static INT8, calibrated on a slice of
+test_images/test) and my_fastapi_app/best.fp16.onnx (FP16 weights and
+activations, FP32 inputs/outputs). Serve one with MODEL_VARIANT=int8|fp16
+once compare_model_variants.py says it agrees closely enough with FP32.
+
+Calibration images are preprocessed exactly like the Detection engine does
+(reduced-size decode, blobFromImage at 640x640, RGB, 1/255).
+
+Run with: python quantize_model.py [--variants int8,fp16] [--calibration-images 100]
+"""
+
+import os
+import sys
+import argparse
+import tempfile
+from pathlib import Path
+
+import cv2
+import onnx
+
+# Add my_fastapi_app to path so we can import the model settings
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'my_fastapi_app'))
+
+from main import DECODE_MIN_SIZE, decode_image, model_variant_path
+
+ROOT = Path(__file__).parent
+
+# The first N test images calibrate INT8; compare_model_variants.py skips them by default
+CALIBRATION_IMAGES = 100
+
+
+def calibration_images(num_images):
+    test_images_dir = ROOT / "test_images" / "test"
+    return sorted(test_images_dir.glob("*.jpg"))[:num_images]
+
+
+def output_nodes(model):
+    """Nodes writing the graph outputs: the head concatenating box coordinates (0-640)
+    with class scores (0-1), which a single INT8 scale cannot represent"""
+    outputs = {output.name for output in model.graph.output}
+    return [node.name for node in model.graph.node if outputs & set(node.output)]
+
+
+def load_named(src):
+    """Load a model, naming unnamed nodes: excluding nodes from quantization needs
+    names, and the FP16 converter derives clashing names from empty ones"""
+    model = onnx.load(src)
+    for i, node in enumerate(model.graph.node):
+        if not node.name:
+            node.name = f"{node.op_type}_{i}"
+    return model
+
+
+def quantize_int8(src, dst, image_paths, per_channel=True):
+    from onnxruntime.quantization import (
+        CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType, quantize_static
+    )
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    class TestImagesReader(CalibrationDataReader):
+        def __init__(self, input_name):
+            self.input_name = input_name
+            self.paths = iter(image_paths)
+
+        def get_next(self):
+            img_path = next(self.paths, None)
+            if img_path is None:
+                return None
+            image, _ = decode_image(img_path.read_bytes(), min_size=DECODE_MIN_SIZE)
+            blob = cv2.dnn.blobFromImage(image, 1/255.0, (640, 640), swapRB=True, crop=False)
+            return {self.input_name: blob}
+
+    model = load_named(src)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        named = os.path.join(tmp, 'named.onnx')
+        preprocessed = os.path.join(tmp, 'preprocessed.onnx')
+        onnx.save(model, named)
+        quant_pre_process(named, preprocessed)
+
+        quantize_static(
+            preprocessed,
+            dst,
+            TestImagesReader(model.graph.input[0].name),
+            quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            per_channel=per_channel,
+            calibrate_method=CalibrationMethod.MinMax,
+            nodes_to_exclude=output_nodes(model)
+        )
+
+
+def convert_fp16(src, dst):
+    from onnxconverter_common import float16
+
+    model = float16.convert_float_to_float16(load_named(src), keep_io_types=True)
+    onnx.save(model, dst)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--variants', type=str, default='int8,fp16', help='comma-separated variants to produce')
+    parser.add_argument('--calibration-images', type=int, default=CALIBRATION_IMAGES, help='first N test images used to calibrate INT8')
+    parser.add_argument('--per-tensor', action='store_true', help='per-tensor instead of per-channel INT8 weights')
+    args = parser.parse_args()
+
+    src = model_variant_path('fp32')
+    if not os.path.exists(src):
+        print(f"❌ {src} not found!")
+        return False
+
+    for variant in args.variants.split(','):
+        dst = model_variant_path(variant)
+        if variant == 'int8':
+            image_paths = calibration_images(args.calibration_images)
+            print(f"⚙️  Calibrating INT8 on {len(image_paths)} test images...")
+            quantize_int8(src, dst, image_paths, per_channel=not args.per_tensor)
+        elif variant == 'fp16':
+            print("⚙️  Converting to FP16...")
+            convert_fp16(src, dst)
+        else:
+            print(f"❌ Unknown variant '{variant}'")
+            return False
+        print(f"✅ {variant}: {dst} ({os.path.getsize(dst) / 1024 / 1024:.1f} MB, FP32 {os.path.getsize(src) / 1024 / 1024:.1f} MB)")
+
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)